@@ -0,0 +1,331 @@
+# benchmark.py
+
+import argparse
+import json
+import os
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from answer_parser import parse_boxes, parse_points
+from model_backend import create_model
+from telemetry import configure_logging
+
+# --- Configuration ---
+MODEL_ID = "BAAI/RoboBrain2.0-3B"
+MANIFEST_PATH = "benchmark/manifest.json"
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _inside(point, region):
+    x, y = point
+    x1, y1, x2, y2 = region
+    return x1 <= x <= x2 and y1 <= y <= y2
+
+
+def iou(box_a, box_b):
+    """
+    Intersection over union of two [x1, y1, x2, y2] boxes.
+    """
+    ix1, iy1 = max(box_a[0], box_b[0]), max(box_a[1], box_b[1])
+    ix2, iy2 = min(box_a[2], box_b[2]), min(box_a[3], box_b[3])
+    intersection = max(0, ix2 - ix1) * max(0, iy2 - iy1)
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    area_b = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def score(entry, answer):
+    """
+    Scores one answer against the manifest's expectation:
+    pointing -> share of predicted points inside an expected region,
+    grounding/affordance -> IoU of the first predicted box,
+    verify/object -> exact answer match.
+    """
+    expected = entry["expected"]
+    if "regions" in expected:
+        points = parse_points(answer)
+        hits = sum(1 for p in points if any(_inside(p, r) for r in expected["regions"]))
+        return {"points": points, "hit_rate": hits / len(points) if points else 0.0, "any_hit": hits > 0}
+    if "box" in expected:
+        boxes = parse_boxes(answer)
+        return {"boxes": boxes, "iou": iou(boxes[0], expected["box"]) if boxes else 0.0}
+    return {"correct": answer.strip().lower() == expected["answer"].lower()}
+
+
+class MemoryProbe:
+    """
+    Peak GPU memory (when torch and CUDA are available) and peak process RSS.
+    """
+    def __init__(self):
+        try:
+            import torch
+            self.torch = torch if torch.cuda.is_available() else None
+        except ImportError:
+            self.torch = None
+
+    def reset(self):
+        if self.torch is not None:
+            self.torch.cuda.reset_peak_memory_stats()
+
+    def peak_gpu_mb(self):
+        if self.torch is None:
+            return None
+        return round(self.torch.cuda.max_memory_allocated() / 2**20, 1)
+
+    @staticmethod
+    def peak_cpu_mb():
+        # ru_maxrss is reported in KiB on Linux.
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_benchmark(model, manifest, batch_size=4, enable_thinking=False, do_sample=False, warmup=1):
+    """
+    Runs every manifest entry through model.batch_inference, grouped by task,
+    and returns per-sample records and per-task summaries.
+    """
+    probe = MemoryProbe()
+    by_task = {}
+    for entry in manifest:
+        by_task.setdefault(entry["task"], []).append(entry)
+
+    samples = []
+    tasks = {}
+    for task, entries in by_task.items():
+        # Warm-up batches are run but not measured.
+        for _ in range(warmup):
+            warm = entries[:batch_size]
+            model.batch_inference([e["prompt"] for e in warm], [os.path.abspath(e["image"]) for e in warm],
+                                  task=task, enable_thinking=enable_thinking, do_sample=do_sample)
+
+        probe.reset()
+        latencies, output_tokens, generate_s, visual_tokens = [], 0, 0.0, []
+        for i in range(0, len(entries), batch_size):
+            batch = entries[i:i + batch_size]
+            start = time.perf_counter()
+            results = model.batch_inference([e["prompt"] for e in batch], [os.path.abspath(e["image"]) for e in batch],
+                                            task=task, enable_thinking=enable_thinking, do_sample=do_sample)
+            latency = time.perf_counter() - start
+
+            stats = getattr(model, "last_stats", {}) or {}
+            output_tokens += stats.get("output_tokens", 0)
+            generate_s += stats.get("generate_s", 0.0)
+            if "visual_tokens" in stats:
+                visual_tokens.append(stats["visual_tokens"] / len(batch))
+
+            for entry, result in zip(batch, results):
+                latencies.append(latency)
+                samples.append({
+                    "id": entry["id"],
+                    "task": task,
+                    "answer": result["answer"],
+                    "batch_latency_s": round(latency, 4),
+                    **score(entry, result["answer"]),
+                })
+
+        task_samples = [s for s in samples if s["task"] == task]
+        summary = {
+            "samples": len(task_samples),
+            "latency_ms": {
+                "p50": round(1000 * _percentile(latencies, 50), 2),
+                "p90": round(1000 * _percentile(latencies, 90), 2),
+                "p99": round(1000 * _percentile(latencies, 99), 2),
+                "mean": round(1000 * sum(latencies) / len(latencies), 2),
+            },
+            "tokens_per_s": round(output_tokens / generate_s, 2) if generate_s > 0 else None,
+            "visual_tokens_mean": round(sum(visual_tokens) / len(visual_tokens), 1) if visual_tokens else None,
+            "peak_gpu_mb": probe.peak_gpu_mb(),
+        }
+        if any("hit_rate" in s for s in task_samples):
+            summary["hit_rate"] = round(sum(s["hit_rate"] for s in task_samples) / len(task_samples), 4)
+            summary["any_hit_rate"] = round(sum(s["any_hit"] for s in task_samples) / len(task_samples), 4)
+        if any("iou" in s for s in task_samples):
+            summary["mean_iou"] = round(sum(s["iou"] for s in task_samples) / len(task_samples), 4)
+        if any("correct" in s for s in task_samples):
+            summary["accuracy"] = round(sum(s["correct"] for s in task_samples) / len(task_samples), 4)
+        tasks[task] = summary
+        print(f"[Benchmark] {task}: {json.dumps(summary)}")
+
+    return {"tasks": tasks, "samples": samples, "peak_cpu_mb": probe.peak_cpu_mb()}
+
+
+def run_assisted_comparison(model, manifest, enable_thinking=True, warmup=1):
+    """
+    Runs every manifest entry twice with greedy decoding, once with plain generate
+    and once with the model's assisted decoding, and reports per-task latency,
+    speed-up, draft acceptance rate and whether the two outputs are identical.
+    The model must support assisted decoding (SimpleInference with an assistant).
+    """
+    if not getattr(model, "assistant_kwargs", None):
+        raise ValueError("The model has no assistant configured; set ROBOBRAIN_ASSISTANT.")
+
+    def run(entry, assisted):
+        model.use_assistant = assisted
+        start = time.perf_counter()
+        result = model.inference(entry["prompt"], os.path.abspath(entry["image"]), task=entry["task"],
+                                 plot=False, enable_thinking=enable_thinking, do_sample=False)
+        return result, time.perf_counter() - start, dict(model.last_stats)
+
+    by_task = {}
+    for entry in manifest:
+        by_task.setdefault(entry["task"], []).append(entry)
+
+    samples = []
+    tasks = {}
+    try:
+        for task, entries in by_task.items():
+            for entry in entries[:warmup]:
+                run(entry, False)
+                run(entry, True)
+
+            task_samples = []
+            for entry in entries:
+                plain, plain_s, plain_stats = run(entry, False)
+                assisted, assisted_s, assisted_stats = run(entry, True)
+                task_samples.append({
+                    "id": entry["id"],
+                    "task": task,
+                    "plain_latency_s": round(plain_s, 4),
+                    "assisted_latency_s": round(assisted_s, 4),
+                    "output_tokens": plain_stats.get("output_tokens"),
+                    "drafted_tokens": assisted_stats.get("drafted_tokens", 0),
+                    "accepted_tokens": assisted_stats.get("accepted_tokens", 0),
+                    "outputs_match": plain == assisted,
+                })
+            samples.extend(task_samples)
+
+            plain_latencies = [s["plain_latency_s"] for s in task_samples]
+            assisted_latencies = [s["assisted_latency_s"] for s in task_samples]
+            drafted = sum(s["drafted_tokens"] for s in task_samples)
+            summary = {
+                "samples": len(task_samples),
+                "plain_latency_ms": {"p50": round(1000 * _percentile(plain_latencies, 50), 2),
+                                     "mean": round(1000 * sum(plain_latencies) / len(plain_latencies), 2)},
+                "assisted_latency_ms": {"p50": round(1000 * _percentile(assisted_latencies, 50), 2),
+                                        "mean": round(1000 * sum(assisted_latencies) / len(assisted_latencies), 2)},
+                "speedup": round(sum(plain_latencies) / sum(assisted_latencies), 3) if sum(assisted_latencies) > 0 else None,
+                "acceptance_rate": round(sum(s["accepted_tokens"] for s in task_samples) / drafted, 4) if drafted else None,
+                "output_match_rate": round(sum(s["outputs_match"] for s in task_samples) / len(task_samples), 4),
+            }
+            tasks[task] = summary
+            print(f"[Benchmark] {task} (assisted vs plain): {json.dumps(summary)}")
+    finally:
+        model.use_assistant = True
+
+    return {"tasks": tasks, "samples": samples}
+
+
+def _measure_throughput(model, manifest, concurrency, requests, enable_thinking):
+    """
+    Sends `requests` manifest entries (cycled) through model.inference from
+    `concurrency` threads at once and measures completed requests per second.
+    """
+    entries = [manifest[i % len(manifest)] for i in range(requests)]
+    busy_before = getattr(model, "generate_busy_s", None)
+
+    def one(entry):
+        start = time.perf_counter()
+        model.inference(entry["prompt"], os.path.abspath(entry["image"]), task=entry["task"],
+                        plot=False, enable_thinking=enable_thinking, do_sample=False)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, entries))
+    wall = time.perf_counter() - start
+
+    busy_after = getattr(model, "generate_busy_s", None)
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 3),
+        "requests_per_s": round(requests / wall, 3),
+        "latency_ms": {
+            "p50": round(1000 * _percentile(latencies, 50), 2),
+            "p99": round(1000 * _percentile(latencies, 99), 2),
+        },
+        # Share of wall time the GPU spent inside generate.
+        "gpu_busy": round((busy_after - busy_before) / wall, 4) if busy_before is not None else None,
+    }
+
+
+def run_throughput(model, manifest, concurrency=4, requests=32, enable_thinking=False, preprocess_workers=2, warmup=1):
+    """
+    Throughput under concurrent load, with requests going straight to the model
+    and through PipelinedInference (when the backend supports it).
+    """
+    modes = {"direct": model}
+    if hasattr(model, "_prepare_inputs"):
+        # Imported here so the fake backend runs without torch.
+        from inference_pipeline import PipelinedInference
+        direct = model.model if isinstance(model, PipelinedInference) else model
+        modes = {"direct": direct, "pipelined": PipelinedInference(direct, preprocess_workers=preprocess_workers)}
+
+    results = {}
+    for name, target in modes.items():
+        if warmup:
+            _measure_throughput(target, manifest, concurrency, warmup * concurrency, enable_thinking)
+        results[name] = _measure_throughput(target, manifest, concurrency, requests, enable_thinking)
+        print(f"[Benchmark] throughput ({name}): {json.dumps(results[name])}")
+    if "pipelined" in modes:
+        modes["pipelined"].close()
+    if "pipelined" in results:
+        results["speedup"] = round(results["pipelined"]["requests_per_s"] / results["direct"]["requests_per_s"], 3)
+    return {"throughput": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Non-interactive speed and accuracy benchmark over the bundled images.")
+    parser.add_argument("--model-id", default=MODEL_ID)
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="JSON list of {id, image, task, prompt, expected}.")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured warm-up batches per task.")
+    parser.add_argument("--thinking", action="store_true", help="Enable thinking mode.")
+    parser.add_argument("--sample", action="store_true", help="Sample instead of greedy decoding.")
+    parser.add_argument("--assisted", action="store_true",
+                        help="Compare assisted against plain greedy decoding per task (needs ROBOBRAIN_ASSISTANT).")
+    parser.add_argument("--throughput", type=int, metavar="N",
+                        help="Measure throughput over N concurrent requests, direct vs pipelined.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent requests for --throughput.")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+    configure_logging()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    model = create_model(args.model_id)
+    # Measured runs must generate every time, not be answered from the warm-restart cache.
+    feature_cache = getattr(model, "feature_cache", None)
+    if feature_cache is not None:
+        feature_cache.enabled = False
+    if args.throughput:
+        report = run_throughput(model, manifest, concurrency=args.concurrency, requests=args.throughput,
+                                enable_thinking=args.thinking, warmup=args.warmup)
+    elif args.assisted:
+        if args.sample:
+            parser.error("--assisted compares greedy outputs and cannot be combined with --sample.")
+        report = run_assisted_comparison(model, manifest, enable_thinking=args.thinking, warmup=args.warmup)
+    else:
+        report = run_benchmark(model, manifest, batch_size=args.batch_size, enable_thinking=args.thinking,
+                               do_sample=args.sample, warmup=args.warmup)
+    report["config"] = {
+        "model_id": args.model_id,
+        "backend": os.environ.get("ROBOBRAIN_BACKEND", "hf"),
+        "manifest": args.manifest,
+        "batch_size": args.batch_size,
+        "concurrency": args.concurrency if args.throughput else None,
+        "enable_thinking": args.thinking,
+        "do_sample": args.sample,
+        "assistant": os.environ.get("ROBOBRAIN_ASSISTANT") if args.assisted else None,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,98 @@
+# detection_cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def dhash(frame, hash_size=16):
+    """
+    Difference hash of a BGR frame: the frame is shrunk to hash_size x hash_size
+    gradients and every bit says whether a pixel is brighter than its right
+    neighbour. Frames of an unchanged scene differ in only a few bits, even
+    under sensor noise and JPEG artefacts.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class DetectionCache:
+    """
+    Remembers detection results by (prompt, frame hash) so that re-detecting an
+    unchanged scene, e.g. after an occlusion or a repeated 's' press, reuses the
+    previous points instead of waiting for the server.
+
+    A lookup hits when a stored frame for the same prompt is at most `threshold`
+    bits away from the new one and younger than `ttl` seconds. At most
+    `max_entries` results are kept; the least recently used one is evicted first.
+    """
+    def __init__(self, max_entries=32, ttl=30.0, threshold=12, hash_size=16):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hash_size = hash_size
+        # (prompt, hash) -> (points, stored at)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def signature(self, frame):
+        return dhash(frame, self.hash_size)
+
+    def get(self, prompt, signature):
+        """
+        Returns the cached points for a similar frame, or None.
+        """
+        now = time.monotonic()
+        with self.lock:
+            best_key, best_distance = None, self.threshold + 1
+            for key, (_, stored_at) in list(self.entries.items()):
+                if now - stored_at > self.ttl:
+                    del self.entries[key]
+                    continue
+                if key[0] != prompt:
+                    continue
+                distance = bin(key[1] ^ signature).count("1")
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_key)
+            return list(self.entries[best_key][0])
+
+    def put(self, prompt, signature, points):
+        with self.lock:
+            self.entries[(prompt, signature)] = (list(points), time.monotonic())
+            self.entries.move_to_end((prompt, signature))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, prompt=None):
+        """
+        Forgets the results for one prompt, or everything when prompt is None.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if prompt is None or key[0] == prompt]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
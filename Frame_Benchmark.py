@@ -0,0 +1,156 @@
+# frame_benchmark.py
+
+import argparse
+import gc
+import json
+import resource
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from Frame_Ring import FrameRing
+
+RESOLUTIONS = {"720p": (720, 1280), "1080p": (1080, 1920)}
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class SyntheticCapture:
+    """
+    Stands in for cv2.VideoCapture: read() returns a fresh array, read(image)
+    fills the given buffer, as OpenCV does when the size matches.
+    """
+    def __init__(self, height, width):
+        self.pattern = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    def read(self, image=None):
+        if image is not None and image.shape == self.pattern.shape:
+            np.copyto(image, self.pattern)
+            return True, image
+        return True, self.pattern.copy()
+
+
+def _draw(frame):
+    cv2.circle(frame, (100, 100), 10, (0, 0, 255), -1)
+    cv2.putText(frame, "Press 's' to select object(s)", (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 2)
+
+
+def run_copying(cap, frames, detect_every, detect_hold):
+    """
+    The per-frame path before the ring buffer: a new frame per read, a copy for
+    the hand thread, an allocating cvtColor and a copy per detection.
+    """
+    detections = []
+    for i in range(frames):
+        _, frame = cap.read()
+        hand_frame = frame.copy()
+        rgb = cv2.cvtColor(hand_frame, cv2.COLOR_BGR2RGB)
+        if i % detect_every == 0:
+            detections.append((i + detect_hold, frame.copy()))
+        detections = [(until, held) for until, held in detections if until > i]
+        _draw(frame)
+        yield rgb
+
+
+def run_ring(cap, frames, detect_every, detect_hold, ring):
+    """
+    The same path through a FrameRing: stages retain the captured buffer, the
+    overlay is drawn on the reused canvas and cvtColor writes into a reused buffer.
+    """
+    rgb = None
+    detections = []
+    for i in range(frames):
+        source = ring.read(cap)
+        frame = ring.canvas(source)
+        hand_source = source.retain()
+        if rgb is None:
+            rgb = np.empty_like(hand_source.array)
+        cv2.cvtColor(hand_source.array, cv2.COLOR_BGR2RGB, dst=rgb)
+        hand_source.release()
+        if i % detect_every == 0:
+            detections.append((i + detect_hold, source.retain()))
+        for until, held in detections:
+            if until <= i:
+                held.release()
+        detections = [(until, held) for until, held in detections if until > i]
+        _draw(frame)
+        source.release()
+        yield rgb
+
+
+def measure(mode, height, width, frames, detect_every, detect_hold):
+    cap = SyntheticCapture(height, width)
+    ring = FrameRing()
+    if mode == "ring":
+        pipeline = lambda *args: run_ring(*args, ring)
+    else:
+        pipeline = run_copying
+
+    # Timing and page faults, without tracemalloc overhead.
+    gc.collect()
+    collections_before = sum(stat["collections"] for stat in gc.get_stats())
+    faults_before = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    frame_times = []
+    start = time.perf_counter()
+    for _ in pipeline(cap, frames, detect_every, detect_hold):
+        now = time.perf_counter()
+        frame_times.append(now - start)
+        start = now
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults_before
+    collections = sum(stat["collections"] for stat in gc.get_stats()) - collections_before
+
+    # Bytes newly allocated within a frame, from a shorter traced run.
+    traced_frames = min(frames, 50)
+    tracemalloc.start()
+    new_bytes = []
+    for _ in pipeline(cap, traced_frames, detect_every, detect_hold):
+        current, peak = tracemalloc.get_traced_memory()
+        new_bytes.append(peak - current)
+        tracemalloc.reset_peak()
+    tracemalloc.stop()
+
+    mean_s = sum(frame_times) / len(frame_times)
+    # The first frame sets up the ring's buffers; steady state is what matters.
+    allocated_mb = sum(new_bytes[1:]) / max(1, len(new_bytes) - 1) / 2**20
+    result = {
+        "mean_ms": round(1000 * mean_s, 3),
+        "p95_ms": round(1000 * _percentile(frame_times, 95), 3),
+        "minor_page_faults_per_frame": round(faults / frames, 1),
+        "allocated_mb_per_frame": round(allocated_mb, 2),
+        "allocation_mb_per_s": round(allocated_mb / mean_s, 1) if mean_s > 0 else 0.0,
+        "gc_collections": collections,
+        "frame_mb": round(height * width * 3 / 2**20, 2),
+    }
+    if mode == "ring":
+        result["ring"] = ring.stats()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-frame allocation cost of the AR client's frame path, "
+                                                 "with and without the FrameRing.")
+    parser.add_argument("--resolutions", nargs="+", default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--detect-every", type=int, default=30, help="Start a detection every N frames.")
+    parser.add_argument("--detect-hold", type=int, default=15, help="Frames a detection keeps its frame.")
+    parser.add_argument("--output", help="Write the JSON report to this file as well.")
+    args = parser.parse_args()
+
+    report = {}
+    for name in args.resolutions:
+        height, width = RESOLUTIONS[name]
+        report[name] = {mode: measure(mode, height, width, args.frames, args.detect_every, args.detect_hold)
+                        for mode in ("copy", "ring")}
+        copy, ring = report[name]["copy"], report[name]["ring"]
+        report[name]["speedup"] = round(copy["mean_ms"] / ring["mean_ms"], 2) if ring["mean_ms"] > 0 else None
+        print(f"[Frames] {name}: {json.dumps(report[name])}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
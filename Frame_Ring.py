@@ -0,0 +1,153 @@
+# frame_ring.py
+
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class FrameRef:
+    """
+    A reference-counted, read-only view of one captured frame. Stages that keep
+    a frame past the current call (hand tracking, detection) retain() it instead
+    of copying it and release() it when they are done; the buffer goes back to
+    the ring once the last holder has released it.
+    """
+    def __init__(self, ring, slot, array):
+        self.ring = ring
+        self.slot = slot
+        self.array = array.view()
+        self.array.flags.writeable = False
+
+    @classmethod
+    def detached(cls, array):
+        """
+        Wraps an array that does not belong to a ring; retain/release are no-ops.
+        """
+        return cls(None, None, array)
+
+    def retain(self):
+        if self.ring is not None:
+            self.ring._retain(self.slot)
+        return self
+
+    def release(self):
+        if self.ring is not None:
+            self.ring._release(self.slot)
+
+
+class FrameRing:
+    """
+    Preallocated capture buffers for one camera stream. read() decodes the next
+    frame straight into a free buffer (cv2.VideoCapture.read(image) reuses a
+    buffer of the right size) and hands it out as a FrameRef holding one
+    reference, so no frame is allocated per iteration. canvas() gives the
+    render stage a reused, writable copy to draw the overlay on, leaving the
+    shared pixels untouched for the stages still reading them.
+
+    When every buffer is still held the ring grows by one; `allocations` counts
+    every buffer ever created, so it stays flat in steady state.
+    """
+    def __init__(self, slots=6):
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.shape = None
+        self.dtype = None
+        # Bumped on every resize, so releases of slots from an older size are ignored.
+        self.generation = 0
+        self.buffers = []
+        self.counts = []
+        self.free = deque()
+        self.allocations = 0
+        self._canvas = None
+
+    def _reset(self, shape, dtype):
+        """
+        Starts over with buffers of a new frame size. Call with self.lock held.
+        Buffers still held elsewhere stay alive through their FrameRef views.
+        """
+        self.shape, self.dtype = shape, dtype
+        self.generation += 1
+        self.buffers, self.counts, self.free = [], [], deque()
+        for _ in range(self.slots):
+            self._grow()
+
+    def _grow(self):
+        self.buffers.append(np.empty(self.shape, self.dtype))
+        self.counts.append(0)
+        self.free.append(len(self.buffers) - 1)
+        self.allocations += 1
+
+    def acquire(self, shape, dtype=np.uint8):
+        """
+        Returns (slot, writable buffer) of a free buffer, already holding one reference.
+        """
+        with self.lock:
+            if self.shape != tuple(shape) or self.dtype != np.dtype(dtype):
+                self._reset(tuple(shape), np.dtype(dtype))
+            if not self.free:
+                self._grow()
+            index = self.free.popleft()
+            self.counts[index] = 1
+            return (self.generation, index), self.buffers[index]
+
+    def _retain(self, slot):
+        generation, index = slot
+        with self.lock:
+            if generation == self.generation:
+                self.counts[index] += 1
+
+    def _release(self, slot):
+        generation, index = slot
+        with self.lock:
+            if generation != self.generation or self.counts[index] == 0:
+                return
+            self.counts[index] -= 1
+            if self.counts[index] == 0:
+                self.free.append(index)
+
+    def wrap(self, frame):
+        """
+        Copies a frame that was decoded elsewhere into a free slot.
+        """
+        slot, buffer = self.acquire(frame.shape, frame.dtype)
+        np.copyto(buffer, frame)
+        return FrameRef(self, slot, buffer)
+
+    def read(self, cap):
+        """
+        Reads the next frame from cap into a free slot. Returns a FrameRef, or
+        None at the end of the stream.
+        """
+        if self.shape is None:
+            # The frame size is only known after the first read.
+            ret, frame = cap.read()
+            return self.wrap(frame) if ret else None
+
+        slot, buffer = self.acquire(self.shape, self.dtype)
+        ret, frame = cap.read(buffer)
+        if not ret:
+            self._release(slot)
+            return None
+        if not np.may_share_memory(frame, buffer):
+            # The stream changed size, so OpenCV allocated a new frame.
+            self._release(slot)
+            return self.wrap(frame)
+        return FrameRef(self, slot, buffer)
+
+    def canvas(self, ref):
+        """
+        Copies the frame into the reused render buffer and returns it for drawing.
+        """
+        if self._canvas is None or self._canvas.shape != ref.array.shape:
+            self._canvas = np.empty_like(ref.array)
+        np.copyto(self._canvas, ref.array)
+        return self._canvas
+
+    def stats(self):
+        with self.lock:
+            return {
+                "slots": len(self.buffers),
+                "in_use": sum(1 for count in self.counts if count),
+                "allocations": self.allocations,
+            }
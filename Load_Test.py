@@ -0,0 +1,184 @@
+# load_test.py
+
+import argparse
+import asyncio
+import json
+import mimetypes
+import os
+import time
+import httpx
+
+# --- Configuration ---
+BASE_URL = "http://127.0.0.1:8000"
+TRACE_PATH = "benchmark/load_trace.jsonl"
+# Endpoints each server serves: main_API.py ("main") and New_API.py ("stateful").
+SERVER_ENDPOINTS = {
+    "main": {"/inference/"},
+    "stateful": {"/verify", "/prompt"},
+}
+
+
+def load_trace(trace_path, server):
+    """
+    Reads a JSONL trace. Each line is one request:
+        {"endpoint": "/inference/", "text": ..., "image": path}
+        {"endpoint": "/verify", "object_id": ..., "image": path}
+        {"endpoint": "/prompt", "prompt": ..., "image": path}
+    Only entries for endpoints the target server serves are kept, see SERVER_ENDPOINTS.
+    /prompt entries are sent with the image_id obtained by verifying their image once.
+    Image bytes are read up front so disk I/O does not count against the server.
+    """
+    with open(trace_path) as f:
+        trace = [json.loads(line) for line in f if line.strip()]
+    trace = [entry for entry in trace if entry["endpoint"] in SERVER_ENDPOINTS[server]]
+    if not trace:
+        raise ValueError(f"{trace_path} has no requests for the {server} server "
+                         f"({', '.join(sorted(SERVER_ENDPOINTS[server]))}).")
+
+    images = {}
+    for entry in trace:
+        path = entry["image"]
+        if path not in images:
+            with open(path, "rb") as img:
+                images[path] = (os.path.basename(path), img.read(), mimetypes.guess_type(path)[0] or "image/jpeg")
+    return trace, images
+
+
+def check_route(endpoint, response):
+    """
+    Raises when the server has no such endpoint, which FastAPI answers with a bare
+    404 "Not Found". Other 404s (e.g. a failed /verify) are regular answers.
+    """
+    if response.status_code == 404 and response.headers.get("content-type", "").startswith("application/json") \
+            and response.json().get("detail") == "Not Found":
+        raise RuntimeError(f"The server at {response.url.copy_with(path='/')} does not serve {endpoint}; "
+                           f"is --server set to the right API?")
+
+
+async def resolve_image_ids(client, trace, images):
+    """
+    Verifies every image used by a /prompt entry once and returns {path: image_id}.
+    """
+    image_ids = {}
+    for entry in trace:
+        if entry["endpoint"] == "/prompt" and entry["image"] not in image_ids:
+            # Verification can legitimately answer "different" (404), so allow a few attempts.
+            for _ in range(5):
+                response = await client.post("/verify", data={"object_id": entry.get("object_id", "the object")},
+                                             files={"image": images[entry["image"]]})
+                check_route("/verify", response)
+                if response.status_code == 200:
+                    break
+            else:
+                raise RuntimeError(f"Could not verify {entry['image']} for /prompt: {response.text}")
+            image_ids[entry["image"]] = response.json()["image_id"]
+    return image_ids
+
+
+async def send(client, entry, images, image_ids):
+    endpoint = entry["endpoint"]
+    if endpoint == "/inference/":
+        return await client.post(endpoint, data={"text": entry["text"]}, files={"image": images[entry["image"]]})
+    if endpoint == "/verify":
+        return await client.post(endpoint, data={"object_id": entry["object_id"]}, files={"image": images[entry["image"]]})
+    if endpoint == "/prompt":
+        return await client.post(endpoint, data={"image_id": image_ids[entry["image"]], "prompt": entry["prompt"]})
+    raise ValueError(f"Unsupported endpoint in trace: {endpoint}")
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    """
+    samples: list of (endpoint, status, latency_seconds). Status 0 means a transport error.
+    """
+    def stats(latencies):
+        if not latencies:
+            return {}
+        return {
+            "p50_ms": round(1000 * _percentile(latencies, 50), 2),
+            "p90_ms": round(1000 * _percentile(latencies, 90), 2),
+            "p99_ms": round(1000 * _percentile(latencies, 99), 2),
+            "max_ms": round(1000 * max(latencies), 2),
+        }
+
+    statuses = {}
+    for _, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    endpoints = {}
+    for endpoint in sorted({s[0] for s in samples}):
+        latencies = [latency for e, status, latency in samples if e == endpoint and status == 200]
+        endpoints[endpoint] = {"ok": len(latencies), **stats(latencies)}
+
+    ok_latencies = [latency for _, status, latency in samples if status == 200]
+    return {
+        "requests": len(samples),
+        "ok": len(ok_latencies),
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency": stats(ok_latencies),
+        "endpoints": endpoints,
+    }
+
+
+async def run_load(base_url, trace_path, concurrency, total_requests, timeout, server="main"):
+    """
+    Closed-loop load: `concurrency` workers replay the trace round-robin until
+    `total_requests` have been sent.
+    """
+    trace, images = load_trace(trace_path, server)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        image_ids = await resolve_image_ids(client, trace, images)
+
+        samples = []
+        next_index = 0
+
+        async def worker():
+            nonlocal next_index
+            while next_index < total_requests:
+                entry = trace[next_index % len(trace)]
+                next_index += 1
+                start = time.perf_counter()
+                try:
+                    response = await send(client, entry, images, image_ids)
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = 0
+                else:
+                    check_route(entry["endpoint"], response)
+                samples.append((entry["endpoint"], status, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return summarize(samples, elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a request trace against the RoboBrain API at fixed concurrency.")
+    parser.add_argument("--url", default=BASE_URL, help="Server base URL.")
+    parser.add_argument("--trace", default=TRACE_PATH, help="JSONL trace of requests to replay.")
+    parser.add_argument("--server", choices=list(SERVER_ENDPOINTS), default="main",
+                        help="Target API: main (main_API.py, /inference/) or stateful (New_API.py, /verify and /prompt). "
+                             "Trace entries for other endpoints are skipped.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="Total number of requests to send.")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout in seconds.")
+    parser.add_argument("--output", help="Write the JSON report to this file as well.")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(args.url, args.trace, args.concurrency, args.requests, args.timeout, args.server))
+    report["server"] = args.server
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
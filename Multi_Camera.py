@@ -0,0 +1,205 @@
+# multi_camera.py
+
+import os
+import threading
+import time
+import cv2
+import requests
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from Frame_Ring import FrameRing
+from Robo_Handtracking import RealTimeARClient
+
+
+class BatchingDetector:
+    """
+    A detector shared by several RealTimeARClient instances. Detection requests
+    arriving within batch_window seconds of each other are coalesced into one
+    call to the server's /inference/batch/ endpoint over a single keep-alive
+    connection. A detection that gets no answer within timeout seconds fails
+    with a Timeout instead of blocking its stream forever.
+    """
+    def __init__(self, server_url, batch_window=0.05, max_batch=8, timeout=60.0):
+        self.batch_url = f"{server_url.rstrip('/')}/batch/"
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.session = requests.Session()
+
+        self.pending = []
+        self.cond = threading.Condition()
+        self.running = True
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self.dispatcher.start()
+
+    def __call__(self, frame, prompt):
+        """
+        [Blocking] Queues one frame for detection and returns its points.
+        """
+        ok, encoded = cv2.imencode(".jpg", frame)
+        if not ok:
+            raise ValueError("Could not encode frame as JPEG.")
+
+        future = Future()
+        with self.cond:
+            if not self.running:
+                raise requests.exceptions.ConnectionError("Detector closed.")
+            self.pending.append((encoded.tobytes(), prompt, future))
+            self.cond.notify()
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise requests.exceptions.Timeout(f"No detection result within {self.timeout}s.")
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    return
+            # Give the other streams a moment to join this batch.
+            time.sleep(self.batch_window)
+            with self.cond:
+                batch = self.pending[:self.max_batch]
+                self.pending = self.pending[self.max_batch:]
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        files = [('images', (f"frame_{i}.jpg", data, 'image/jpeg')) for i, (data, _, _) in enumerate(batch)]
+        payload = {'texts': [prompt for _, prompt, _ in batch]}
+
+        try:
+            print(f"[Detector] Sending batch of {len(batch)} frame(s) to server.")
+            response = self.session.post(self.batch_url, files=files, data=payload, timeout=self.timeout)
+            response.raise_for_status()
+            results = response.json()["results"]
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(RealTimeARClient.parse_points(result.get('answer', '')))
+            if len(results) < len(batch):
+                raise ValueError(f"Server answered {len(results)} of {len(batch)} frames.")
+        except Exception as e:
+            # Malformed or short answers must not kill the dispatcher or leave a stream waiting.
+            print(f"[Detector] Batch failed: {e!r}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            for _, _, future in self.pending:
+                future.set_exception(requests.exceptions.ConnectionError("Detector closed."))
+            self.pending = []
+            self.cond.notify_all()
+        self.session.close()
+
+
+class MultiStreamRunner:
+    """
+    Runs several camera streams in one process. All streams share one tracker
+    thread pool and one BatchingDetector; each stream gets its own window.
+
+    Controls:
+    - '1'..'9': Select which stream receives keyboard input.
+    - Every other key goes to the selected stream ('s', 'p', 'q' as usual).
+    """
+    def __init__(self, server_url, droidcam_urls, initial_prompt="Point to the keyboard keys", max_workers=None,
+                 detector=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+        self.detector = detector or BatchingDetector(server_url)
+        self.clients = [
+            RealTimeARClient(server_url, url, initial_prompt=initial_prompt, executor=self.executor,
+                             detector=self.detector, window_name=f"Camera {i + 1}: {url}")
+            for i, url in enumerate(droidcam_urls)
+        ]
+        # One FrameRing per stream; latest_frames holds each stream's newest unprocessed FrameRef.
+        self.rings = [FrameRing() for _ in self.clients]
+        self.latest_frames = [None] * len(self.clients)
+        self.frames_lock = threading.Lock()
+        self.shown_frames = [None] * len(self.clients)
+        self.active = 0
+        self.stop_event = threading.Event()
+
+    def _read_frames(self, index, cap):
+        """
+        [Threaded] Keeps only the newest frame of one stream so a slow camera
+        never stalls the others.
+        """
+        while not self.stop_event.is_set():
+            source = self.rings[index].read(cap)
+            if source is None:
+                print(f"Stream {index + 1} ended.")
+                break
+            with self.frames_lock:
+                skipped, self.latest_frames[index] = self.latest_frames[index], source
+            # A frame the main loop never picked up goes straight back to the ring.
+            if skipped is not None:
+                skipped.release()
+
+    def run(self):
+        """
+        Main loop: steps every stream that has a new frame, then polls the keyboard once.
+        """
+        caps = [client.open() for client in self.clients]
+        readers = []
+        for i, cap in enumerate(caps):
+            if cap is not None:
+                reader = threading.Thread(target=self._read_frames, args=(i, cap), daemon=True)
+                reader.start()
+                readers.append(reader)
+
+        live = {i for i, cap in enumerate(caps) if cap is not None}
+        while live and any(reader.is_alive() for reader in readers):
+            for i in list(live):
+                with self.frames_lock:
+                    source, self.latest_frames[i] = self.latest_frames[i], None
+                if source is None:
+                    continue
+
+                client = self.clients[i]
+                frame = self.rings[i].canvas(source)
+                keep_running = client.step(frame, source=source)
+                source.release()
+                if not keep_running:
+                    live.discard(i)
+                    cv2.destroyWindow(client.window_name)
+                    continue
+                cv2.imshow(client.window_name, frame)
+                self.shown_frames[i] = frame
+
+            key = cv2.waitKey(1) & 0xFF
+            if ord('1') <= key <= ord('9') and key - ord('1') < len(self.clients):
+                self.active = key - ord('1')
+                print(f"Keyboard now controls stream {self.active + 1}.")
+            elif self.active in live:
+                last_frame = self.shown_frames[self.active]
+                if last_frame is not None and not self.clients[self.active]._handle_key_press(key, last_frame):
+                    self.clients[self.active].stop()
+
+        self.stop_event.set()
+        for reader in readers:
+            reader.join(timeout=1)
+        for client, cap in zip(self.clients, caps):
+            if cap is not None:
+                client.close(cap)
+        self.detector.close()
+        self.executor.shutdown()
+        cv2.destroyAllWindows()
+
+
+if __name__ == "__main__":
+    SERVER_URL = "https://balanced-vaguely-mastodon.ngrok-free.app/inference/"
+    DROIDCAM_URLS = [
+        "http://192.168.133.7:4747/video",
+        "http://192.168.133.8:4747/video",
+    ]
+
+    # ROBOBRAIN_TRANSPORT=ws shares one /ws connection between the streams instead of batching over HTTP.
+    detector = None
+    if os.environ.get("ROBOBRAIN_TRANSPORT", "http") == "ws":
+        from WebSocket_Detector import WebSocketDetector
+        detector = WebSocketDetector(SERVER_URL)
+
+    runner = MultiStreamRunner(SERVER_URL, DROIDCAM_URLS, detector=detector)
+    runner.run()
@@ -2,35 +2,100 @@
 
 import os
 import shutil
+import cv2
 import uvicorn
+from contextlib import asynccontextmanager
 import uuid
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Response
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pyngrok import ngrok, conf
-from typing import Union
+from typing import Optional, Union
 
-# Import your custom class from the inference.py file
-from inference import SimpleInference
+from annotation import ANNOTATE_MODES, AnnotationWorker, annotate_result
+from memory_guard import GPUMemoryExhausted
+from model_loader import ModelLoader
+from telemetry import configure_logging, logger, metrics_payload, stage_timer, track_requests
 
 # --- Global Settings & Setup ---
 VERIFIED_DIR = "verified_images"
 os.makedirs(VERIFIED_DIR, exist_ok=True)
 
+# --- Model Loading ---
+# The model is loaded and warmed up in the background once the server has bound
+# its port. Until then the inference endpoints answer 503 and /readyz reports progress.
+# SimpleInference by default; set ROBOBRAIN_BACKEND=fake to run without a GPU.
+loader = ModelLoader("BAAI/RoboBrain2.0-3B")
+
+# Annotated images are only written to disk on request, by a background worker
+# that keeps at most ROBOBRAIN_ANNOTATION_MAX_FILES of them.
+annotation_worker = AnnotationWorker(
+    output_dir=os.environ.get("ROBOBRAIN_ANNOTATION_DIR", "result"),
+    max_files=int(os.environ.get("ROBOBRAIN_ANNOTATION_MAX_FILES", "200"))
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loader.start()
+    yield
+
+def read_verified_image(image_path):
+    """
+    Decodes a stored image for annotation, or raises 422 when the file cannot be decoded.
+    """
+    image = cv2.imread(image_path)
+    if image is None:
+        raise HTTPException(status_code=422, detail=f"Stored image '{os.path.basename(image_path)}' cannot be decoded. Please verify it again.")
+    return image
+
+def get_model():
+    """
+    Returns the loaded model, or raises 503 while it is still loading or warming up.
+    """
+    if not loader.ready:
+        raise HTTPException(status_code=503, detail=f"Model is not ready yet (status: {loader.status}).", headers={"Retry-After": "5"})
+    return loader.model
+
 app = FastAPI(
     title="RoboBrain Stateful API",
     description="A two-step API: 1. Verify an image and get an ID. 2. Use the ID to send multiple prompts.",
-    version="3.0.0"
+    version="3.0.0",
+    lifespan=lifespan
 )
-
-# --- Model Loading ---
-print("Initializing server and loading model...")
-model = SimpleInference("BAAI/RoboBrain2.0-3B")
-print("Model loaded. Server is ready.")
+app.middleware("http")(track_requests)
 
 # --- API Endpoints ---
 @app.get("/")
 def root():
     return {"message": "Welcome to the Stateful RoboBrain API. Use /verify and /prompt endpoints."}
 
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus scrape endpoint: stage latencies, tokens/s, GPU memory and in-flight requests.
+    """
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/healthz")
+def healthz():
+    """
+    Liveness probe: the process is up and serving HTTP.
+    """
+    return {"status": "alive"}
+
+@app.get("/readyz")
+def readyz():
+    """
+    Readiness probe: 200 once the model is loaded and warmed up, 503 before that.
+    """
+    body = {"status": loader.status}
+    if loader.error:
+        body["error"] = loader.error
+    if hasattr(loader.model, "replica_status"):
+        body["replicas"] = loader.model.replica_status()
+    return JSONResponse(status_code=200 if loader.ready else 503, content=body)
+
 @app.post("/verify")
 async def verify_image_and_get_id(
     object_id: str = Form(..., description="A description of the object to verify in the image."),
@@ -40,16 +105,20 @@ async def verify_image_and_get_id(
     Verifies if an object is in an image. If successful, saves the image
     and returns a unique image_id for use with the /prompt endpoint.
     """
-    # Use a temporary file for initial processing
-    temp_upload_path = os.path.join(VERIFIED_DIR, f"temp_{image.filename}")
+    model = get_model()
+
+    # Use a temporary file for initial processing; uploads run concurrently,
+    # so the name must not depend on the client's filename alone.
+    temp_upload_path = os.path.join(VERIFIED_DIR, f"temp_{uuid.uuid4()}_{image.filename}")
     
     try:
-        with open(temp_upload_path, "wb") as buffer:
+        with stage_timer("upload_read"), open(temp_upload_path, "wb") as buffer:
             shutil.copyfileobj(image.file, buffer)
 
         # --- Run Verification ---
-        print(f"Verifying object '{object_id}' in image '{image.filename}'...")
-        verification_result = model.inference(
+        logger.debug("Verifying object '%s' in image '%s'...", object_id, image.filename)
+        verification_result = await run_in_threadpool(
+            model.inference,
             text=object_id,
             image=os.path.abspath(temp_upload_path),
             task="verify",
@@ -68,13 +137,13 @@ async def verify_image_and_get_id(
             # Move the temp file to its permanent location
             os.rename(temp_upload_path, permanent_path)
             
-            print(f"Verification successful. Image saved as {image_id}{file_extension}")
+            logger.info("Verification successful. Image saved as %s%s", image_id, file_extension)
             return {"status": "verified", "image_id": image_id}
         else:
             # --- Verification Failed ---
             # Clean up the temporary file and return the error
             os.remove(temp_upload_path)
-            print("Verification failed. Sending comedic error.")
+            logger.info("Verification failed. Sending comedic error.")
             raise HTTPException(
                 status_code=404, 
                 detail="YOU DARE LIE TO ROBOBRAIN????"
@@ -86,18 +155,34 @@ async def verify_image_and_get_id(
             os.remove(temp_upload_path)
         if isinstance(e, HTTPException):
             raise e
+        if isinstance(e, GPUMemoryExhausted):
+            logger.warning("Rejected request under GPU memory pressure: %s", e)
+            raise HTTPException(status_code=503, detail=f"GPU memory is exhausted, please retry shortly: {e}", headers={"Retry-After": "5"})
         raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
 
 
 @app.post("/prompt")
 async def run_prompt_on_verified_image(
     image_id: str = Form(..., description="The unique ID of the previously verified image."),
-    prompt: str = Form(..., description="The pointing instruction for the model.")
+    prompt: str = Form(..., description="The pointing instruction for the model."),
+    enable_thinking: bool = Form(False, description="Let the model reason before answering."),
+    thinking_budget: Optional[int] = Form(None, description="Maximum reasoning tokens before the answer is forced."),
+    latency_sla: Optional[float] = Form(None, description="Target generate time in seconds; picks the thinking budget when none is given."),
+    annotate: str = Form("coords", description="'none', 'coords' (parsed points) or 'image' (points plus a base64 JPEG overlay)."),
+    save_annotation: bool = Form(False, description="Also write the annotated image to the result directory in the background."),
+    do_sample: bool = Form(True, description="False decodes greedily; the answer is then reproducible and cached across restarts.")
 ):
     """
     Runs a pointing task on an image that has already been verified,
-    using its unique image_id.
+    using its unique image_id. When ROBOBRAIN_FEATURE_CACHE_DIR is set, the
+    image's preprocessed pixels and visual embeddings are cached on disk by
+    the model (see FeatureCache), so follow-up prompts skip that work, even
+    after a server restart.
     """
+    if annotate not in ANNOTATE_MODES:
+        raise HTTPException(status_code=422, detail=f"annotate must be one of {ANNOTATE_MODES}.")
+    model = get_model()
+
     # Find the image file by its ID, checking common extensions
     image_path = None
     for ext in ['.png', '.jpg', '.jpeg', '.webp']:
@@ -111,25 +196,39 @@ async def run_prompt_on_verified_image(
 
     try:
         # --- Run Pointing Task ---
-        print(f"Running prompt '{prompt}' on image_id '{image_id}'...")
-        pointing_result = model.inference(
+        logger.debug("Running prompt '%s' on image_id '%s'...", prompt, image_id)
+        pointing_result = await run_in_threadpool(
+            model.inference,
             text=prompt,
             image=os.path.abspath(image_path),
             task="pointing",
-            plot=True,
-            enable_thinking=False,
-            do_sample=True
+            plot=False,
+            enable_thinking=enable_thinking,
+            do_sample=do_sample,
+            thinking_budget=thinking_budget,
+            latency_sla_s=latency_sla,
+            # Verified images are prompted again and again; their features are worth keeping.
+            cache_features=True
+        )
+        logger.debug("Pointing task complete.")
+        return await run_in_threadpool(
+            annotate_result, pointing_result, "pointing", annotate, lambda: read_verified_image(image_path),
+            os.path.basename(image_path), annotation_worker, save_annotation
         )
-        print("Pointing task complete.")
-        return pointing_result
 
+    except HTTPException:
+        raise
+    except GPUMemoryExhausted as e:
+        logger.warning("Rejected request under GPU memory pressure: %s", e)
+        raise HTTPException(status_code=503, detail=f"GPU memory is exhausted, please retry shortly: {e}", headers={"Retry-After": "5"})
     except Exception as e:
-        print(f"An error occurred during the pointing task: {e}")
+        logger.error("An error occurred during the pointing task: %s", e)
         raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
 
 
 # --- Main execution block to start the server and ngrok tunnel ---
 if __name__ == "__main__":
+    configure_logging()
     NGROK_AUTHTOKEN = os.environ.get("NGROK_AUTHTOKEN")
     if NGROK_AUTHTOKEN is None:
         NGROK_AUTHTOKEN = input("Please enter your ngrok authtoken: ")
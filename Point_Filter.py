@@ -0,0 +1,94 @@
+# point_filter.py
+
+import numpy as np
+
+
+class PointKalmanFilter:
+    """
+    Constant-velocity Kalman filter for all tracked dots at once. The state of
+    every point is (x, y, vx, vy) in pixels and pixels per second; the arrays
+    hold one row per point, so predicting or correcting N points is a handful
+    of batched matrix products instead of N Python loops.
+
+    predict() runs every frame and is cheap; update() takes the positions
+    reported by the visual trackers whenever they have run. uncertainty() is
+    the standard deviation, in pixels, of each predicted position and tells
+    the caller when the prediction can no longer be trusted on its own.
+
+    acceleration_std models how abruptly dots may change speed (hand-held
+    camera shake); measurement_std is the jitter of the tracker centers.
+    """
+    def __init__(self, acceleration_std=400.0, measurement_std=2.0, initial_velocity_std=100.0):
+        self.acceleration_var = acceleration_std ** 2
+        self.measurement_var = measurement_std ** 2
+        self.initial_velocity_var = initial_velocity_std ** 2
+        self.state = np.zeros((0, 4))
+        self.covariance = np.zeros((0, 4, 4))
+
+    def __len__(self):
+        return len(self.state)
+
+    def reset(self, points):
+        """
+        Starts tracking the given [(x, y), ...] at rest, replacing all previous points.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.state = np.zeros((len(points), 4))
+        self.state[:, :2] = points
+        self.covariance = np.zeros((len(points), 4, 4))
+        self.covariance[:, 0, 0] = self.covariance[:, 1, 1] = self.measurement_var
+        self.covariance[:, 2, 2] = self.covariance[:, 3, 3] = self.initial_velocity_var
+
+    def predict(self, dt):
+        """
+        Advances every point by dt seconds and returns the predicted positions as an (N, 2) array.
+        """
+        transition = np.eye(4)
+        transition[0, 2] = transition[1, 3] = dt
+        # Piecewise-constant white acceleration noise.
+        q = self.acceleration_var
+        noise = np.zeros((4, 4))
+        noise[0, 0] = noise[1, 1] = q * dt ** 4 / 4
+        noise[0, 2] = noise[2, 0] = noise[1, 3] = noise[3, 1] = q * dt ** 3 / 2
+        noise[2, 2] = noise[3, 3] = q * dt ** 2
+
+        self.state = self.state @ transition.T
+        self.covariance = transition @ self.covariance @ transition.T + noise
+        return self.positions()
+
+    def update(self, measurements, mask=None):
+        """
+        Corrects the points with measured positions, an (N, 2) array. Rows where
+        mask is False are left as predicted.
+        """
+        measurements = np.asarray(measurements, dtype=np.float64).reshape(-1, 2)
+        rows = np.arange(len(self.state)) if mask is None else np.flatnonzero(mask)
+        if len(rows) == 0:
+            return self.positions()
+        measurements = measurements[rows]
+
+        state, covariance = self.state[rows], self.covariance[rows]
+        innovation = measurements - state[:, :2]
+        # Only positions are observed, so H picks the first two state components.
+        innovation_cov = covariance[:, :2, :2] + self.measurement_var * np.eye(2)
+        gain = covariance[:, :, :2] @ np.linalg.inv(innovation_cov)
+        self.state[rows] = state + (gain @ innovation[:, :, None])[:, :, 0]
+        self.covariance[rows] = covariance - gain @ covariance[:, :2, :]
+        return self.positions()
+
+    def keep(self, mask):
+        """
+        Drops the points where mask is False, e.g. lost trackers or popped dots.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        self.state = self.state[mask]
+        self.covariance = self.covariance[mask]
+
+    def positions(self):
+        return self.state[:, :2].copy()
+
+    def uncertainty(self):
+        """
+        Standard deviation of each position estimate in pixels, along its worse axis.
+        """
+        return np.sqrt(np.maximum(self.covariance[:, 0, 0], self.covariance[:, 1, 1]))
@@ -0,0 +1,358 @@
+# replay_harness.py
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import cv2
+import numpy as np
+
+from Frame_Ring import FrameRing
+from Robo_Handtracking import RealTimeARClient
+
+
+class RecordingCapture:
+    """
+    Wraps a cv2.VideoCapture and writes every frame it returns to
+    <session_dir>/frames, with its timestamp, in frames.jsonl. read(image)
+    passes the destination buffer on, as FrameRing expects.
+    """
+    def __init__(self, cap, session_dir):
+        self.cap = cap
+        self.frames_dir = os.path.join(session_dir, "frames")
+        os.makedirs(self.frames_dir, exist_ok=True)
+        self.log = open(os.path.join(session_dir, "frames.jsonl"), "w")
+        self.index = -1
+        self.start_time = time.perf_counter()
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self, image=None):
+        ret, frame = self.cap.read(image) if image is not None else self.cap.read()
+        if ret:
+            self.index += 1
+            # PNG is lossless, so the replayed pixels match what the client saw.
+            cv2.imwrite(os.path.join(self.frames_dir, f"{self.index:06d}.png"), frame)
+            self.log.write(json.dumps({"index": self.index, "t": time.perf_counter() - self.start_time}) + "\n")
+        return ret, frame
+
+    def record_key(self, key):
+        self.log.write(json.dumps({"index": self.index, "key": key}) + "\n")
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def release(self):
+        self.log.close()
+        self.cap.release()
+
+
+class ReplayCapture:
+    """
+    A cv2.VideoCapture-compatible reader for a recorded session. With
+    realtime=True frames are paced by their recorded timestamps; otherwise
+    they are returned as fast as the client asks for them. Like
+    cv2.VideoCapture, read(image) fills the given buffer when its size matches.
+    """
+    def __init__(self, session_dir, realtime=False):
+        self.frames_dir = os.path.join(session_dir, "frames")
+        self.realtime = realtime
+        self.timestamps = []
+        self.keys = {}
+        with open(os.path.join(session_dir, "frames.jsonl")) as f:
+            for line in f:
+                entry = json.loads(line)
+                if "key" in entry:
+                    self.keys.setdefault(entry["index"], []).append(entry["key"])
+                else:
+                    self.timestamps.append(entry["t"])
+        self.index = -1
+        self.start_time = None
+
+    def isOpened(self):
+        return bool(self.timestamps)
+
+    def read(self, image=None):
+        if self.index + 1 >= len(self.timestamps):
+            return False, None
+        self.index += 1
+
+        if self.realtime:
+            if self.start_time is None:
+                self.start_time = time.perf_counter() - self.timestamps[self.index]
+            delay = self.timestamps[self.index] - (time.perf_counter() - self.start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+        frame = cv2.imread(os.path.join(self.frames_dir, f"{self.index:06d}.png"))
+        if frame is None:
+            return False, None
+        if image is not None and image.shape == frame.shape and image.dtype == frame.dtype:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.timestamps))
+        return 0.0
+
+    def release(self):
+        pass
+
+
+class RecordingDetector:
+    """
+    Wraps the client's detector and appends every server response, with its
+    round-trip latency, to detections.jsonl.
+    """
+    def __init__(self, detector, session_dir):
+        self.detector = detector
+        self.log_path = os.path.join(session_dir, "detections.jsonl")
+        self.lock = threading.Lock()
+        open(self.log_path, "w").close()
+
+    def __call__(self, frame, prompt):
+        start = time.perf_counter()
+        points = self.detector(frame, prompt)
+        entry = {"prompt": prompt, "points": points, "latency": time.perf_counter() - start}
+        with self.lock:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        return points
+
+
+class ReplayDetector:
+    """
+    Stands in for the HTTP detector: returns the recorded responses in order.
+    With realtime=True it also waits for the recorded server latency.
+    """
+    def __init__(self, session_dir, realtime=False):
+        self.realtime = realtime
+        with open(os.path.join(session_dir, "detections.jsonl")) as f:
+            self.responses = [json.loads(line) for line in f]
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, frame, prompt):
+        with self.lock:
+            if self.next_index >= len(self.responses):
+                print("[Replay] No recorded response left; returning no points.")
+                return []
+            response = self.responses[self.next_index]
+            self.next_index += 1
+
+        if response["prompt"] != prompt:
+            print(f"[Replay] Prompt mismatch: recorded '{response['prompt']}', got '{prompt}'.")
+        if self.realtime:
+            time.sleep(response["latency"])
+        return [tuple(point) for point in response["points"]]
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(stage_times, frame_count, elapsed, trace_digest, tracker_runs=0):
+    """
+    Builds the benchmark report: per-stage latency in milliseconds and end-to-end FPS.
+    """
+    stages = {}
+    for stage, samples in sorted(stage_times.items()):
+        if not samples:
+            continue
+        stages[stage] = {
+            "count": len(samples),
+            "mean_ms": round(1000 * sum(samples) / len(samples), 3),
+            "p50_ms": round(1000 * _percentile(samples, 50), 3),
+            "p95_ms": round(1000 * _percentile(samples, 95), 3),
+            "max_ms": round(1000 * max(samples), 3),
+        }
+    return {
+        "frames": frame_count,
+        "elapsed_s": round(elapsed, 3),
+        "fps": round(frame_count / elapsed, 2) if elapsed > 0 else 0.0,
+        "stages": stages,
+        # Frames on which the CSRT trackers ran; the others used the Kalman prediction only.
+        "tracker_runs": tracker_runs,
+        # Hash of the dot positions on every frame; it changes only when tracking behaviour does.
+        "trace_digest": trace_digest,
+    }
+
+
+def record(server_url, droidcam_url, session_dir, prompt):
+    """
+    Runs the client live against the camera and server, saving frames, key
+    presses and detection responses to session_dir.
+    """
+    os.makedirs(session_dir, exist_ok=True)
+    client = RealTimeARClient(server_url, droidcam_url, initial_prompt=prompt)
+    client.detector = RecordingDetector(client.detector, session_dir)
+    client.capture_factory = lambda url: RecordingCapture(cv2.VideoCapture(url), session_dir)
+
+    with open(os.path.join(session_dir, "session.json"), "w") as f:
+        json.dump({"droidcam_url": droidcam_url, "server_url": server_url, "prompt": prompt}, f, indent=2)
+
+    cap = client.open()
+    if cap is None:
+        return
+
+    # As in RealTimeARClient.run: the other stages get the clean captured frame, the HUD goes on the canvas.
+    ring = FrameRing()
+    while True:
+        source = ring.read(cap)
+        if source is None: break
+
+        frame = ring.canvas(source)
+        keep_running = client.step(frame, source=source)
+        if keep_running:
+            cv2.imshow(client.window_name, frame)
+
+            key = cv2.waitKey(1) & 0xFF
+            if key != 255:
+                cap.record_key(key)
+            keep_running = client._handle_key_press(key, frame)
+        source.release()
+        if not keep_running:
+            break
+
+    client.close(cap)
+    cv2.destroyAllWindows()
+    print(f"Session recorded to {session_dir}")
+
+
+def compare_traces(reference, candidate):
+    """
+    How far the dots of a candidate run stray from a reference run of the same
+    session, e.g. reduced-rate tracking against trackers on every frame. Frames
+    where the two runs show a different number of dots are counted separately.
+    """
+    errors = []
+    mismatched = 0
+    for ref_dots, dots in zip(reference, candidate):
+        if len(ref_dots) != len(dots):
+            mismatched += 1
+            continue
+        errors.extend(((x - rx) ** 2 + (y - ry) ** 2) ** 0.5 for (rx, ry), (x, y) in zip(ref_dots, dots))
+    if not errors:
+        return {"compared_dots": 0, "mismatched_frames": mismatched}
+    return {
+        "compared_dots": len(errors),
+        "mismatched_frames": mismatched,
+        "mean_error_px": round(sum(errors) / len(errors), 2),
+        "p95_error_px": round(_percentile(errors, 95), 2),
+        "max_error_px": round(max(errors), 2),
+    }
+
+
+def replay(session_dir, realtime=False, show=False, tracker_interval=None, uncertainty_threshold=None, trace=None):
+    """
+    Feeds a recorded session back through the client and returns the benchmark report.
+    At max speed (realtime=False) hand inference and detection run inline, so the
+    run is deterministic. tracker_interval and uncertainty_threshold override the
+    client's defaults; when trace is a list, the dot positions of every frame are
+    appended to it.
+    """
+    with open(os.path.join(session_dir, "session.json")) as f:
+        session = json.load(f)
+
+    client = RealTimeARClient(session["server_url"], session["droidcam_url"], initial_prompt=session["prompt"])
+    if tracker_interval is not None:
+        client.tracker_interval = tracker_interval
+    if uncertainty_threshold is not None:
+        client.uncertainty_threshold = uncertainty_threshold
+    client.detector = ReplayDetector(session_dir, realtime=realtime)
+    client.capture_factory = lambda url: ReplayCapture(session_dir, realtime=realtime)
+    client.synchronous = not realtime
+    client.stage_times = {}
+
+    cap = client.open()
+    if cap is None:
+        print(f"Error: No frames recorded in {session_dir}")
+        return None
+
+    # The same frame path as RealTimeARClient.run: captured frames live in a ring and are
+    # shared with the other stages, the overlay is drawn on the ring's canvas.
+    ring = FrameRing()
+    digest = hashlib.sha256()
+    frame_count = 0
+    start = time.perf_counter()
+    while True:
+        capture_start = time.perf_counter()
+        source = ring.read(cap)
+        if source is None: break
+        client._record_stage("capture", capture_start)
+
+        frame_start = time.perf_counter()
+        frame = ring.canvas(source)
+        if not client.step(frame, cap.timestamps[cap.index], source=source):
+            source.release()
+            break
+        if show:
+            cv2.imshow(client.window_name, frame)
+            cv2.waitKey(1)
+
+        keep_running = True
+        for key in cap.keys.get(cap.index, []):
+            keep_running = client._handle_key_press(key, frame) and keep_running
+        source.release()
+        client._record_stage("end_to_end", frame_start)
+
+        digest.update(repr(client.state.dot_positions).encode())
+        if trace is not None:
+            trace.append(client.state.dot_positions)
+        frame_count += 1
+        if not keep_running:
+            break
+    elapsed = time.perf_counter() - start
+
+    client.close(cap)
+    if show:
+        cv2.destroyAllWindows()
+    return summarize(client.stage_times, frame_count, elapsed, digest.hexdigest(), client.tracker_runs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record or replay a RealTimeARClient session.")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    record_parser = subparsers.add_parser("record", help="Capture frames and server responses from a live session.")
+    record_parser.add_argument("session_dir")
+    record_parser.add_argument("--server-url", default="https://balanced-vaguely-mastodon.ngrok-free.app/inference/")
+    record_parser.add_argument("--droidcam-url", default="http://192.168.133.7:4747/video")
+    record_parser.add_argument("--prompt", default="Point to the keyboard keys")
+
+    replay_parser = subparsers.add_parser("replay", help="Replay a recorded session and report per-stage latency.")
+    replay_parser.add_argument("session_dir")
+    replay_parser.add_argument("--realtime", action="store_true", help="Pace frames and responses as recorded.")
+    replay_parser.add_argument("--show", action="store_true", help="Display the rendered frames.")
+    replay_parser.add_argument("--output", help="Write the JSON report to this file as well.")
+    replay_parser.add_argument("--tracker-interval", type=int, help="Run the trackers every N frames.")
+    replay_parser.add_argument("--uncertainty-threshold", type=float,
+                               help="Also run the trackers when a dot's predicted position is this uncertain (px).")
+    replay_parser.add_argument("--compare-full-rate", action="store_true",
+                               help="Replay again with trackers on every frame and report the dot position error.")
+
+    args = parser.parse_args()
+    if args.mode == "record":
+        record(args.server_url, args.droidcam_url, args.session_dir, args.prompt)
+    else:
+        trace = [] if args.compare_full_rate else None
+        report = replay(args.session_dir, realtime=args.realtime, show=args.show,
+                        tracker_interval=args.tracker_interval, uncertainty_threshold=args.uncertainty_threshold,
+                        trace=trace)
+        if report is not None and args.compare_full_rate:
+            reference = []
+            full_rate = replay(args.session_dir, realtime=args.realtime, tracker_interval=1, trace=reference)
+            report["full_rate"] = {"fps": full_rate["fps"], "tracker_runs": full_rate["tracker_runs"],
+                                   **compare_traces(reference, trace)}
+        if report is not None:
+            print(json.dumps(report, indent=2))
+            if args.output:
+                with open(args.output, "w") as f:
+                    json.dump(report, f, indent=2)
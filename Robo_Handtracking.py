@@ -2,63 +2,314 @@ import requests
 import cv2
 import os
 import re
+import json
+import queue
 import threading
 import time
+import dataclasses
 import mediapipe as handtrack
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Detection_Cache import DetectionCache
+from Frame_Ring import FrameRef, FrameRing
+from Point_Filter import PointKalmanFilter
+
+
+@dataclasses.dataclass(frozen=True)
+class ClientState:
+    """
+    Immutable snapshot of the client state. A new snapshot is published by the
+    frame loop after every change, so readers never need a lock.
+    """
+    prompt: str
+    tracking_active: bool = False
+    is_detecting: bool = False
+    is_typing_prompt: bool = False
+    typed_prompt: str = ""
+    redetection_trigger_time: float = None
+    dot_positions: tuple = ()
+    running: bool = False
+
 
 class RealTimeARClient:
     """
     A class to manage the real-time AR tracking client, integrated with
     MediaPipe for hand-based interaction, with performance optimizations.
+
+    The client can be driven from other threads through set_prompt(),
+    trigger_detection() and stop(), or over a local HTTP control socket
+    when control_port is given. Several clients can share one tracker
+    executor and one detector (see Multi_Camera.py). With a detection_cache
+    (see Detection_Cache.py), re-detecting an unchanged scene reuses the
+    previous points; press 'S' (or POST /detect {"force": true}) to bypass it.
+
+    Dots are predicted every frame by a Kalman filter (see Point_Filter.py).
+    The CSRT trackers only run every tracker_interval frames, or sooner when a
+    prediction's uncertainty exceeds uncertainty_threshold pixels, and their
+    measurements correct the filter. tracker_interval=1 runs them on every frame.
+
+    run() captures into a FrameRing: the hand and detection threads share the
+    clean camera frame through reference-counted read-only views, while the
+    overlay is drawn on a reused canvas, so no frame is copied or allocated
+    per iteration.
     """
-    def __init__(self, server_url, droidcam_url):
+    def __init__(self, server_url, droidcam_url, initial_prompt="Point to the keyboard keys", control_port=None,
+                 executor=None, detector=None, window_name="Real-time AR Tracking", detection_cache=None,
+                 tracker_interval=3, uncertainty_threshold=8.0):
         # --- Configuration ---
         self.server_url = server_url
         self.droidcam_url = droidcam_url
-        self.prompt = "Point to the keyboard keys"
+        self.control_port = control_port
+        self.window_name = window_name
         self.dot_radius = 10
         self.dot_color = (0, 0, 255)
         self.pop_effects = []
+        self.tracker_interval = tracker_interval
+        self.uncertainty_threshold = uncertainty_threshold
 
         # --- State Variables ---
+        # Only the frame loop writes these; everyone else reads self.state
+        # or posts to self.commands.
+        self.state = ClientState(prompt=initial_prompt)
+        self.commands = queue.Queue()
         self.trackers = []
-        self.tracking_active = False
-        self.is_detecting = False
-        self.redetection_trigger_time = None
-        self.is_typing_prompt = False
-        self.typed_prompt = ""
+        # One filter row per tracker, in the same order.
+        self.point_filter = PointKalmanFilter()
+        self._last_frame_time = None
+        self._frames_since_tracker_update = 0
+        self.tracker_runs = 0
         self.latest_hand_results = None
-        self.lock = threading.Lock()
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=10)
+        # detector(frame, prompt) -> [(x, y), ...]; defaults to one HTTP call per frame.
+        self.detector = detector or self._request_points
+        self.detection_cache = detection_cache
+        self._control_server = None
+        self._hand_thread = None
+        # The current frame's clean pixels (FrameRef) while step() runs, and the
+        # reused RGB buffer of the hand thread.
+        self._source = None
+        self._rgb_buffer = None
+
+        # --- Instrumentation (used by Replay_Harness.py) ---
+        # capture_factory opens the stream; synchronous runs hand inference and
+        # detection inline so replays are deterministic; stage_times, when set to
+        # a dict, collects per-stage latencies in seconds.
+        self.capture_factory = cv2.VideoCapture
+        self.synchronous = False
+        self.stage_times = None
 
         # --- MediaPipe Hand Tracking Setup ---
         self.handtrack_hands = handtrack.solutions.hands
         self.hands = self.handtrack_hands.Hands(model_complexity=0, min_detection_confidence=0.7)
         self.handtrack_draw = handtrack.solutions.drawing_utils
 
-    def _get_and_track_points(self, frame, prompt):
+    # --- Public Control API (thread-safe) ---
+    @property
+    def prompt(self):
+        return self.state.prompt
+
+    def set_prompt(self, prompt):
+        """
+        Replaces the current prompt and clears any active trackers.
+        """
+        self.commands.put(("set_prompt", prompt))
+
+    def trigger_detection(self, force=False):
+        """
+        Samples the next frame and sends it to the server for detection.
+        force skips the detection cache for this prompt.
+        """
+        self.commands.put(("detect", force))
+
+    def stop(self):
+        """
+        Asks the frame loop to exit and release the camera.
+        """
+        self.commands.put(("stop", None))
+
+    def get_state(self):
+        """
+        Returns the latest published ClientState snapshot.
+        """
+        return self.state
+
+    def _publish(self, **changes):
+        self.state = dataclasses.replace(self.state, **changes)
+
+    def _record_stage(self, stage, start):
+        if self.stage_times is not None:
+            self.stage_times.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def _share(self, frame):
         """
-        [Threaded] Gets points from the server and initializes 2D trackers.
+        A FrameRef of the current frame that another thread may keep: the
+        captured buffer when step() was given one, otherwise a copy of frame.
+        The receiver releases it.
         """
-        print(f"\n[Thread] Sending frame to server for detection with prompt: '{prompt}'")
-        temp_frame_path = "temp_frame_for_thread.jpg"
+        if self._source is not None:
+            return self._source.retain()
+        return FrameRef.detached(frame.copy())
+
+    def _hold_source(self, source):
+        if self._source is not None:
+            self._source.release()
+        self._source = source.retain() if source is not None else None
+
+    # --- Command Handling (frame loop only) ---
+    def _start_detection(self, frame):
+        self.trackers = []
+        self._publish(tracking_active=False, is_detecting=True, redetection_trigger_time=None, dot_positions=())
+        if self.synchronous:
+            self._get_and_track_points(self._share(frame), self.state.prompt)
+            self._drain_commands(frame)
+            return
+        threading.Thread(target=self._get_and_track_points, args=(self._share(frame), self.state.prompt)).start()
+
+    def _apply_command(self, command, arg, frame):
+        """
+        Applies one queued command. Returns False when the loop should stop.
+        """
+        if command == "stop":
+            return False
+        if command == "set_prompt":
+            self.trackers = []
+            self._publish(prompt=arg, is_typing_prompt=False, typed_prompt="", tracking_active=False,
+                          redetection_trigger_time=None, dot_positions=())
+        elif command == "detect":
+            if arg and self.detection_cache is not None:
+                self.detection_cache.invalidate(self.state.prompt)
+            if not self.state.is_detecting:
+                self._start_detection(frame)
+        elif command == "trackers_ready":
+            prompt, new_trackers, points = arg
+            # Results for a prompt that has since been replaced are stale.
+            if prompt == self.state.prompt and not self.state.is_typing_prompt:
+                self.trackers = new_trackers
+                self.point_filter.reset(points)
+                self._last_frame_time = None
+                # The trackers were initialised on an older frame; let them run on the next one.
+                self._frames_since_tracker_update = self.tracker_interval
+                self._publish(tracking_active=bool(new_trackers), is_detecting=False)
+            else:
+                self._publish(is_detecting=False)
+        elif command == "detection_failed":
+            self._publish(is_detecting=False)
+        return True
+
+    def _drain_commands(self, frame):
+        while True:
+            try:
+                command, arg = self.commands.get_nowait()
+            except queue.Empty:
+                return True
+            if not self._apply_command(command, arg, frame):
+                return False
+
+    # --- Local Control Socket ---
+    def _start_control_server(self):
+        """
+        Serves a small JSON control API on localhost:
+        GET /state, GET /cache, POST /prompt {"prompt": ...}, POST /detect {"force": false}, POST /stop.
+        """
+        client = self
+
+        class ControlHandler(BaseHTTPRequestHandler):
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/state":
+                    self._reply(200, dataclasses.asdict(client.get_state()))
+                elif self.path == "/cache" and client.detection_cache is not None:
+                    self._reply(200, client.detection_cache.stats())
+                else:
+                    self._reply(404, {"detail": "Not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self._reply(400, {"detail": "Body must be JSON"})
+                    return
+                if self.path == "/prompt" and isinstance(body.get("prompt"), str):
+                    client.set_prompt(body["prompt"])
+                elif self.path == "/detect":
+                    client.trigger_detection(force=bool(body.get("force")))
+                elif self.path == "/stop":
+                    client.stop()
+                else:
+                    self._reply(404, {"detail": "Not found"})
+                    return
+                self._reply(202, {"status": "queued"})
+
+            def log_message(self, format, *args):
+                pass
+
+        self._control_server = ThreadingHTTPServer(("127.0.0.1", self.control_port), ControlHandler)
+        threading.Thread(target=self._control_server.serve_forever, daemon=True).start()
+        print(f"Control API listening on http://127.0.0.1:{self.control_port}")
+
+    def _request_points(self, frame, prompt):
+        """
+        Sends one frame to the server and returns the detected points.
+        """
+        temp_frame_path = f"temp_frame_for_thread_{threading.get_ident()}.jpg"
         cv2.imwrite(temp_frame_path, frame)
 
         try:
-            files = {'image': (temp_frame_path, open(temp_frame_path, 'rb'), 'image/jpeg')}
-            payload = {'text': prompt}
-            response = requests.post(self.server_url, files=files, data=payload)
+            with open(temp_frame_path, 'rb') as f:
+                files = {'image': (temp_frame_path, f, 'image/jpeg')}
+                payload = {'text': prompt}
+                response = requests.post(self.server_url, files=files, data=payload)
             response.raise_for_status()
             result = response.json()
+        finally:
+            if os.path.exists(temp_frame_path):
+                os.remove(temp_frame_path)
+
+        return self.parse_points(result.get('answer', ''))
 
-            answer_text = result.get('answer', '')
-            point_pattern = r'\(\s*(\d+)\s*,\s*(\d+)\s*\)'
-            extracted_points = re.findall(point_pattern, answer_text)
+    @staticmethod
+    def parse_points(answer_text):
+        """
+        Extracts [(x, y), ...] from the server's free-text pointing answer.
+        """
+        point_pattern = r'\(\s*(\d+)\s*,\s*(\d+)\s*\)'
+        return [(int(x), int(y)) for x, y in re.findall(point_pattern, answer_text)]
+
+    def _get_and_track_points(self, source, prompt):
+        """
+        [Threaded] Gets points from the detector and initializes 2D trackers.
+        The result is handed back to the frame loop through the command queue.
+        source is a FrameRef, released once the trackers are initialized.
+        """
+        frame = source.array
+        try:
+            points, signature = None, None
+            if self.detection_cache is not None:
+                signature = self.detection_cache.signature(frame)
+                points = self.detection_cache.get(prompt, signature)
+
+            if points is not None:
+                print(f"\n[Thread] Scene unchanged, reusing {len(points)} cached point(s) for prompt: '{prompt}'")
+            else:
+                print(f"\n[Thread] Sending frame to server for detection with prompt: '{prompt}'")
+                points = self.detector(frame, prompt)
+                # Empty answers are not cached, so pressing 's' again asks the server again.
+                if signature is not None and points:
+                    self.detection_cache.put(prompt, signature, points)
 
             new_trackers = []
-            if extracted_points:
-                points = [(int(x), int(y)) for x, y in extracted_points]
+            if points:
                 for point in points:
                     bbox_size = 50
                     bbox = (point[0] - bbox_size // 2, point[1] - bbox_size // 2, bbox_size, bbox_size)
@@ -66,75 +317,89 @@ class RealTimeARClient:
                     tracker.init(frame, bbox)
                     new_trackers.append(tracker)
 
-            with self.lock:
-                self.trackers = new_trackers
-                self.tracking_active = True if self.trackers else False
+            self.commands.put(("trackers_ready", (prompt, new_trackers, points or [])))
 
         except requests.exceptions.RequestException as e:
             print(f"[Thread] Network Error: {e}")
+            self.commands.put(("detection_failed", None))
+        except Exception as e:
+            # Anything else (a malformed answer, a timeout, cv2.error from a tracker) must
+            # still clear is_detecting, or every later detection request would be ignored.
+            print(f"[Thread] Detection Error: {e!r}")
+            self.commands.put(("detection_failed", None))
         finally:
-            with self.lock:
-                self.is_detecting = False
-            if os.path.exists(temp_frame_path):
-                os.remove(temp_frame_path)
+            source.release()
 
-    def _update_trackers(self, frame):
+    def _update_trackers(self, frame, timestamp):
         """
-        Updates trackers and returns a list of their current center positions.
+        Predicts the dots for this frame and returns their current center positions.
+        The trackers only run when the interval is up or a prediction has become
+        too uncertain; trackers that fail are dropped together with their dot.
         """
         if not self.trackers:
-            self.tracking_active = False
             return []
 
-        futures = [self.executor.submit(tracker.update, frame) for tracker in self.trackers]
+        dt = 0.0 if self._last_frame_time is None else max(0.0, timestamp - self._last_frame_time)
+        self._last_frame_time = timestamp
+        self.point_filter.predict(dt)
+        self._frames_since_tracker_update += 1
 
-        updated_trackers = []
-        dot_positions = []
-        for i, future in enumerate(futures):
-            success, bbox = future.result()
-            if success:
-                updated_trackers.append(self.trackers[i])
-                center_x = int(bbox[0] + bbox[2] / 2)
-                center_y = int(bbox[1] + bbox[3] / 2)
-                dot_positions.append((center_x, center_y))
-
-        if len(self.trackers) > 0 and len(updated_trackers) == 0:
-            self.tracking_active = False
-
-        self.trackers = updated_trackers
-        if not self.trackers:
-            self.tracking_active = False
+        if (self._frames_since_tracker_update >= self.tracker_interval
+                or self.point_filter.uncertainty().max() > self.uncertainty_threshold):
+            futures = [self.executor.submit(tracker.update, frame) for tracker in self.trackers]
+
+            found = []
+            measurements = []
+            for future in futures:
+                success, bbox = future.result()
+                found.append(bool(success))
+                measurements.append((bbox[0] + bbox[2] / 2, bbox[1] + bbox[3] / 2) if success else (0.0, 0.0))
+
+            self.point_filter.update(measurements, found)
+            self.point_filter.keep(found)
+            self.trackers = [tracker for tracker, ok in zip(self.trackers, found) if ok]
+            self._frames_since_tracker_update = 0
+            self.tracker_runs += 1
 
-        return dot_positions
+        return [(int(x), int(y)) for x, y in self.point_filter.positions()]
 
-    def _process_hands_in_background(self, frame):
+    def _process_hands_in_background(self, source):
         """
         [Threaded] Processes the frame for hand landmarks to avoid blocking the main loop.
+        source is a FrameRef, released once converted.
         """
-        img_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        results = self.hands.process(img_rgb)
-        with self.lock:
-            self.latest_hand_results = results
+        start = time.perf_counter()
+        try:
+            frame = source.array
+            # Only one hand pass runs at a time, so the RGB buffer can be reused.
+            if self._rgb_buffer is None or self._rgb_buffer.shape != frame.shape:
+                self._rgb_buffer = np.empty_like(frame)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self._rgb_buffer)
+        finally:
+            source.release()
+        # A single reference assignment, so the frame loop never sees a partial result.
+        self.latest_hand_results = self.hands.process(self._rgb_buffer)
+        self._record_stage("hand_inference", start)
 
-    def _draw_hud(self, frame):
+    def _draw_hud(self, frame, state):
         """
         Draws the Heads-Up Display on the frame.
         """
-        if self.is_typing_prompt:
+        if state.is_typing_prompt:
             cursor = "|" if int(time.time() * 2) % 2 == 0 else ""
-            prompt_text = f"New Prompt: {self.typed_prompt}{cursor}"
+            prompt_text = f"New Prompt: {state.typed_prompt}{cursor}"
             cv2.putText(frame, prompt_text, (20, frame.shape[0] - 45), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 255, 255), 2)
         else:
-            if self.redetection_trigger_time is not None:
+            if state.redetection_trigger_time is not None:
                 cv2.putText(frame, "Trackers lost. Re-detecting soon...", (20, 160), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 165, 255), 2)
-            if self.is_detecting:
+            if state.is_detecting:
                 cv2.putText(frame, "Detecting, please stand still...", (20, 130), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 255), 2)
-            if not self.tracking_active and not self.is_detecting:
+            if not state.tracking_active and not state.is_detecting:
                 cv2.putText(frame, "Press 's' to select object(s)", (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 2)
 
             cv2.putText(frame, "Press 'p' to change prompt", (20, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 2)
             cv2.putText(frame, "Press 'q' to quit", (20, 100), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 2)
-            cv2.putText(frame, f"Prompt: {self.prompt}", (20, frame.shape[0] - 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+            cv2.putText(frame, f"Prompt: {state.prompt}", (20, frame.shape[0] - 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
 
     def _handle_key_press(self, key, frame):
         """
@@ -142,141 +407,206 @@ class RealTimeARClient:
         """
         if key == 255: return True
 
-        if self.is_typing_prompt:
+        state = self.state
+        if state.is_typing_prompt:
             if key == 13: # Enter
-                with self.lock:
-                    self.prompt = self.typed_prompt
-                    self.is_typing_prompt = False
-                    self.typed_prompt = ""
+                self._publish(prompt=state.typed_prompt, is_typing_prompt=False, typed_prompt="")
             elif key == 8: # Backspace
-                self.typed_prompt = self.typed_prompt[:-1]
+                self._publish(typed_prompt=state.typed_prompt[:-1])
             elif 32 <= key <= 126:
-                self.typed_prompt += chr(key)
+                self._publish(typed_prompt=state.typed_prompt + chr(key))
             return True
 
         if key == ord('q'): return False
 
         if key == ord('s'):
-            with self.lock:
-                self.tracking_active = False
-                self.is_detecting = True
-                self.trackers = []
-                self.redetection_trigger_time = None
-            threading.Thread(target=self._get_and_track_points, args=(frame.copy(), self.prompt)).start()
+            self._start_detection(frame)
+
+        if key == ord('S'):
+            if self.detection_cache is not None:
+                self.detection_cache.invalidate(state.prompt)
+            self._start_detection(frame)
 
         if key == ord('p'):
-            with self.lock:
-                self.tracking_active = False
-                self.is_detecting = False
-                self.trackers = []
-                self.is_typing_prompt = True
-                self.typed_prompt = ""
-                self.redetection_trigger_time = None
+            self.trackers = []
+            self._publish(tracking_active=False, is_detecting=False, is_typing_prompt=True, typed_prompt="",
+                          redetection_trigger_time=None, dot_positions=())
 
         return True
 
-    def run(self):
+    def open(self):
         """
-        Main application loop.
+        Opens the camera stream and the optional control socket.
+        Returns the capture, or None if the stream could not be opened.
         """
-        print(f"Initial prompt is: '{self.prompt}'.")
-        cap = cv2.VideoCapture(self.droidcam_url)
+        print(f"Initial prompt is: '{self.state.prompt}'.")
+        cap = self.capture_factory(self.droidcam_url)
         if not cap.isOpened():
             print(f"Error: Could not open DroidCam stream at {self.droidcam_url}")
-            return
+            return None
 
-        hand_thread = None
+        if self.control_port is not None:
+            self._start_control_server()
 
-        while True:
-            ret, frame = cap.read()
-            if not ret: break
-
-            h, w, c = frame.shape
-
-            dot_positions = []
-            was_tracking = self.tracking_active
-            if self.tracking_active:
-                with self.lock:
-                    dot_positions = self._update_trackers(frame)
-
-            if hand_thread is None or not hand_thread.is_alive():
-                hand_thread = threading.Thread(target=self._process_hands_in_background, args=(frame.copy(),))
-                hand_thread.start()
-
-            if self.latest_hand_results and self.latest_hand_results.multi_hand_landmarks:
-                for hand_lms in self.latest_hand_results.multi_hand_landmarks:
-                    index_finger_tip = hand_lms.landmark[self.handtrack_hands.HandLandmark.INDEX_FINGER_TIP]
-                    ix, iy = int(index_finger_tip.x * w), int(index_finger_tip.y * h)
-
-                    with self.lock:
-                        dots_were_popped = False
-                        surviving_trackers = list(self.trackers)
-                        surviving_dots = list(dot_positions)
-
-                        for i in range(len(dot_positions) - 1, -1, -1):
-                            dot_pos = dot_positions[i]
-                            distance = ((ix - dot_pos[0])**2 + (iy - dot_pos[1])**2)**0.5
-                            if distance < self.dot_radius:
-                                dots_were_popped = True
-                                print(f"Popped a dot at {dot_pos}!")
-                                self.pop_effects.append({"pos": dot_pos, "time": time.time()})
-                                del surviving_trackers[i]
-                                del surviving_dots[i]
-
-                        self.trackers = surviving_trackers
-                        dot_positions = surviving_dots
-
-                        if dots_were_popped and not self.trackers:
-                            print("\nTask complete! Please enter a new prompt.")
-                            self.is_typing_prompt = True
-                            self.typed_prompt = ""
-                            self.redetection_trigger_time = None
-
-                    if dot_positions:
-                        distances = [((ix - dx)**2 + (iy - dy)**2)**0.5 for dx, dy in dot_positions]
-                        nearest_dot = dot_positions[distances.index(min(distances))]
-                        cv2.arrowedLine(frame, (ix, iy), nearest_dot, (0, 255, 0), 3)
-
-                    self.handtrack_draw.draw_landmarks(frame, hand_lms, self.handtrack_hands.HAND_CONNECTIONS)
-
-            if was_tracking and not self.trackers and not self.is_typing_prompt:
-                with self.lock:
-                    if not self.is_detecting and self.redetection_trigger_time is None:
-                        print("\nTrackers lost. Re-detecting in a moment...")
-                        self.redetection_trigger_time = time.time()
-
-            if self.redetection_trigger_time is not None and not self.is_detecting:
-                delay_seconds = 2.0
-                if time.time() - self.redetection_trigger_time > delay_seconds:
-                    print(f"Delay of {delay_seconds}s over. Triggering re-detection...")
-                    with self.lock:
-                        self.is_detecting = True
-                        self.redetection_trigger_time = None
-                    threading.Thread(target=self._get_and_track_points, args=(frame.copy(), self.prompt)).start()
-
-            for effect in self.pop_effects[:]:
-                if time.time() - effect["time"] < 0.5:
-                    cv2.circle(frame, effect["pos"], self.dot_radius + 5, (0, 255, 0), 3)
-                else:
-                    self.pop_effects.remove(effect)
+        self._publish(running=True)
+        return cap
 
-            for dot_pos in dot_positions:
-                cv2.circle(frame, dot_pos, self.dot_radius, self.dot_color, -1)
+    def step(self, frame, timestamp=None, source=None):
+        """
+        Processes one camera frame: applies queued commands, updates trackers,
+        handles hand interaction and draws the overlay onto the frame in place.
+        timestamp is the capture time in seconds (default: now); replays pass
+        the recorded one so the dot predictions are reproducible. source is an
+        optional FrameRef with frame's undrawn pixels, which background stages
+        then share instead of copying frame; the client keeps a reference to it
+        until the next step.
+        Returns False when the client has been asked to stop.
+        """
+        self._hold_source(source)
+        if not self._drain_commands(frame):
+            return False
+        if timestamp is None:
+            timestamp = time.perf_counter()
 
-            self._draw_hud(frame)
-            cv2.imshow("Real-time AR Tracking", frame)
+        h, w, c = frame.shape
 
-            key = cv2.waitKey(1) & 0xFF
-            if not self._handle_key_press(key, frame):
-                break
+        dot_positions = []
+        was_tracking = self.state.tracking_active
+        if was_tracking:
+            start = time.perf_counter()
+            dot_positions = self._update_trackers(frame, timestamp)
+            self._record_stage("tracker_update", start)
+
+        if self.synchronous:
+            # Runs before anything is drawn, so frame itself can be used.
+            self._process_hands_in_background(FrameRef.detached(frame))
+        elif self._hand_thread is None or not self._hand_thread.is_alive():
+            self._hand_thread = threading.Thread(target=self._process_hands_in_background, args=(self._share(frame),))
+            self._hand_thread.start()
+
+        start = time.perf_counter()
+        hand_results = self.latest_hand_results
+        if hand_results and hand_results.multi_hand_landmarks:
+            for hand_lms in hand_results.multi_hand_landmarks:
+                index_finger_tip = hand_lms.landmark[self.handtrack_hands.HandLandmark.INDEX_FINGER_TIP]
+                ix, iy = int(index_finger_tip.x * w), int(index_finger_tip.y * h)
+
+                dots_were_popped = False
+                surviving_trackers = list(self.trackers)
+                surviving_dots = list(dot_positions)
+                kept = [True] * len(dot_positions)
+
+                for i in range(len(dot_positions) - 1, -1, -1):
+                    dot_pos = dot_positions[i]
+                    distance = ((ix - dot_pos[0])**2 + (iy - dot_pos[1])**2)**0.5
+                    if distance < self.dot_radius:
+                        dots_were_popped = True
+                        print(f"Popped a dot at {dot_pos}!")
+                        self.pop_effects.append({"pos": dot_pos, "time": time.time()})
+                        del surviving_trackers[i]
+                        del surviving_dots[i]
+                        kept[i] = False
+
+                self.trackers = surviving_trackers
+                dot_positions = surviving_dots
+                if dots_were_popped:
+                    self.point_filter.keep(kept)
+
+                if dots_were_popped and not self.trackers:
+                    print("\nTask complete! Please enter a new prompt.")
+                    self._publish(is_typing_prompt=True, typed_prompt="", redetection_trigger_time=None)
+
+                if dot_positions:
+                    distances = [((ix - dx)**2 + (iy - dy)**2)**0.5 for dx, dy in dot_positions]
+                    nearest_dot = dot_positions[distances.index(min(distances))]
+                    cv2.arrowedLine(frame, (ix, iy), nearest_dot, (0, 255, 0), 3)
+
+                self.handtrack_draw.draw_landmarks(frame, hand_lms, self.handtrack_hands.HAND_CONNECTIONS)
+        self._record_stage("hit_test", start)
+
+        if was_tracking:
+            self._publish(tracking_active=bool(self.trackers), dot_positions=tuple(dot_positions))
+
+        state = self.state
+        if was_tracking and not self.trackers and not state.is_typing_prompt:
+            if not state.is_detecting and state.redetection_trigger_time is None:
+                print("\nTrackers lost. Re-detecting in a moment...")
+                self._publish(redetection_trigger_time=time.time())
+
+        state = self.state
+        if state.redetection_trigger_time is not None and not state.is_detecting:
+            delay_seconds = 2.0
+            if time.time() - state.redetection_trigger_time > delay_seconds:
+                print(f"Delay of {delay_seconds}s over. Triggering re-detection...")
+                self._start_detection(frame)
+
+        start = time.perf_counter()
+        for effect in self.pop_effects[:]:
+            if time.time() - effect["time"] < 0.5:
+                cv2.circle(frame, effect["pos"], self.dot_radius + 5, (0, 255, 0), 3)
+            else:
+                self.pop_effects.remove(effect)
+
+        for dot_pos in dot_positions:
+            cv2.circle(frame, dot_pos, self.dot_radius, self.dot_color, -1)
+
+        self._draw_hud(frame, self.state)
+        self._record_stage("render", start)
+        return True
 
-        self.executor.shutdown()
+    def close(self, cap):
+        """
+        Releases the camera and everything the client owns.
+        """
+        self._publish(running=False)
+        self._hold_source(None)
+        if self._control_server is not None:
+            self._control_server.shutdown()
+        if self._owns_executor:
+            self.executor.shutdown()
+        if self.detection_cache is not None:
+            print(f"Detection cache: {self.detection_cache.stats()}")
         cap.release()
+
+    def run(self):
+        """
+        Main application loop.
+        """
+        cap = self.open()
+        if cap is None:
+            return
+
+        ring = FrameRing()
+        while True:
+            source = ring.read(cap)
+            if source is None: break
+
+            # The overlay goes onto a reused canvas; the captured frame stays clean for the other stages.
+            frame = ring.canvas(source)
+            keep_running = self.step(frame, source=source)
+            if keep_running:
+                cv2.imshow(self.window_name, frame)
+
+                key = cv2.waitKey(1) & 0xFF
+                keep_running = self._handle_key_press(key, frame)
+            source.release()
+            if not keep_running:
+                break
+
+        self.close(cap)
         cv2.destroyAllWindows()
 
 if __name__ == "__main__":
     SERVER_URL = "https://balanced-vaguely-mastodon.ngrok-free.app/inference/"
     DROIDCAM_URL = "http://192.168.133.7:4747/video"
 
-    client = RealTimeARClient(SERVER_URL, DROIDCAM_URL)
-    client.run()
\ No newline at end of file
+    # ROBOBRAIN_TRANSPORT=ws sends frames over the server's persistent /ws channel instead.
+    detector = None
+    if os.environ.get("ROBOBRAIN_TRANSPORT", "http") == "ws":
+        from WebSocket_Detector import WebSocketDetector
+        detector = WebSocketDetector(SERVER_URL)
+
+    client = RealTimeARClient(SERVER_URL, DROIDCAM_URL, detector=detector, detection_cache=DetectionCache())
+    client.run()
+    if detector is not None:
+        detector.close()
\ No newline at end of file
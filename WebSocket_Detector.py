@@ -0,0 +1,209 @@
+# websocket_detector.py
+
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from urllib.parse import urlsplit, urlunsplit
+
+import cv2
+import requests
+from websockets.sync.client import connect
+
+from ws_protocol import pack_frame, unpack_frame
+
+
+def websocket_url(server_url):
+    """
+    Turns the HTTP inference URL into the server's WebSocket URL,
+    e.g. "https://host/inference/" -> "wss://host/ws".
+    """
+    parts = urlsplit(server_url)
+    scheme = {"http": "ws", "https": "wss"}.get(parts.scheme, parts.scheme)
+    return urlunsplit((scheme, parts.netloc, "/ws", "", ""))
+
+
+class QualityController:
+    """
+    Picks the encode quality for the next frame from the measured link speed.
+
+    Every answered request gives one (bytes sent, network time) sample, where the
+    network time is the round trip minus the server's own processing time. A
+    least-squares fit over recent samples splits that into a fixed latency and a
+    per-byte cost (1 / bandwidth). Quality is lowered when the predicted upload
+    time of a frame, its share of the network time beyond the fixed latency,
+    exceeds target_upload_s and raised again when there is room. A slow but
+    high-latency link therefore keeps its quality.
+    """
+    def __init__(self, quality=80, min_quality=30, max_quality=90, target_upload_s=0.1, step=5, window=32):
+        self.quality = quality
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.target_upload_s = target_upload_s
+        self.step = step
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.seconds_per_byte = None
+        self.latency_s = None
+
+    def observe(self, size, network_s):
+        with self.lock:
+            self.samples.append((size, max(network_s, 0.0)))
+            self._fit()
+            if self.seconds_per_byte is None:
+                return
+            upload_s = size * self.seconds_per_byte
+            if upload_s > self.target_upload_s:
+                self.quality = max(self.min_quality, self.quality - self.step)
+            elif upload_s < self.target_upload_s / 2:
+                self.quality = min(self.max_quality, self.quality + self.step)
+
+    def _fit(self):
+        n = len(self.samples)
+        if n < 4:
+            return
+        mean_size = sum(size for size, _ in self.samples) / n
+        mean_time = sum(t for _, t in self.samples) / n
+        var = sum((size - mean_size) ** 2 for size, _ in self.samples)
+        cov = sum((size - mean_size) * (t - mean_time) for size, t in self.samples)
+        if var > 0 and cov > 0:
+            self.seconds_per_byte = cov / var
+            self.latency_s = max(0.0, mean_time - self.seconds_per_byte * mean_size)
+        elif mean_size > 0:
+            # Not enough spread in frame sizes to separate the two: take the fastest round
+            # trip as the fixed latency and only the time above it as transfer. Latency alone
+            # then never lowers the quality; raising it spreads the sizes for a real fit.
+            self.latency_s = min(t for _, t in self.samples)
+            self.seconds_per_byte = (mean_time - self.latency_s) / mean_size
+
+    @property
+    def bandwidth_bps(self):
+        return 8 / self.seconds_per_byte if self.seconds_per_byte else None
+
+
+class WebSocketDetector:
+    """
+    A detector that talks to the server's /ws endpoint over one persistent
+    connection instead of one multipart HTTP upload per frame.
+
+    Frames are sent as JPEG (or WebP) with a small msgpack header and answered
+    with structured points, so no answer text has to be parsed. Every request
+    carries an id, so several detections (e.g. from different streams sharing
+    this detector) can be in flight at once. Encode quality follows the measured
+    bandwidth, see QualityController. The connection is opened on first use and
+    re-opened after a failure.
+    """
+    def __init__(self, server_url, image_format="jpeg", quality=80, min_quality=30, max_quality=90,
+                 target_upload_s=0.1, timeout=60.0):
+        self.ws_url = websocket_url(server_url)
+        self.image_format = image_format
+        self.timeout = timeout
+        self.controller = QualityController(quality, min_quality, max_quality, target_upload_s)
+
+        self.lock = threading.Lock()
+        self.connection = None
+        # request id -> (future, connection, send time, encoded size)
+        self.pending = {}
+        self.request_ids = itertools.count()
+
+    def __call__(self, frame, prompt):
+        """
+        [Blocking] Sends one frame for detection and returns its points.
+        """
+        future = self.submit(frame, prompt)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Forget the request, or it would stay pending and count as in flight forever.
+            with self.lock:
+                for request_id, entry in list(self.pending.items()):
+                    if entry[0] is future:
+                        del self.pending[request_id]
+            raise requests.exceptions.Timeout(f"No detection result within {self.timeout}s.")
+
+    def submit(self, frame, prompt, task="pointing"):
+        """
+        Sends one frame without waiting; the returned Future resolves to [(x, y), ...].
+        """
+        quality = self.controller.quality
+        if self.image_format == "webp":
+            ok, encoded = cv2.imencode(".webp", frame, [cv2.IMWRITE_WEBP_QUALITY, quality])
+        else:
+            ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError(f"Could not encode frame as {self.image_format}.")
+        data = encoded.tobytes()
+
+        future = Future()
+        with self.lock:
+            try:
+                connection = self._connect()
+                request_id = next(self.request_ids)
+                header = {"id": request_id, "text": prompt, "task": task, "format": self.image_format}
+                self.pending[request_id] = (future, connection, time.perf_counter(), len(data))
+                connection.send(pack_frame(header, data))
+            except Exception as e:
+                self._fail_connection(self.connection, e)
+                if not future.done():
+                    future.set_exception(requests.exceptions.ConnectionError(f"WebSocket send failed: {e}"))
+        return future
+
+    def _connect(self):
+        """
+        Returns the open connection, opening it first if needed. Call with self.lock held.
+        """
+        if self.connection is None:
+            print(f"[Detector] Connecting to {self.ws_url}")
+            self.connection = connect(self.ws_url, max_size=None, open_timeout=10)
+            threading.Thread(target=self._receive_loop, args=(self.connection,), daemon=True).start()
+        return self.connection
+
+    def _receive_loop(self, connection):
+        error = "connection closed"
+        try:
+            for message in connection:
+                header, _ = unpack_frame(message)
+                with self.lock:
+                    entry = self.pending.pop(header.get("id"), None)
+                if entry is None:
+                    continue
+                future, _, sent_at, size = entry
+                if header.get("status") == "ok":
+                    self.controller.observe(size, time.perf_counter() - sent_at - header.get("server_s", 0.0))
+                    future.set_result([tuple(point) for point in header.get("points", [])])
+                else:
+                    future.set_exception(requests.exceptions.HTTPError(
+                        f"Server error {header.get('code')}: {header.get('detail')}"))
+        except Exception as e:
+            error = e
+        with self.lock:
+            self._fail_connection(connection, error)
+
+    def _fail_connection(self, connection, error):
+        """
+        Fails every request still waiting on connection and forgets it. Call with self.lock held.
+        """
+        if connection is None:
+            return
+        for request_id, (future, owner, _, _) in list(self.pending.items()):
+            if owner is connection:
+                del self.pending[request_id]
+                future.set_exception(requests.exceptions.ConnectionError(f"WebSocket failed: {error}"))
+        if self.connection is connection:
+            self.connection = None
+        connection.close()
+
+    def stats(self):
+        with self.lock:
+            in_flight = len(self.pending)
+        return {
+            "quality": self.controller.quality,
+            "bandwidth_bps": self.controller.bandwidth_bps,
+            "latency_s": self.controller.latency_s,
+            "in_flight": in_flight,
+        }
+
+    def close(self):
+        with self.lock:
+            self._fail_connection(self.connection, "detector closed")
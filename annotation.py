@@ -0,0 +1,159 @@
+import base64, os, queue, threading, uuid
+import cv2
+import numpy as np
+
+from answer_parser import parse_boxes, parse_points, parse_trajectory
+from telemetry import logger, stage_timer
+
+
+# Per-request annotation modes accepted by the API servers.
+ANNOTATE_MODES = ["none", "coords", "image"]
+
+
+def decode_image(data):
+    """
+    Decode uploaded image bytes into a BGR array.
+    """
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Unable to decode uploaded image.")
+    return image
+
+
+def extract_annotations(task, answer_text):
+    """
+    Parse a model answer into the coordinates that can be drawn for its task.
+    Returns {"points": [...], "boxes": [...], "trajectories": [...]} with empty lists
+    for whatever the task does not produce.
+    """
+    annotations = {"points": [], "boxes": [], "trajectories": []}
+    if task == "pointing":
+        annotations["points"] = parse_points(answer_text)
+    elif task in ["affordance", "grounding"]:
+        annotations["boxes"] = parse_boxes(answer_text)
+    elif task == "trajectory":
+        annotations["trajectories"] = [parse_trajectory(answer_text)]
+    return annotations
+
+
+def draw_annotations(image, points=None, boxes=None, trajectories=None):
+    """
+    Draw points, bounding boxes, and trajectories onto a BGR image array in place.
+
+    Parameters:
+        image: Decoded image (numpy array, BGR)
+        points: List of points in format [(x1, y1), (x2, y2), ...]
+        boxes: List of boxes in format [[x1, y1, x2, y2], [x1, y1, x2, y2], ...]
+        trajectories: List of trajectories in format [[(x1, y1), (x2, y2), ...], [...]]
+    """
+    # Draw points
+    if points:
+        for point in points:
+            x, y = point
+            cv2.circle(image, (x, y), 10, (0, 0, 255), -1)  # Red solid circle
+
+    # Draw bounding boxes
+    if boxes:
+        for box in boxes:
+            x1, y1, x2, y2 = box
+            cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 2)  # Green box, line width 2
+
+    # Draw trajectories
+    if trajectories:
+        for trajectory in trajectories:
+            if len(trajectory) < 2:
+                continue  # Need at least 2 points to form a trajectory
+            # Connect trajectory points with lines
+            for i in range(1, len(trajectory)):
+                cv2.line(image, tuple(trajectory[i-1]), tuple(trajectory[i]), (255, 0, 0), 2)  # Blue line, width 2
+            # Draw a larger point at the trajectory end
+            end_x, end_y = trajectory[-1]
+            cv2.circle(image, (end_x, end_y), 7, (255, 0, 0), -1)  # Blue solid circle, slightly larger
+    return image
+
+
+def encode_overlay(image, annotations, ext=".jpg", quality=85):
+    """
+    Draw the annotations on a copy of the decoded image and return it base64-encoded.
+    """
+    with stage_timer("plot"):
+        overlay = draw_annotations(image.copy(), **annotations)
+        ok, encoded = cv2.imencode(ext, overlay, [cv2.IMWRITE_JPEG_QUALITY, quality] if ext == ".jpg" else [])
+        if not ok:
+            raise ValueError(f"Could not encode overlay as {ext}")
+        return base64.b64encode(encoded.tobytes()).decode("ascii")
+
+
+def annotate_result(result, task, mode, load_image, name, worker=None, save=False):
+    """
+    Add the requested annotation to an inference result.
+
+    Args:
+        result (dict): The {"thinking", "answer"} dict returned by the model; updated in place.
+        task (str): Task the answer belongs to.
+        mode (str): "none" leaves the result as is, "coords" adds the parsed points/boxes/
+            trajectories, "image" also adds "overlay", a base64 JPEG of the annotated image.
+        load_image (callable): Returns the decoded BGR image; only called when pixels are needed.
+        name (str): File name used when the annotated image is saved.
+        worker (AnnotationWorker): Background writer used when save is True.
+        save (bool): Also write the annotated image to disk in the background.
+    """
+    annotations = extract_annotations(task, result["answer"])
+    if mode != "none":
+        result.update(annotations)
+    if mode == "image" or (save and worker is not None):
+        image = load_image()
+        if mode == "image":
+            result["overlay"] = encode_overlay(image, annotations)
+        if save and worker is not None:
+            worker.submit(image, annotations, name)
+    return result
+
+
+class AnnotationWorker:
+    """
+    Writes annotated images to disk on a background thread, off the request path.
+    The output directory is bounded: once it holds more than max_files images the
+    oldest ones are deleted. If the worker falls behind, new jobs are dropped
+    rather than queued without limit.
+    """
+
+    def __init__(self, output_dir="result", max_files=200, max_pending=32):
+        self.output_dir = output_dir
+        self.max_files = max_files
+        self.jobs = queue.Queue(maxsize=max_pending)
+        os.makedirs(output_dir, exist_ok=True)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, image, annotations, name):
+        """
+        Queue one image for annotation. `image` must not be modified by the caller afterwards.
+        Returns the path the file will be written to, or None if the job was dropped.
+        """
+        stem, ext = os.path.splitext(os.path.basename(name))
+        output_path = os.path.join(self.output_dir, f"{stem}_{uuid.uuid4().hex[:8]}_annotated{ext or '.jpg'}")
+        try:
+            self.jobs.put_nowait((image, annotations, output_path))
+        except queue.Full:
+            logger.warning("Annotation queue full; dropping %s", output_path)
+            return None
+        return output_path
+
+    def _run(self):
+        while True:
+            image, annotations, output_path = self.jobs.get()
+            try:
+                cv2.imwrite(output_path, draw_annotations(image, **annotations))
+                logger.debug("Annotated image saved to: %s", output_path)
+                self._prune()
+            except Exception as e:
+                logger.error("Error writing annotation %s: %s", output_path, e)
+
+    def _prune(self):
+        paths = [os.path.join(self.output_dir, name) for name in os.listdir(self.output_dir)]
+        paths = [path for path in paths if os.path.isfile(path)]
+        if len(paths) <= self.max_files:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_files]:
+            os.remove(path)
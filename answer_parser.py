@@ -0,0 +1,26 @@
+import re
+
+POINT_PATTERN = r'\(\s*(\d+)\s*,\s*(\d+)\s*\)'
+BOX_PATTERN = r'\[\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\]'
+TRAJECTORY_PATTERN = r'(\d+),\s*(\d+)'
+
+
+def parse_points(answer_text):
+    """
+    Extract pointing results, e.g. "[(x1, y1), (x2, y2)]" -> [(x1, y1), (x2, y2)].
+    """
+    return [(int(x), int(y)) for x, y in re.findall(POINT_PATTERN, answer_text)]
+
+
+def parse_boxes(answer_text):
+    """
+    Extract bounding boxes, e.g. "[x1, y1, x2, y2]" -> [[x1, y1, x2, y2]].
+    """
+    return [[int(x1), int(y1), int(x2), int(y2)] for x1, y1, x2, y2 in re.findall(BOX_PATTERN, answer_text)]
+
+
+def parse_trajectory(answer_text):
+    """
+    Extract one trajectory, e.g. "[[x1, y1], [x2, y2]]" -> [(x1, y1), (x2, y2)].
+    """
+    return [(int(x), int(y)) for x, y in re.findall(TRAJECTORY_PATTERN, answer_text)]
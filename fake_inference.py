@@ -0,0 +1,106 @@
+import random, time
+from typing import Union
+from PIL import Image
+from telemetry import logger
+
+
+def parse_latency(spec: str):
+    """
+    Parse a latency distribution spec into a sampler returning seconds.
+
+    Supported specs:
+        "constant:0.2"            always 0.2 s
+        "uniform:0.1:0.4"         uniform between 0.1 and 0.4 s
+        "normal:0.3:0.05"         normal with mean 0.3 s and std 0.05 s
+        "lognormal:0.3:0.5"       lognormal with median 0.3 s and shape 0.5
+    """
+    kind, *params = spec.split(":")
+    params = [float(p) for p in params]
+    if kind == "constant" and len(params) == 1:
+        return lambda rng: params[0]
+    if kind == "uniform" and len(params) == 2:
+        return lambda rng: rng.uniform(params[0], params[1])
+    if kind == "normal" and len(params) == 2:
+        return lambda rng: max(0.0, rng.gauss(params[0], params[1]))
+    if kind == "lognormal" and len(params) == 2:
+        return lambda rng: params[0] * rng.lognormvariate(0.0, params[1])
+    raise ValueError(f"Invalid latency spec: {spec}. Expected e.g. 'constant:0.2' or 'lognormal:0.3:0.5'.")
+
+
+class FakeInference:
+    """
+    A drop-in stand-in for SimpleInference that needs no GPU or model weights.
+    It returns well-formed answers for every task after sleeping for a latency
+    drawn from a configurable distribution, so the HTTP layer can be tested and
+    load-tested on its own.
+    """
+
+    def __init__(self, model_id="BAAI/RoboBrain2.0-3B", latency="lognormal:0.3:0.5", same_rate=0.9, seed=None):
+        """
+        Args:
+            model_id (str): Ignored; kept so the constructor matches SimpleInference.
+            latency (str): Latency distribution spec, see parse_latency().
+            same_rate (float): Probability that a "verify" request answers "same".
+            seed (int): Optional seed for reproducible answers and latencies.
+        """
+        logger.info("Loading fake backend (latency=%s) ...", latency)
+        self.model_id = model_id
+        self.sample_latency = parse_latency(latency)
+        self.same_rate = same_rate
+        self.rng = random.Random(seed)
+
+    def _image_size(self, image):
+        try:
+            with Image.open(image) as img:
+                return img.size
+        except (OSError, ValueError):
+            return 640, 480
+
+    def _answer(self, task, image):
+        width, height = self._image_size(image)
+        rng = self.rng
+
+        def point():
+            return rng.randrange(width), rng.randrange(height)
+
+        def box():
+            (x1, x2), (y1, y2) = sorted(rng.sample(range(width), 2)), sorted(rng.sample(range(height), 2))
+            return f"[{x1}, {y1}, {x2}, {y2}]"
+
+        if task == "pointing":
+            return "[" + ", ".join(f"({x}, {y})" for x, y in (point() for _ in range(rng.randint(1, 4)))) + "]"
+        if task == "trajectory":
+            return "[" + ", ".join(f"[{x}, {y}]" for x, y in (point() for _ in range(rng.randint(2, 10)))) + "]"
+        if task in ["affordance", "grounding"]:
+            return box()
+        if task == "verify":
+            return "same" if rng.random() < self.same_rate else "different"
+        if task == "object":
+            return "object"
+        return "This is a fake answer."
+
+    def inference(self, text: str, image: Union[list, str], task="general", plot=False, enable_thinking=True, do_sample=True, temperature=0.7,
+                  thinking_budget=None, latency_sla_s=None, cache_features=False):
+        """Return a fake but well-formed answer. Arguments mirror SimpleInference.inference; plot, the thinking budget and cache_features are ignored."""
+        if isinstance(image, str):
+            image = [image]
+
+        assert task in ["general", "pointing", "affordance", "trajectory", "grounding", "verify", "object"], f"Invalid task type: {task}."
+        assert task == "general" or len(image) == 1, "Pointing, affordance, grounding, verify, object, and trajectory tasks require exactly one image."
+
+        time.sleep(self.sample_latency(self.rng))
+        return {
+            "thinking": "Fake reasoning." if enable_thinking else "",
+            "answer": self._answer(task, image[0])
+        }
+
+    def batch_inference(self, texts: list, images: list, task="pointing", enable_thinking=False, do_sample=True, temperature=0.7,
+                        thinking_budget=None, latency_sla_s=None):
+        """Return one fake answer per (text, image) pair after a single latency sample."""
+        assert len(texts) == len(images), "batch_inference needs exactly one image per prompt."
+
+        time.sleep(self.sample_latency(self.rng))
+        return [
+            {"thinking": "Fake reasoning." if enable_thinking else "", "answer": self._answer(task, image)}
+            for image in images
+        ]
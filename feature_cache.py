@@ -0,0 +1,238 @@
+import hashlib, json, os, queue, sqlite3, threading, time
+
+import numpy as np
+
+from telemetry import FEATURE_CACHE_LOOKUPS, logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS arrays (
+    key TEXT NOT NULL,
+    name TEXT NOT NULL,
+    file TEXT NOT NULL,
+    PRIMARY KEY (key, name)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+"""
+
+
+class FeatureCache:
+    """
+    On-disk cache of per-image work that survives server restarts: preprocessed
+    pixel tensors, visual embeddings and deterministic results. A SQLite index
+    maps each key to its arrays, stored as .npy files that are memory-mapped on
+    read, so a restarted server only pages in what its requests touch. The
+    index itself is opened on first use, not at construction.
+
+    Every entry belongs to the namespace of the loading profile it was computed
+    with (model id and revision, dtype, quantization, attention implementation,
+    processor settings, library versions). Entries of any other namespace are
+    purged when the cache is opened, so a changed model or profile never serves
+    stale features. At most max_bytes of arrays and meta are kept; the least
+    recently used entries are evicted first.
+
+    Request paths store entries with put_async(), which hands them to a
+    background writer; when it falls behind, new entries are dropped rather
+    than queued without limit.
+    """
+
+    # Remembered file hashes are checked for deleted files after this many new ones.
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, directory, profile, max_bytes=2 * 2**30, max_pending=64):
+        self.directory = directory
+        self.arrays_dir = os.path.join(directory, "arrays")
+        self.namespace = hashlib.sha256(json.dumps(profile, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.max_bytes = max_bytes
+        # When False, lookups miss and nothing is stored, e.g. during warm-up.
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.db = None
+        self.writes = queue.Queue(maxsize=max_pending)
+        self.writer = None
+        self.new_files = 0
+
+    def _open(self):
+        """
+        Returns the index connection, opening it first if needed. Call with self.lock held.
+        """
+        if self.db is None:
+            os.makedirs(self.arrays_dir, exist_ok=True)
+            # Replica processes may share the directory; SQLite serialises their writes.
+            db = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), timeout=30, check_same_thread=False)
+            db.executescript(SCHEMA)
+            stale = db.execute("SELECT key FROM entries WHERE namespace != ?", (self.namespace,)).fetchall()
+            for (key,) in stale:
+                self._delete(db, key)
+            self._prune_files(db)
+            db.commit()
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries").fetchone()
+            if stale:
+                logger.info("Feature cache: dropped %d entries of another model or loading profile.", len(stale))
+            logger.info("Feature cache: %d entries (%.0f MiB) in %s", entries, size / 2**20, self.directory)
+            self.db = db
+        return self.db
+
+    def _delete(self, db, key):
+        for (path,) in db.execute("SELECT file FROM arrays WHERE key = ?", (key,)).fetchall():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        db.execute("DELETE FROM arrays WHERE key = ?", (key,))
+        db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _prune_files(self, db):
+        """
+        Forgets the hashes of files that no longer exist. Call with self.lock held.
+        """
+        gone = [(path,) for (path,) in db.execute("SELECT path FROM files").fetchall() if not os.path.exists(path)]
+        db.executemany("DELETE FROM files WHERE path = ?", gone)
+
+    def _key(self, kind, params):
+        return hashlib.sha256(json.dumps([self.namespace, kind, params], sort_keys=True).encode()).hexdigest()
+
+    def file_hash(self, path):
+        """
+        SHA-256 of a file's contents, remembered by path, modification time and size
+        so unchanged files are hashed only once, across restarts too.
+        """
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self._open().execute("SELECT mtime_ns, size, hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[2]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        with self.lock:
+            db = self._open()
+            db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                       (path, stat.st_mtime_ns, stat.st_size, digest.hexdigest()))
+            self.new_files += 1
+            if self.new_files % self.PRUNE_INTERVAL == 0:
+                self._prune_files(db)
+            db.commit()
+        return digest.hexdigest()
+
+    def get(self, kind, params):
+        """
+        Returns (arrays, meta) for the entry, with the arrays memory-mapped
+        read-only, or None.
+        """
+        if not self.enabled:
+            return None
+        key = self._key(kind, params)
+        with self.lock:
+            db = self._open()
+            row = db.execute("SELECT meta FROM entries WHERE key = ?", (key,)).fetchone()
+            files = db.execute("SELECT name, file FROM arrays WHERE key = ?", (key,)).fetchall() if row else []
+            if row is not None:
+                db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+                db.commit()
+        if row is None:
+            FEATURE_CACHE_LOOKUPS.labels(kind=kind, outcome="miss").inc()
+            return None
+
+        try:
+            arrays = {name: np.load(path, mmap_mode="r") for name, path in files}
+        except (OSError, ValueError) as e:
+            # Evicted by another process in the meantime, or a torn file.
+            logger.warning("Feature cache: dropping unreadable %s entry: %s", kind, e)
+            with self.lock:
+                self._delete(self.db, key)
+                self.db.commit()
+            FEATURE_CACHE_LOOKUPS.labels(kind=kind, outcome="miss").inc()
+            return None
+        FEATURE_CACHE_LOOKUPS.labels(kind=kind, outcome="hit").inc()
+        return arrays, json.loads(row[0])
+
+    def put(self, kind, params, arrays=None, meta=None):
+        """
+        Stores numpy arrays and/or a JSON-serialisable meta dict under (kind, params).
+        """
+        if not self.enabled:
+            return
+        key = self._key(kind, params)
+        arrays = arrays or {}
+        files = {}
+        for name, array in arrays.items():
+            path = os.path.join(self.arrays_dir, f"{key}_{name}.npy")
+            # Written under a temporary name and renamed, so readers never see half a file.
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(temp_path, path)
+            files[name] = path
+
+        meta = json.dumps(meta or {})
+        # Meta counts too, so entries without arrays (results) are evicted like the others.
+        size = sum(array.nbytes for array in arrays.values()) + len(meta)
+        with self.lock:
+            db = self._open()
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, self.namespace, kind, meta, size, time.time()))
+            db.execute("DELETE FROM arrays WHERE key = ?", (key,))
+            db.executemany("INSERT INTO arrays VALUES (?, ?, ?)", [(key, name, path) for name, path in files.items()])
+            self._evict(db)
+            db.commit()
+
+    def put_async(self, kind, params, arrays=None, meta=None):
+        """
+        Like put(), but written by the background writer. The arrays must not be
+        modified afterwards.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, daemon=True)
+                self.writer.start()
+        try:
+            self.writes.put_nowait((kind, params, arrays, meta))
+        except queue.Full:
+            logger.debug("Feature cache: writer is behind, dropping a %s entry.", kind)
+
+    def _write_loop(self):
+        while True:
+            kind, params, arrays, meta = self.writes.get()
+            try:
+                self.put(kind, params, arrays, meta)
+            except Exception as e:
+                logger.warning("Feature cache: could not store %s entry: %s", kind, e)
+            finally:
+                self.writes.task_done()
+
+    def flush(self):
+        """
+        Blocks until every entry handed to put_async() has been written.
+        """
+        self.writes.join()
+
+    def _evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        while total > self.max_bytes:
+            key, size = db.execute("SELECT key, bytes FROM entries ORDER BY last_used LIMIT 1").fetchone()
+            self._delete(db, key)
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            rows = self._open().execute(
+                "SELECT kind, COUNT(*), COALESCE(SUM(bytes), 0) FROM entries GROUP BY kind").fetchall()
+        return {kind: {"entries": count, "bytes": size} for kind, count, size in rows}
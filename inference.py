@@ -1,21 +1,127 @@
-import os, re, cv2, torch
+import functools, itertools, os, cv2, threading, time, torch
+import numpy as np
 from typing import Union
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
+from PIL import Image
+from transformers import __version__ as transformers_version
+from transformers import (Qwen2_5_VLForConditionalGeneration, AutoConfig, AutoProcessor, BitsAndBytesConfig, LogitsProcessor,
+                          LogitsProcessorList, StoppingCriteria, StoppingCriteriaList)
 from qwen_vl_utils import process_vision_info
+from annotation import draw_annotations, extract_annotations
+from feature_cache import FeatureCache
+from memory_guard import GPUMemoryExhausted, MemoryGuard
+from telemetry import (ACCEPTED_DRAFT_TOKENS, DECODE_TOKENS_PER_SECOND, DRAFT_TOKENS, GENERATED_TOKENS,
+                       THINKING_BUDGET_FORCED, logger, observe_stage, record_gpu_memory, stage_timer)
+
+MAX_NEW_TOKENS = 768
+# Tokens kept free for the answer when the thinking budget is derived from a latency SLA.
+ANSWER_RESERVE_TOKENS = 96
+# Prompt length without image tokens, assumed when planning memory before tokenization.
+TEXT_TOKENS_ESTIMATE = 256
+
+
+class FirstTokenTimer(StoppingCriteria):
+    """
+    Never stops generation; records when the first token is ready so that
+    generate time can be split into prefill and decode.
+    """
+    def __init__(self):
+        self.first_token_time = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_time is None:
+            # One sync per request so the timestamp reflects finished GPU work.
+            if input_ids.is_cuda:
+                torch.cuda.synchronize(input_ids.device)
+            self.first_token_time = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class ThinkingBudgetProcessor(LogitsProcessor):
+    """
+    Forces "</think><answer>" into every sequence that has produced `budget`
+    reasoning tokens without closing its thinking section itself, so the rest
+    of max_new_tokens goes to the answer.
+
+    forced_ids and close_ids are the token ids of "</think><answer>" and
+    "</think>", encoded once by the caller: the tokenizer is shared with
+    preprocessing threads and must not be used during generate.
+    """
+    def __init__(self, forced_ids, close_ids, prompt_length, budget):
+        self.forced_ids = forced_ids
+        self.close_ids = close_ids
+        self.prompt_length = prompt_length
+        self.budget = budget
+        self.closed = set()
+        self.forced_rows = set()
+
+    def __call__(self, input_ids, scores):
+        generated = input_ids.shape[1] - self.prompt_length
+        # Position inside the forced sequence; derived from the length alone so that
+        # assisted decoding, which may call this for several positions, stays consistent.
+        step = generated - self.budget
+        for row in range(input_ids.shape[0]):
+            if row in self.closed:
+                continue
+            if generated > 0 and step <= 0:
+                tail = input_ids[row, -len(self.close_ids) - 2:].tolist()
+                width = len(self.close_ids)
+                if any(tail[i:i + width] == self.close_ids for i in range(len(tail) - width + 1)):
+                    self.closed.add(row)
+                    continue
+            if 0 <= step < len(self.forced_ids):
+                self.forced_rows.add(row)
+                forced_id = self.forced_ids[step]
+                scores[row] = float("-inf")
+                scores[row, forced_id] = 0.0
+        return scores
+
+
+def parse_assistant(spec):
+    """
+    Parse an assisted-decoding spec into (kind, value).
+
+        "" or "none"           plain generate
+        "prompt_lookup"        n-gram drafting against the prompt, 10 tokens per draft
+        "prompt_lookup:5"      the same with 5 tokens per draft
+        anything else          model id of a smaller draft model sharing the tokenizer
+    """
+    spec = (spec or "").strip()
+    if spec.lower() in ["", "none"]:
+        return None, None
+    if spec.lower().startswith("prompt_lookup"):
+        _, _, num_tokens = spec.partition(":")
+        return "prompt_lookup", int(num_tokens or 10)
+    return "draft_model", spec
+
 
 class SimpleInference:
     """
     A class for performing inference using Hugging Face models.
     """
     
-    def __init__(self, model_id="BAAI/RoboBrain2.0-3B"):
+    def __init__(self, model_id="BAAI/RoboBrain2.0-3B", cache_dir=None, assistant=None, thinking_budget=None,
+                 feature_cache_dir=None, feature_cache_max_bytes=2 * 2**30):
         """
         Initialize the model and processor.
         
         Args:
             model_id (str): Path or Hugging Face model identifier (default: "BAAI/RoboBrain2.0-7B")
+            cache_dir (str): Optional directory where the resolved processor and model config are
+                saved after the first load. Later loads read them from there and skip the Hub.
+            assistant (str): Optional assisted-decoding spec, see parse_assistant(). Drafted tokens
+                are verified by this model, so greedy outputs are the same as with plain generate.
+            thinking_budget (int): Default cap on reasoning tokens when thinking is enabled;
+                None lets the model think for up to max_new_tokens.
+            feature_cache_dir (str): Optional directory of the warm-restart FeatureCache, which keeps
+                preprocessed pixels, visual embeddings and greedy (do_sample=False) results across
+                restarts for the images of requests made with cache_features=True. It is invalidated
+                when the model or its loading profile changes.
+            feature_cache_max_bytes (int): Disk budget of the feature cache.
         """
-        print("Loading Checkpoint ...")
+        logger.info("Loading Checkpoint ...")
+
+        local_dir = os.path.join(cache_dir, model_id.replace("/", "--")) if cache_dir else None
+        cached = local_dir is not None and os.path.exists(os.path.join(local_dir, "config.json"))
 
         #quantization_config = BitsAndBytesConfig(load_in_8bit=True)
         #quantization_config = BitsAndBytesConfig(
@@ -24,16 +130,73 @@ class SimpleInference:
         #    bnb_4bit_quant_type="nf4"  # Use "nf4" (Normalized Float 4) for best results
         #)
 
+        # safetensors shards are memory-mapped and copied straight to their device.
         self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
             model_id,
+            config=AutoConfig.from_pretrained(local_dir) if cached else None,
             torch_dtype="auto", 
             #quantization_config=quantization_config, 
-            device_map="auto"
+            device_map="auto",
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+            local_files_only=cached
         )
 
-        self.processor = AutoProcessor.from_pretrained(model_id)
+        self.processor = AutoProcessor.from_pretrained(local_dir if cached else model_id)
+        if local_dir is not None and not cached:
+            self.processor.save_pretrained(local_dir)
+            self.model.config.save_pretrained(local_dir)
+            logger.info("Saved processor and config to %s", local_dir)
+        # Batched generation needs the padding on the left of the prompt.
+        self.processor.tokenizer.padding_side = "left"
+        # Token counts and timing of the most recent generate call, see _generate().
+        self.last_stats = {}
+        # Token ids used by ThinkingBudgetProcessor, encoded once here rather than per request.
+        tokenizer = self.processor.tokenizer
+        self.think_forced_ids = tokenizer.encode("</think><answer>", add_special_tokens=False)
+        self.think_close_ids = tokenizer.encode("</think>", add_special_tokens=False)
+
+        # --- Assisted decoding ---
+        self.assistant = assistant
+        self.assistant_kwargs = self._load_assistant(assistant)
+        # Only single-sequence generate calls are assisted; set False to compare against plain decoding.
+        self.use_assistant = bool(self.assistant_kwargs)
+        # Input lengths of every forward pass of the target model during the current generate call.
+        # A verification step feeds the last token plus the drafted ones, which is how drafts are counted.
+        self._forward_lengths = None
+        self.model.register_forward_pre_hook(self._record_forward, with_kwargs=True)
+        # Requests arrive on server worker threads; only one may use the GPU at a time,
+        # while preprocessing of the others proceeds in parallel.
+        self.generate_lock = threading.Lock()
+        # Total seconds spent inside generate, for GPU utilisation in the throughput benchmark.
+        self.generate_busy_s = 0.0
+
+        # --- Thinking budget ---
+        self.thinking_budget = thinking_budget
+        # Running estimates used to turn a latency SLA into a budget; refined after every request.
+        self.prefill_estimate_s = 0.5
+        self.decode_rate_estimate = 30.0
+
+        # --- GPU memory admission control ---
+        # Oversized images are downscaled and requests wait for memory instead of failing with OOM.
+        self.memory_guard = None
+        if torch.cuda.is_available():
+            self.memory_guard = MemoryGuard(torch, self.model.config, dtype_bytes=self.model.dtype.itemsize)
+
+        # --- Warm-restart feature cache ---
+        self.feature_cache = None
+        # Cache keys of the images in the generate call in progress, for the vision tower,
+        # and the embeddings it computed for them, stored once the generate lock is released.
+        self._visual_keys = None
+        self._pending_embeds = None
+        self._cache_embeddings = True
+        if feature_cache_dir:
+            self.feature_cache = FeatureCache(feature_cache_dir, self._loading_profile(model_id), feature_cache_max_bytes)
+            visual = self.model.visual
+            visual.forward = functools.partial(self._cached_visual_forward, visual.forward)
         
-    def inference(self, text:str, image: Union[list,str], task="general", plot=False, enable_thinking=True, do_sample=True, temperature=0.7):
+    def inference(self, text:str, image: Union[list,str], task="general", plot=False, enable_thinking=True, do_sample=True, temperature=0.7,
+                  thinking_budget=None, latency_sla_s=None, cache_features=False):
         """Perform inference with text and images input.
         Args:
             text (str): The input text prompt.
@@ -42,41 +205,452 @@ class SimpleInference:
             enable_thinking (bool): Whether to enable thinking mode.
             do_sample (bool): Whether to use sampling during generation.
             temperature (float): Temperature for sampling.
+            thinking_budget (int): Maximum reasoning tokens before the answer is forced; overrides the default.
+            latency_sla_s (float): Target end-to-end generate time; picks the thinking budget when none is given.
+            cache_features (bool): Use the feature cache for these images. Only worth it for images that
+                will be sent again, e.g. stored ones; one-off uploads would only fill the cache.
         """
 
         if isinstance(image, str):
             image = [image]
 
+        self._check_request(task, image)
+
+        result_key = self._result_key(text, image, task, enable_thinking, do_sample, thinking_budget, latency_sla_s,
+                                      cache_features)
+        result = self._cached_result(result_key)
+        if result is not None:
+            if plot:
+                self._plot(image[0], task, result["answer"])
+            return result
+
+        max_pixels = self._plan_max_pixels([image])
+        while True:
+            inputs = self._to_device(self._prepare_inputs([text], [image], task, enable_thinking, max_pixels,
+                                                          cache_features))
+
+            # Inference
+            logger.debug("Running inference ...")
+            budget = self._resolve_thinking_budget(enable_thinking, thinking_budget, latency_sla_s)
+            try:
+                generated_ids_trimmed = self._generate(inputs, thinking_budget=budget, do_sample=do_sample, temperature=temperature)
+                break
+            except GPUMemoryExhausted:
+                del inputs
+                retry_pixels = self._retry_max_pixels(image, max_pixels)
+                if retry_pixels is None:
+                    raise
+                max_pixels = retry_pixels
+
+        result = self._decode_outputs(generated_ids_trimmed, enable_thinking)[0]
+        self._store_result(result_key, result, max_pixels)
+        if plot:
+            self._plot(image[0], task, result["answer"])
+        return result
+
+    def _resolve_thinking_budget(self, enable_thinking, thinking_budget=None, latency_sla_s=None):
+        """
+        Pick the reasoning-token budget for one request: an explicit budget wins,
+        then one derived from the latency SLA and the measured prefill time and
+        decode speed, then the default. None means unlimited.
+        """
+        if not enable_thinking:
+            return None
+        if thinking_budget is None and latency_sla_s is not None:
+            decode_s = latency_sla_s - self.prefill_estimate_s
+            thinking_budget = int(decode_s * self.decode_rate_estimate) - ANSWER_RESERVE_TOKENS
+        if thinking_budget is None:
+            thinking_budget = self.thinking_budget
+        if thinking_budget is None:
+            return None
+        return max(0, min(thinking_budget, MAX_NEW_TOKENS - ANSWER_RESERVE_TOKENS))
+
+    def _check_request(self, task, image):
         assert task in ["general", "pointing", "affordance", "trajectory", "grounding", "verify", "object"], f"Invalid task type: {task}. Supported tasks are 'general', 'pointing', 'affordance', 'trajectory', 'grounding'."
         assert task == "general" or (task in ["pointing", "affordance", "trajectory", "grounding", "verify", "object"] and len(image) == 1), "Pointing, affordance, grounding, verify, object, and trajectory tasks require exactly one image."
 
+    def _visual_tokens(self, image):
+        """
+        Visual tokens the processor will produce for local image paths, from their
+        headers alone. Returns None when a size is unknown (e.g. URLs).
+        """
+        image_processor = self.processor.image_processor
+        unit = image_processor.patch_size * image_processor.merge_size
+        max_pixels = getattr(image_processor, "max_pixels", None) or 12845056
+        total = 0
+        for path in image:
+            if path.startswith("http"):
+                return None
+            try:
+                with Image.open(path) as img:
+                    width, height = img.size
+            except (OSError, ValueError):
+                return None
+            total += min(width * height, max_pixels) // (unit * unit)
+        return total
+
+    def _plan_max_pixels(self, images):
+        """
+        Per-image max_pixels that keeps a request within the GPU memory guard, or
+        None when the images can be used at their normal size.
+        """
+        if self.memory_guard is None:
+            return None
+        requested = [self._visual_tokens(image) for image in images]
+        if any(tokens is None for tokens in requested) or not requested:
+            return None
+        largest = max(requested)
+        allowed = self.memory_guard.plan_visual_tokens(largest, TEXT_TOKENS_ESTIMATE, MAX_NEW_TOKENS, batch=len(images))
+        if allowed >= largest:
+            return None
+        image_processor = self.processor.image_processor
+        unit = image_processor.patch_size * image_processor.merge_size
+        images_per_prompt = max(len(image) for image in images)
+        return max(image_processor.min_pixels, allowed * unit * unit // images_per_prompt)
+
+    def _retry_max_pixels(self, image, max_pixels):
+        """
+        New max_pixels for retrying a request that ran out of GPU memory with
+        max_pixels, or None when the image cannot shrink any further.
+        """
+        retry_pixels = self._plan_max_pixels([image])
+        if retry_pixels is None or (max_pixels is not None and retry_pixels >= max_pixels):
+            return None
+        logger.warning("Retrying with max_pixels=%d after running out of GPU memory.", retry_pixels)
+        return retry_pixels
+
+    def _prepare_inputs(self, texts, images, task, enable_thinking, max_pixels=None, cache_features=False):
+        """
+        CPU half of a request: prompt formatting, chat template, image loading and
+        resizing, and tokenization. images holds one list of image paths per text;
+        max_pixels, when given, caps the resolution of every image. With
+        cache_features, preprocessed pixels come from and go to the feature cache.
+        Returns the processor output as CPU tensors.
+        """
+        batch_messages = []
+        for text, image in zip(texts, images):
+            text = self._format_prompt(text, task)
+            logger.debug("##### INPUT #####\n%s\n###############", text)
+            batch_messages.append(self._build_messages(text, image, max_pixels))
+        batch_texts = [self._apply_template(messages, enable_thinking) for messages in batch_messages]
+
+        image_keys = self._image_keys(images, max_pixels) if cache_features else None
+        cached = self._cached_pixels(image_keys)
+        if cached is not None:
+            with stage_timer("tokenize"):
+                inputs = self._tokenize_with_pixels(batch_texts, *cached)
+        else:
+            with stage_timer("vision_preprocess"):
+                image_inputs, video_inputs = process_vision_info(batch_messages)
+            with stage_timer("tokenize"):
+                inputs = self.processor(
+                    text=batch_texts,
+                    images=image_inputs,
+                    videos=video_inputs,
+                    padding=True,
+                    return_tensors="pt",
+                )
+            self._store_pixels(image_keys, inputs)
+        if image_keys is not None:
+            # Not a model input; _generate() pops it and hands it to the vision tower.
+            inputs["image_keys"] = image_keys
+        return inputs
+
+    # --- Feature cache ---
+    def _loading_profile(self, model_id):
+        """
+        Everything that changes preprocessing or model outputs; the feature cache
+        is invalidated whenever any of it differs from the run that filled it.
+        """
+        config = self.model.config
+        return {
+            "model_id": model_id,
+            "revision": getattr(config, "_commit_hash", None),
+            "dtype": str(self.model.dtype),
+            "quantization": getattr(config, "quantization_config", None),
+            "attention": getattr(config, "_attn_implementation", None),
+            "image_processor": self.processor.image_processor.to_dict(),
+            "transformers": transformers_version,
+            "torch": torch.__version__,
+        }
+
+    def _image_keys(self, images, max_pixels):
+        """
+        Feature-cache keys of every image of the batch in processor order, with
+        None for images that cannot be cached (URLs, unreadable files). None
+        when the cache is off.
+        """
+        if self.feature_cache is None or not self.feature_cache.enabled:
+            return None
+        keys = []
+        for path in itertools.chain.from_iterable(images):
+            try:
+                keys.append(None if path.startswith("http") else
+                            {"image": self.feature_cache.file_hash(path), "max_pixels": max_pixels})
+            except OSError:
+                keys.append(None)
+        return keys
+
+    def _cached_pixels(self, image_keys):
+        """
+        (pixel_values, image_grid_thw) of the whole batch from the cache, or None
+        unless every image is cached.
+        """
+        if not image_keys or None in image_keys:
+            return None
+        pixel_values, grids = [], []
+        for key in image_keys:
+            entry = self.feature_cache.get("pixels", key)
+            if entry is None:
+                return None
+            arrays, _ = entry
+            pixel_values.append(torch.from_numpy(np.array(arrays["pixel_values"])))
+            grids.append(torch.from_numpy(np.array(arrays["image_grid_thw"])))
+        return torch.cat(pixel_values), torch.cat(grids)
+
+    def _store_pixels(self, image_keys, inputs):
+        if not image_keys or "image_grid_thw" not in inputs or len(inputs["image_grid_thw"]) != len(image_keys):
+            return
+        grids = inputs["image_grid_thw"]
+        # pixel_values holds the patches of all images one after another.
+        ends = grids.prod(-1).cumsum(0).tolist()
+        for key, grid, start, end in zip(image_keys, grids, [0, *ends], ends):
+            if key is not None:
+                self.feature_cache.put_async("pixels", key, {"pixel_values": inputs["pixel_values"][start:end].numpy(),
+                                                             "image_grid_thw": grid[None].numpy()})
+
+    def _tokenize_with_pixels(self, batch_texts, pixel_values, image_grid_thw):
+        """
+        Tokenize prompts whose images were preprocessed earlier. Every image
+        placeholder is expanded to that image's number of tokens, as the
+        processor itself does.
+        """
+        merge_length = self.processor.image_processor.merge_size ** 2
+        image_token = self.processor.image_token
+        counts = iter((image_grid_thw.prod(-1) // merge_length).tolist())
+        expanded = []
+        for text in batch_texts:
+            first, *rest = text.split(image_token)
+            expanded.append(first + "".join(image_token * next(counts) + part for part in rest))
+        inputs = self.processor.tokenizer(expanded, padding=True, return_tensors="pt")
+        inputs["pixel_values"] = pixel_values
+        inputs["image_grid_thw"] = image_grid_thw
+        return inputs
+
+    def _cached_visual_forward(self, original, hidden_states, *args, **kwargs):
+        """
+        Forward of the vision tower that takes embeddings from the feature cache.
+        Only images without a cached embedding go through the tower; theirs are
+        kept in self._pending_embeds and stored by _generate() after the call.
+        """
+        if "grid_thw" in kwargs:
+            grid_thw = kwargs.pop("grid_thw")
+        else:
+            grid_thw, args = args[0], args[1:]
+        keys = self._visual_keys
+        if not self._cache_embeddings or keys is None or self._pending_embeds is None or len(keys) != len(grid_thw):
+            return original(hidden_states, *args, grid_thw=grid_thw, **kwargs)
+
+        merge_length = self.processor.image_processor.merge_size ** 2
+        patches = grid_thw.prod(-1).tolist()
+        embeds = [None] * len(keys)
+        for i, key in enumerate(keys):
+            entry = self.feature_cache.get("embeds", key) if key is not None else None
+            if entry is not None and entry[0]["embeds"].shape[0] == patches[i] // merge_length:
+                arrays, meta = entry
+                tensor = torch.from_numpy(np.array(arrays["embeds"]))
+                if meta["dtype"] == "bfloat16":
+                    tensor = tensor.view(torch.bfloat16)
+                embeds[i] = tensor.to(hidden_states.device)
+
+        missing = [i for i, tensor in enumerate(embeds) if tensor is None]
+        if missing:
+            starts = [0, *itertools.accumulate(patches)]
+            computed = original(torch.cat([hidden_states[starts[i]:starts[i + 1]] for i in missing]), *args,
+                                grid_thw=grid_thw[missing], **kwargs)
+            if not torch.is_tensor(computed):
+                # This transformers version returns an output object; leave the embeddings uncached.
+                logger.warning("Vision tower output is not a tensor; visual embeddings will not be cached.")
+                self._cache_embeddings = False
+                if len(missing) == len(keys):
+                    return computed
+                return original(hidden_states, *args, grid_thw=grid_thw, **kwargs)
+
+            counts = [patches[i] // merge_length for i in missing]
+            for i, part in zip(missing, computed.split(counts)):
+                embeds[i] = part
+                if keys[i] is not None:
+                    self._pending_embeds.append((keys[i], part.detach()))
+        return torch.cat(embeds)
+
+    def _store_embeds(self, pending):
+        """
+        Copy embeddings computed during a generate call to the CPU and hand them to
+        the feature cache's writer. Called without the generate lock.
+        """
+        for key, tensor in pending or ():
+            stored = tensor.cpu()
+            # numpy has no bfloat16; the raw bits are kept as int16.
+            dtype = str(stored.dtype).replace("torch.", "")
+            if stored.dtype == torch.bfloat16:
+                stored = stored.view(torch.int16)
+            self.feature_cache.put_async("embeds", key, {"embeds": stored.numpy()}, {"dtype": dtype})
+
+    def _result_key(self, text, image, task, enable_thinking, do_sample, thinking_budget, latency_sla_s,
+                    cache_features=False):
+        """
+        Cache key of a cacheable request whose answer is deterministic (greedy
+        decoding, no SLA-derived budget), or None. The key covers everything that
+        decides the answer, including the generation settings and the assistant.
+        """
+        if not cache_features or self.feature_cache is None or do_sample or latency_sla_s is not None:
+            return None
+        image_keys = self._image_keys([image], None)
+        if not image_keys or None in image_keys:
+            return None
+        return {
+            "images": [key["image"] for key in image_keys],
+            "text": text,
+            "task": task,
+            "enable_thinking": enable_thinking,
+            "thinking_budget": self._resolve_thinking_budget(enable_thinking, thinking_budget),
+            "do_sample": do_sample,
+            "max_new_tokens": MAX_NEW_TOKENS,
+            "generation_config": self.model.generation_config.to_json_string(use_diff=True),
+            "assistant": self.assistant if self.use_assistant else None,
+        }
+
+    def _cached_result(self, result_key):
+        """
+        The cached answer for result_key, or None. A hit replaces last_stats with a
+        cache-hit marker, so nothing reports the stats of an earlier generate.
+        """
+        if result_key is None:
+            return None
+        entry = self.feature_cache.get("result", result_key)
+        if entry is None:
+            return None
+        self.last_stats = {"cache_hit": True}
+        return dict(entry[1])
+
+    def _store_result(self, result_key, result, max_pixels):
+        # Answers computed on a downscaled image are not the canonical ones.
+        if result_key is not None and max_pixels is None:
+            self.feature_cache.put_async("result", result_key, meta=dict(result))
+
+    def _to_device(self, inputs):
+        """
+        Copy prepared inputs to the GPU. The tensors are staged in pinned host memory
+        so the copies are asynchronous and the CPU does not wait for them; work queued
+        on the same CUDA stream afterwards (generate) is ordered after the copy.
+        """
+        with stage_timer("h2d"):
+            for key, value in inputs.items():
+                if torch.is_tensor(value):
+                    inputs[key] = value.pin_memory().to("cuda", non_blocking=True)
+        return inputs
+
+    def _decode_outputs(self, generated_ids_trimmed, enable_thinking):
+        """
+        Decode generated ids into one {"thinking", "answer"} dict per sequence.
+        """
+        with stage_timer("parse"):
+            output_texts = self.processor.batch_decode(
+                generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+            )
+
+            results = []
+            for output in output_texts:
+                thinking_text, answer_text = self._split_output(output, enable_thinking)
+                results.append({"thinking": thinking_text, "answer": answer_text})
+        return results
+
+    def _plot(self, image_path, task, answer_text):
+        """
+        Draw the answer of a spatial task onto its image and save it under result/.
+        """
+        if task not in ["pointing", "affordance", "trajectory", "grounding"]:
+            return
+        logger.debug("Plotting enabled. Drawing results on the image ...")
+        # extract points, boxes, or trajectories based on the task
+
+        with stage_timer("plot"):
+            annotations = extract_annotations(task, answer_text)
+            logger.debug("Extracted %s annotations: %s", task, annotations)
+            image_name_to_save = os.path.basename(image_path).replace(".", f"_with_{task}_annotated.")
+
+            os.makedirs("result", exist_ok=True)
+            image_path_to_save = os.path.join("result", image_name_to_save)
+
+            self.draw_on_image(image_path, output_path=image_path_to_save, **annotations)
+
+    def _load_assistant(self, spec):
+        """
+        Build the extra generate() kwargs for the assisted-decoding spec.
+        """
+        kind, value = parse_assistant(spec)
+        if kind is None:
+            return {}
+        if kind == "prompt_lookup":
+            logger.info("Assisted decoding: prompt lookup with %d draft tokens.", value)
+            return {"prompt_lookup_num_tokens": value}
+
+        logger.info("Assisted decoding: loading draft model %s ...", value)
+        draft = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+            value,
+            torch_dtype="auto",
+            device_map="auto",
+            use_safetensors=True,
+            low_cpu_mem_usage=True
+        )
+        if draft.config.vocab_size != self.model.config.vocab_size:
+            raise ValueError(f"Draft model {value} does not share the vocabulary of the target model.")
+        return {"assistant_model": draft}
+
+    def _record_forward(self, module, args, kwargs):
+        if self._forward_lengths is not None:
+            input_ids = kwargs.get("input_ids")
+            if input_ids is None:
+                input_ids = kwargs.get("inputs_embeds")
+            if input_ids is not None:
+                self._forward_lengths.append(input_ids.shape[1])
+
+    def _format_prompt(self, text, task):
+        """
+        Wrap the user text in the task-specific instruction template.
+        """
         if task == "pointing":
-            print("Pointing task detected. We automatically add a pointing prompt for inference.")
+            logger.debug("Pointing task detected. We automatically add a pointing prompt for inference.")
             text = f"{text}. Your answer should be formatted as a list of tuples, i.e. [(x1, y1), (x2, y2), ...], where each tuple contains the x and y coordinates of a point satisfying the conditions above. The coordinates should indicate the normalized pixel locations of the points in the image."
         elif task == "affordance":
-            print("Affordance task detected. We automatically add an affordance prompt for inference.")
+            logger.debug("Affordance task detected. We automatically add an affordance prompt for inference.")
             text = f"You are a robot using the joint control. The task is \"{text}\". Please predict a possible affordance area of the end effector. Your answer MUST be only a bounding box in the format [x1, y1, x2, y2]."
         elif task == "trajectory":
-            print("Trajectory task detected. We automatically add a trajectory prompt for inference.")
+            logger.debug("Trajectory task detected. We automatically add a trajectory prompt for inference.")
             text = f"You are a robot using the joint control. The task is \"{text}\". Please predict up to 10 key trajectory points to complete the task. Your answer should be formatted as a list of tuples, i.e. [[x1, y1], [x2, y2], ...], where each tuple contains the x and y coordinates of a point."
         elif task == "grounding":
-            print("Grounding task detected. We automatically add a grounding prompt for inference.")
+            logger.debug("Grounding task detected. We automatically add a grounding prompt for inference.")
             text = f"Please provide the bounding box coordinate of the region this sentence describes: {text}."
         elif task == "verify":
-            print("Verify task detected. We automatically add a verification prompt for inference.")
+            logger.debug("Verify task detected. We automatically add a verification prompt for inference.")
             text = f"Please identify the object in the image. Compare the identified object with the object from the prompt: {text}. Your answer should be 'same' or 'different'." 
         elif task == "object":
-            print("Object task detected. we automatically add an object keyword detection for the prompt.")
+            logger.debug("Object task detected. we automatically add an object keyword detection for the prompt.")
             text = f"from the prompt : \"{text}\". What am I looking for?. use the prompt itself as reference, don't look at the image. your answer should be the object's name NOT the object's feature."
-        print(F"##### INPUT #####\n{text}\n###############")
+        return text
 
-        messages = [
+    def _build_messages(self, text, image, max_pixels=None):
+        """
+        Build the chat messages for one prompt and its image paths.
+        """
+        return [
             {
                 "role": "user",
                 "content": [
                     *[
                         {"type": "image", 
-                         "image": path if path.startswith("http") else f"file://{path}"
+                         "image": path if path.startswith("http") else f"file://{path}",
+                         **({"max_pixels": max_pixels} if max_pixels else {})
                         } for path in image
                     ],
                     {"type": "text", "text": f"{text}"},
@@ -84,99 +658,189 @@ class SimpleInference:
             },
         ]
 
+    def _apply_template(self, messages, enable_thinking):
+        """
+        Render the chat template and open (or skip) the thinking section.
+        """
         text = self.processor.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
         )
 
         if enable_thinking:
-            print("Thinking enabled.")
-            text = f"{text}<think>"
-        else:
-            print("Thinking disabled.")
-            text = f"{text}<think></think><answer>"
-
+            logger.debug("Thinking enabled.")
+            return f"{text}<think>"
+        logger.debug("Thinking disabled.")
+        return f"{text}<think></think><answer>"
 
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self.processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
-        inputs = inputs.to("cuda")
+    def _split_output(self, output, enable_thinking):
+        """
+        Split a decoded generation into (thinking, answer) text.
+        """
+        if enable_thinking:
+            thinking_text, closed, answer_text = output.partition("</think>")
+            thinking_text = thinking_text.replace("<think>", "").strip()
+            if not closed:
+                # max_new_tokens ran out while the model was still reasoning.
+                logger.warning("Generation ended inside the thinking section; returning an empty answer.")
+            answer_text = answer_text.replace("<answer>", "").replace("</answer>", "").strip()
+        else:
+            thinking_text = ""
+            answer_text = output.replace("<answer>", "").replace("</answer>", "").strip()
+        return thinking_text, answer_text
 
-        # Inference
-        print("Running inference ...")
+    def _generate(self, inputs, thinking_budget=None, **generate_kwargs):
+        """
+        Run generate on prepared inputs and return the new token ids per sequence.
+        With a thinking_budget, sequences that reason for that many tokens are made
+        to close their thinking section and answer, see ThinkingBudgetProcessor.
+        Prefill and decode time, token counts and GPU memory are recorded in
+        self.last_stats and in the telemetry metrics. Single-sequence calls use
+        assisted decoding when it is configured and self.use_assistant is set.
+        """
+        image_keys = inputs.pop("image_keys", None)
+        timer = FirstTokenTimer()
+        budget_processor = None
+        if thinking_budget is not None:
+            budget_processor = ThinkingBudgetProcessor(self.think_forced_ids, self.think_close_ids,
+                                                       inputs.input_ids.shape[1], thinking_budget)
+            generate_kwargs["logits_processor"] = LogitsProcessorList([budget_processor])
+        # transformers only supports assisted generation with a batch size of one.
+        assisted = self.use_assistant and bool(self.assistant_kwargs) and inputs.input_ids.shape[0] == 1
+        if assisted:
+            generate_kwargs.update(self.assistant_kwargs)
 
-        with torch.inference_mode():
-            generated_ids = self.model.generate(**inputs, max_new_tokens=768, do_sample=do_sample, temperature=temperature)
+        merge_size = self.processor.image_processor.merge_size
+        visual_tokens = int(inputs.image_grid_thw.prod(-1).sum()) // (merge_size ** 2) if "image_grid_thw" in inputs else 0
+        batch_size, prompt_length = inputs.input_ids.shape
+        with self.generate_lock:
+            if self.memory_guard is not None:
+                # Inside the lock: what matters is the headroom once the previous request has finished.
+                # The lock is released while admit waits, so other requests are not held up meanwhile.
+                self.memory_guard.admit(self.memory_guard.estimate(
+                    visual_tokens // batch_size, prompt_length - visual_tokens // batch_size, MAX_NEW_TOKENS, batch_size),
+                    lock=self.generate_lock)
+            self._forward_lengths = []
+            self._visual_keys = image_keys
+            self._pending_embeds = [] if image_keys is not None else None
+            start = time.perf_counter()
+            out_of_memory = False
+            try:
+                with torch.inference_mode():
+                    generated_ids = self.model.generate(
+                        **inputs, max_new_tokens=MAX_NEW_TOKENS, stopping_criteria=StoppingCriteriaList([timer]), **generate_kwargs
+                    )
+            except torch.cuda.OutOfMemoryError:
+                out_of_memory = True
+            finally:
+                forward_lengths, self._forward_lengths = self._forward_lengths, None
+                pending_embeds, self._pending_embeds = self._pending_embeds, None
+                self._visual_keys = None
+            if out_of_memory:
+                # Outside the except block, so the failed call's tensors are no longer referenced
+                # by the traceback and the cache can really be released.
+                if self.memory_guard is not None:
+                    self.memory_guard.recover_from_oom()
+                else:
+                    torch.cuda.empty_cache()
+                raise GPUMemoryExhausted("CUDA ran out of memory during generate.")
+            end = time.perf_counter()
+            self.generate_busy_s += end - start
+            if self.memory_guard is not None:
+                self.memory_guard.record_success()
+        self._store_embeds(pending_embeds)
         generated_ids_trimmed = [
             out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
         ]
-        output_text = self.processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )
 
-        if enable_thinking:
-            thinking_text = output_text[0].split("</think>")[0].replace("<think>", "").strip()
-            answer_text = output_text[0].split("</think>")[1].replace("<answer>", "").replace("</answer>", "").strip()
-        else:
-            thinking_text = ""
-            answer_text = output_text[0].replace("<answer>", "").replace("</answer>", "").strip()
+        first_token_time = timer.first_token_time or end
+        prefill_time, decode_time = first_token_time - start, end - first_token_time
 
-        if plot and task in ["pointing", "affordance", "trajectory", "grounding"]:
-            print("Plotting enabled. Drawing results on the image ...")
-            # extract points, boxes, or trajectories based on the task
+        pad_token_id = self.processor.tokenizer.pad_token_id
+        output_tokens = sum(int((ids != pad_token_id).sum()) for ids in generated_ids_trimmed)
+        # The first token of every sequence comes out of prefill.
+        decode_tokens = max(0, output_tokens - len(generated_ids_trimmed))
 
-            plot_points, plot_boxes, plot_trajectories = None, None, None
-            
-            if task == "trajectory":
-                # Extract trajectory points
-                trajectory_pattern = r'(\d+),\s*(\d+)'
-                trajectory_points = re.findall(trajectory_pattern, answer_text)
-                plot_trajectories =  [[(int(x), int(y)) for x, y in trajectory_points]]
-                print(f"Extracted trajectory points: {plot_trajectories}")
-                image_name_to_save = os.path.basename(image[0]).replace(".", "_with_trajectory_annotated.")
-            elif task == "pointing":
-                # Extract points
-                point_pattern = r'\(\s*(\d+)\s*,\s*(\d+)\s*\)'
-                points = re.findall(point_pattern, answer_text)
-                plot_points =  [(int(x), int(y)) for x, y in points]
-                print(f"Extracted points: {plot_points}")
-                image_name_to_save = os.path.basename(image[0]).replace(".", "_with_pointing_annotated.")
-            elif task == "affordance":
-                # Extract bounding boxes
-                box_pattern = r'\[\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\]'
-                boxes = re.findall(box_pattern, answer_text)
-                plot_boxes =  [[int(x1), int(y1), int(x2), int(y2)] for x1, y1, x2, y2 in boxes]
-                print(f"Extracted bounding boxes: {plot_boxes}")
-                image_name_to_save = os.path.basename(image[0]).replace(".", "_with_affordance_annotated.")
-            elif task == "grounding":
-                # Extract bounding boxes
-                box_pattern = r'\[\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\]'
-                boxes = re.findall(box_pattern, answer_text)
-                plot_boxes =  [[int(x1), int(y1), int(x2), int(y2)] for x1, y1, x2, y2 in boxes]
-                print(f"Extracted bounding boxes: {plot_boxes}")
-                image_name_to_save = os.path.basename(image[0]).replace(".", "_with_grounding_annotated.")
+        self.last_stats = {
+            "input_tokens": int(inputs.attention_mask.sum()),
+            "visual_tokens": visual_tokens,
+            "output_tokens": output_tokens,
+            "prefill_s": prefill_time,
+            "decode_s": decode_time,
+            "generate_s": end - start,
+            "tokens_per_s": decode_tokens / decode_time if decode_time > 0 else 0.0,
+            "target_forwards": len(forward_lengths),
+        }
+        if budget_processor is not None:
+            self.last_stats.update({
+                "thinking_budget": thinking_budget,
+                "thinking_forced": len(budget_processor.forced_rows),
+            })
+            THINKING_BUDGET_FORCED.inc(len(budget_processor.forced_rows))
 
-            os.makedirs("result", exist_ok=True)
-            image_path_to_save = os.path.join("result", image_name_to_save)
+        # Exponential moving averages feeding _resolve_thinking_budget().
+        self.prefill_estimate_s = 0.8 * self.prefill_estimate_s + 0.2 * prefill_time
+        if decode_tokens and decode_time > 0:
+            self.decode_rate_estimate = 0.8 * self.decode_rate_estimate + 0.2 * (decode_tokens / len(generated_ids_trimmed) / decode_time)
+        if assisted:
+            # Besides the drafts, the target sees the prompt once and then one token per later
+            # forward (the one it produced itself). Every forward yields that one token plus
+            # the draft tokens it accepted.
+            drafted = sum(forward_lengths) - inputs.input_ids.shape[1] - max(0, len(forward_lengths) - 1)
+            accepted = min(drafted, max(0, output_tokens - len(forward_lengths)))
+            self.last_stats.update({
+                "assistant": self.assistant,
+                "drafted_tokens": drafted,
+                "accepted_tokens": accepted,
+                "acceptance_rate": accepted / drafted if drafted else None,
+            })
+            DRAFT_TOKENS.inc(drafted)
+            ACCEPTED_DRAFT_TOKENS.inc(accepted)
 
-            self.draw_on_image(
-                image[0], 
-                points=plot_points, 
-                boxes=plot_boxes, 
-                trajectories=plot_trajectories,
-                output_path=image_path_to_save
-            )
+        observe_stage("prefill", prefill_time)
+        observe_stage("decode", decode_time)
+        GENERATED_TOKENS.inc(output_tokens)
+        if decode_time > 0:
+            DECODE_TOKENS_PER_SECOND.observe(self.last_stats["tokens_per_s"])
+        record_gpu_memory(torch)
+        return generated_ids_trimmed
 
-        return {
-            "thinking": thinking_text,
-            "answer": answer_text
-        }
+    def batch_inference(self, texts: list, images: list, task="pointing", enable_thinking=False, do_sample=True, temperature=0.7,
+                        thinking_budget=None, latency_sla_s=None):
+        """Perform inference on several (text, image) pairs with a single generate call
+        (or a few, when the whole batch would not fit in GPU memory).
+        Args:
+            texts (list): The input text prompts.
+            images (list): One image path per prompt.
+            task (str): The task type shared by every pair in the batch.
+            enable_thinking (bool): Whether to enable thinking mode.
+            do_sample (bool): Whether to use sampling during generation.
+            temperature (float): Temperature for sampling.
+            thinking_budget (int): Maximum reasoning tokens per sequence before the answer is forced.
+            latency_sla_s (float): Target generate time; picks the thinking budget when none is given.
+        Returns:
+            list: One {"thinking", "answer"} dict per pair, in input order.
+        """
+        assert len(texts) == len(images), "batch_inference needs exactly one image per prompt."
+        assert task in ["general", "pointing", "affordance", "trajectory", "grounding", "verify", "object"], f"Invalid task type: {task}."
+
+        chunks = [list(range(len(texts)))]
+        if self.memory_guard is not None:
+            visual_tokens = [self._visual_tokens([image]) or 0 for image in images]
+            estimates = [self.memory_guard.estimate(tokens, TEXT_TOKENS_ESTIMATE, MAX_NEW_TOKENS) for tokens in visual_tokens]
+            chunks = self.memory_guard.split_batch(estimates)
+
+        results = []
+        for chunk in chunks:
+            chunk_images = [[images[i]] for i in chunk]
+            max_pixels = self._plan_max_pixels(chunk_images)
+            inputs = self._to_device(self._prepare_inputs([texts[i] for i in chunk], chunk_images, task, enable_thinking, max_pixels))
+
+            logger.debug("Running batched inference on %d prompts ...", len(chunk))
+            budget = self._resolve_thinking_budget(enable_thinking, thinking_budget, latency_sla_s)
+            generated_ids_trimmed = self._generate(inputs, thinking_budget=budget, do_sample=do_sample, temperature=temperature)
+            results.extend(self._decode_outputs(generated_ids_trimmed, enable_thinking))
+        return results
 
-    
     def draw_on_image(self, image_path, points=None, boxes=None, trajectories=None, output_path=None):
         """
         Draw points, bounding boxes, and trajectories on an image
@@ -194,29 +858,7 @@ class SimpleInference:
             if image is None:
                 raise FileNotFoundError(f"Unable to read image: {image_path}")
             
-            # Draw points
-            if points:
-                for point in points:
-                    x, y = point
-                    cv2.circle(image, (x, y), 10, (0, 0, 255), -1)  # Red solid circle
-            
-            # Draw bounding boxes
-            if boxes:
-                for box in boxes:
-                    x1, y1, x2, y2 = box
-                    cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 2)  # Green box, line width 2
-            
-            # Draw trajectories
-            if trajectories:
-                for trajectory in trajectories:
-                    if len(trajectory) < 2:
-                        continue  # Need at least 2 points to form a trajectory
-                    # Connect trajectory points with lines
-                    for i in range(1, len(trajectory)):
-                        cv2.line(image, trajectory[i-1], trajectory[i], (255, 0, 0), 2)  # Blue line, width 2
-                    # Draw a larger point at the trajectory end
-                    end_x, end_y = trajectory[-1]
-                    cv2.circle(image, (end_x, end_y), 7, (255, 0, 0), -1)  # Blue solid circle, slightly larger
+            draw_annotations(image, points=points, boxes=boxes, trajectories=trajectories)
             
             # Determine output path
             if not output_path:
@@ -225,11 +867,11 @@ class SimpleInference:
             
             # Save the result
             cv2.imwrite(output_path, image)
-            print(f"Annotated image saved to: {output_path}")
+            logger.debug("Annotated image saved to: %s", output_path)
             return output_path
             
         except Exception as e:
-            print(f"Error processing image: {e}")
+            logger.error("Error processing image: %s", e)
             return None
 
 
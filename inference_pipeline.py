@@ -0,0 +1,156 @@
+import queue, threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+
+from memory_guard import GPUMemoryExhausted
+from telemetry import logger
+
+
+class PipelinedInference:
+    """
+    Runs SimpleInference requests as a three-stage pipeline so the GPU never
+    waits for the CPU:
+
+        preprocess pool   chat template, image loading/resizing, tokenization,
+                          pinned-memory staging and an asynchronous copy to the GPU
+                          on a side stream
+        GPU thread        generate, one request at a time
+        decode thread     batch_decode, answer splitting and optional plotting
+
+    While request N decodes, request N+1 is already being prepared and copied.
+    At most max_prepared requests wait on the GPU with their inputs uploaded;
+    beyond that the preprocess workers block, which bounds GPU memory.
+
+    The wrapper exposes the same inference()/batch_inference() methods as
+    SimpleInference, so the API servers use it unchanged.
+    """
+
+    def __init__(self, model, preprocess_workers=2, max_prepared=2):
+        if not hasattr(model, "_prepare_inputs"):
+            raise ValueError("PipelinedInference needs a SimpleInference model.")
+        self.model = model
+        self.workers = ThreadPoolExecutor(max_workers=preprocess_workers, thread_name_prefix="preprocess")
+        # Separate from the preprocess pool so finished requests never queue behind new ones.
+        self.finishers = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode")
+        self.prepared = queue.Queue(maxsize=max_prepared)
+        self.copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.gpu_thread = threading.Thread(target=self._gpu_loop, daemon=True)
+        self.gpu_thread.start()
+        logger.info("Pipelined inference with %d preprocess worker(s).", preprocess_workers)
+
+    def __getattr__(self, name):
+        # last_stats, generate_busy_s, processor, ... come from the wrapped model.
+        return getattr(self.model, name)
+
+    def submit(self, text, image, task="general", plot=False, enable_thinking=True, do_sample=True, temperature=0.7,
+               thinking_budget=None, latency_sla_s=None, cache_features=False):
+        """
+        Queue one request; returns a Future resolving to {"thinking", "answer"}.
+        Arguments mirror SimpleInference.inference.
+        """
+        if isinstance(image, str):
+            image = [image]
+        self.model._check_request(task, image)
+        future = Future()
+        result_key = self.model._result_key(text, image, task, enable_thinking, do_sample, thinking_budget, latency_sla_s,
+                                            cache_features)
+        result = self.model._cached_result(result_key)
+        if result is not None:
+            # Answered from the feature cache without entering the pipeline.
+            if plot:
+                self.model._plot(image[0], task, result["answer"])
+            future.set_result(result)
+            return future
+
+        request = {"text": text, "image": image, "task": task, "plot": plot, "enable_thinking": enable_thinking,
+                   "do_sample": do_sample, "temperature": temperature, "thinking_budget": thinking_budget,
+                   "latency_sla_s": latency_sla_s, "cache_features": cache_features, "result_key": result_key}
+        self.workers.submit(self._prepare, future, request)
+        return future
+
+    def inference(self, text, image, task="general", plot=False, enable_thinking=True, do_sample=True, temperature=0.7,
+                  thinking_budget=None, latency_sla_s=None, cache_features=False):
+        return self.submit(text, image, task=task, plot=plot, enable_thinking=enable_thinking, do_sample=do_sample,
+                           temperature=temperature, thinking_budget=thinking_budget,
+                           latency_sla_s=latency_sla_s, cache_features=cache_features).result()
+
+    def batch_inference(self, texts, images, **kwargs):
+        # Already a single generate call; it shares the GPU with the pipeline through the model's generate lock.
+        return self.model.batch_inference(texts, images, **kwargs)
+
+    # --- Stages ---
+    def _prepare(self, future, request):
+        try:
+            if "max_pixels" not in request:
+                request["max_pixels"] = self.model._plan_max_pixels([request["image"]])
+            inputs = self.model._prepare_inputs([request["text"]], [request["image"]], request["task"],
+                                                request["enable_thinking"], request["max_pixels"],
+                                                request["cache_features"])
+            copied = None
+            if self.copy_stream is not None:
+                # The copy runs on its own stream, concurrently with the generate in progress.
+                with torch.cuda.stream(self.copy_stream):
+                    inputs = self.model._to_device(inputs)
+                    copied = torch.cuda.Event()
+                    copied.record(self.copy_stream)
+            else:
+                inputs = self.model._to_device(inputs)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.prepared.put((future, request, inputs, copied))
+
+    def _gpu_loop(self):
+        while True:
+            item = self.prepared.get()
+            if item is None:
+                return
+            future, request, inputs, copied = item
+            try:
+                if copied is not None:
+                    stream = torch.cuda.current_stream()
+                    stream.wait_event(copied)
+                    # The tensors were allocated on the copy stream but are consumed here.
+                    for value in inputs.values():
+                        if torch.is_tensor(value):
+                            value.record_stream(stream)
+                # Resolved here, so an SLA-derived budget uses the latest speed estimates.
+                budget = self.model._resolve_thinking_budget(request["enable_thinking"], request["thinking_budget"],
+                                                             request["latency_sla_s"])
+                generated_ids = self.model._generate(inputs, thinking_budget=budget, do_sample=request["do_sample"],
+                                                     temperature=request["temperature"])
+            except GPUMemoryExhausted as e:
+                # As in SimpleInference.inference: prepare again at a smaller size, or give up.
+                del inputs
+                retry_pixels = self.model._retry_max_pixels(request["image"], request["max_pixels"])
+                if retry_pixels is None:
+                    future.set_exception(e)
+                else:
+                    request["max_pixels"] = retry_pixels
+                    try:
+                        self.workers.submit(self._prepare, future, request)
+                    except RuntimeError:
+                        # Shutting down; the preprocess pool takes no more work.
+                        future.set_exception(e)
+                continue
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            self.finishers.submit(self._finish, future, request, generated_ids)
+
+    def _finish(self, future, request, generated_ids):
+        try:
+            result = self.model._decode_outputs(generated_ids, request["enable_thinking"])[0]
+            self.model._store_result(request["result_key"], result, request["max_pixels"])
+            if request["plot"]:
+                self.model._plot(request["image"][0], request["task"], result["answer"])
+            future.set_result(result)
+        except Exception as e:
+            future.set_exception(e)
+
+    def close(self):
+        self.workers.shutdown(wait=True)
+        self.prepared.put(None)
+        self.gpu_thread.join()
+        self.finishers.shutdown(wait=True)
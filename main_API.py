@@ -1,74 +1,304 @@
 # main_api_with_pyngrok.py
 
+import asyncio
 import os
 import shutil
+import time
+import uuid
 import uvicorn
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pyngrok import ngrok, conf
-from typing import Union
+from typing import List, Optional, Union
 
-# Import your custom class from the inference.py file
-from inference import SimpleInference
+from annotation import ANNOTATE_MODES, AnnotationWorker, annotate_result, decode_image, extract_annotations
+from memory_guard import GPUMemoryExhausted
+from model_loader import ModelLoader
+from telemetry import REQUESTS, configure_logging, logger, metrics_payload, stage_timer, track_requests
+from ws_protocol import IMAGE_FORMATS, TASKS, pack_frame, unpack_frame
+
+# --- Model Loading ---
+# The model is loaded and warmed up in the background once the server has bound
+# its port. Until then the inference endpoints answer 503 and /readyz reports progress.
+# SimpleInference by default; set ROBOBRAIN_BACKEND=fake to run without a GPU.
+loader = ModelLoader("BAAI/RoboBrain2.0-3B")
+
+# Annotated images are only written to disk on request, by a background worker
+# that keeps at most ROBOBRAIN_ANNOTATION_MAX_FILES of them.
+annotation_worker = AnnotationWorker(
+    output_dir=os.environ.get("ROBOBRAIN_ANNOTATION_DIR", "result"),
+    max_files=int(os.environ.get("ROBOBRAIN_ANNOTATION_MAX_FILES", "200"))
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loader.start()
+    yield
+
+def decode_upload(data):
+    """
+    Decodes an uploaded image for annotation, or raises 422 when it cannot be decoded.
+    """
+    try:
+        return decode_image(data)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"{e} Send a JPEG, PNG or WebP image.")
+
+def get_model():
+    """
+    Returns the loaded model, or raises 503 while it is still loading or warming up.
+    """
+    if not loader.ready:
+        raise HTTPException(status_code=503, detail=f"Model is not ready yet (status: {loader.status}).", headers={"Retry-After": "5"})
+    return loader.model
 
-# --- FastAPI Application Setup ---
 app = FastAPI(
     title="RoboBrain Inference API",
     description="Access the RoboBrain 2.0 model over the internet via ngrok.",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
+app.middleware("http")(track_requests)
 
-# --- Model Loading ---
-print("Initializing server and loading model...")
-model = SimpleInference("BAAI/RoboBrain2.0-3B")
-print("Model loaded. Server is ready.")
-
-# --- API Endpoints (No changes here) ---
+# --- API Endpoints ---
 @app.get("/")
 def root():
     return {"message": "Welcome to the RoboBrain API. Send a POST request to /inference/ to use the model."}
 
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus scrape endpoint: stage latencies, tokens/s, GPU memory and in-flight requests.
+    """
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/healthz")
+def healthz():
+    """
+    Liveness probe: the process is up and serving HTTP.
+    """
+    return {"status": "alive"}
+
+@app.get("/readyz")
+def readyz():
+    """
+    Readiness probe: 200 once the model is loaded and warmed up, 503 before that.
+    """
+    body = {"status": loader.status}
+    if loader.error:
+        body["error"] = loader.error
+    if hasattr(loader.model, "replica_status"):
+        body["replicas"] = loader.model.replica_status()
+    return JSONResponse(status_code=200 if loader.ready else 503, content=body)
+
 @app.post("/inference/")
 async def run_inference(
     text: str = Form(...),
     image: UploadFile = File(...),
     do_sample: bool = Form(True),
-    temperature: float = Form(0.5)
+    temperature: float = Form(0.5),
+    enable_thinking: bool = Form(False, description="Let the model reason before answering."),
+    thinking_budget: Optional[int] = Form(None, description="Maximum reasoning tokens before the answer is forced."),
+    latency_sla: Optional[float] = Form(None, description="Target generate time in seconds; picks the thinking budget when none is given."),
+    annotate: str = Form("coords", description="'none', 'coords' (parsed points) or 'image' (points plus a base64 JPEG overlay)."),
+    save_annotation: bool = Form(False, description="Also write the annotated image to the result directory in the background.")
 ):
+    if annotate not in ANNOTATE_MODES:
+        raise HTTPException(status_code=422, detail=f"annotate must be one of {ANNOTATE_MODES}.")
+    model = get_model()
     TEMP_DIR = "temp_images"
     os.makedirs(TEMP_DIR, exist_ok=True)
-    temp_image_path = os.path.join(TEMP_DIR, image.filename)
+    temp_image_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}_{image.filename}")
     
     try:
-        with open(temp_image_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
+        with stage_timer("upload_read"):
+            data = await image.read()
+            with open(temp_image_path, "wb") as buffer:
+                buffer.write(data)
         
         absolute_image_path = os.path.abspath(temp_image_path)
-        print(f"Received request. Processing image at: {absolute_image_path}")
+        logger.debug("Received request. Processing image at: %s", absolute_image_path)
 
-        result = model.inference(
+        result = await run_in_threadpool(
+            model.inference,
             text=text,
             image=absolute_image_path,
             task="pointing",
-            plot=True,
+            plot=False,
+            enable_thinking=enable_thinking,
+            do_sample=do_sample,
+            temperature=temperature,
+            thinking_budget=thinking_budget,
+            latency_sla_s=latency_sla
+        )
+
+        # The upload is decoded from memory, only if an overlay or a saved copy was asked for.
+        return await run_in_threadpool(
+            annotate_result, result, "pointing", annotate, lambda: decode_upload(data),
+            image.filename, annotation_worker, save_annotation
+        )
+
+    except HTTPException:
+        raise
+    except GPUMemoryExhausted as e:
+        logger.warning("Rejected request under GPU memory pressure: %s", e)
+        raise HTTPException(status_code=503, detail=f"GPU memory is exhausted, please retry shortly: {e}", headers={"Retry-After": "5"})
+    except Exception as e:
+        logger.error("An error occurred during inference: %s", e)
+        raise HTTPException(status_code=500, detail=f"An internal error occurred: {e}")
+    
+    finally:
+        if os.path.exists(temp_image_path):
+            os.remove(temp_image_path)
+
+@app.post("/inference/batch/")
+async def run_batch_inference(
+    texts: List[str] = Form(...),
+    images: List[UploadFile] = File(...),
+    do_sample: bool = Form(True),
+    temperature: float = Form(0.5)
+):
+    """
+    Runs the pointing task on several (text, image) pairs in one generate call.
+    The i-th text is paired with the i-th image; results come back in the same order.
+    """
+    if len(texts) != len(images):
+        raise HTTPException(status_code=422, detail="Send exactly one text per image.")
+    model = get_model()
+
+    TEMP_DIR = "temp_images"
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    # Streams often upload frames under the same filename, so give each a unique one.
+    temp_image_paths = [
+        os.path.join(TEMP_DIR, f"{uuid.uuid4()}{os.path.splitext(image.filename)[1]}") for image in images
+    ]
+
+    try:
+        for image, temp_image_path in zip(images, temp_image_paths):
+            with stage_timer("upload_read"), open(temp_image_path, "wb") as buffer:
+                shutil.copyfileobj(image.file, buffer)
+
+        logger.debug("Received batch of %d images.", len(images))
+        results = await run_in_threadpool(
+            model.batch_inference,
+            texts=texts,
+            images=[os.path.abspath(path) for path in temp_image_paths],
+            task="pointing",
             enable_thinking=False,
             do_sample=do_sample,
             temperature=temperature
         )
-        
-        return result
 
+        return {"results": results}
+
+    except GPUMemoryExhausted as e:
+        logger.warning("Rejected request under GPU memory pressure: %s", e)
+        raise HTTPException(status_code=503, detail=f"GPU memory is exhausted, please retry shortly: {e}", headers={"Retry-After": "5"})
     except Exception as e:
-        print(f"An error occurred during inference: {e}")
+        logger.error("An error occurred during batched inference: %s", e)
         raise HTTPException(status_code=500, detail=f"An internal error occurred: {e}")
-    
+
+    finally:
+        for temp_image_path in temp_image_paths:
+            if os.path.exists(temp_image_path):
+                os.remove(temp_image_path)
+
+# Detections one WebSocket connection may have in flight; further frames wait to be read.
+WS_MAX_IN_FLIGHT = int(os.environ.get("ROBOBRAIN_WS_MAX_IN_FLIGHT", "4"))
+
+async def _ws_detect(header, payload):
+    """
+    Runs one WebSocket detection request and returns its response header.
+    """
+    request_id = header.get("id")
+    task = header.get("task", "pointing")
+    suffix = IMAGE_FORMATS.get(header.get("format", "jpeg"))
+    if suffix is None or not isinstance(header.get("text"), str) or not payload:
+        return {"id": request_id, "status": "error", "code": 422,
+                "detail": f"Need 'text', an image payload and a format in {list(IMAGE_FORMATS)}."}
+    if task not in TASKS:
+        return {"id": request_id, "status": "error", "code": 422, "detail": f"task must be one of {list(TASKS)}."}
+    if not loader.ready:
+        return {"id": request_id, "status": "error", "code": 503,
+                "detail": f"Model is not ready yet (status: {loader.status})."}
+
+    TEMP_DIR = "temp_images"
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    temp_image_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}{suffix}")
+    start = time.perf_counter()
+    try:
+        with stage_timer("upload_read"), open(temp_image_path, "wb") as buffer:
+            buffer.write(payload)
+        result = await run_in_threadpool(
+            loader.model.inference,
+            text=header["text"],
+            image=os.path.abspath(temp_image_path),
+            task=task,
+            plot=False,
+            enable_thinking=False,
+            do_sample=header.get("do_sample", True),
+            temperature=header.get("temperature", 0.5)
+        )
+        annotations = extract_annotations(task, result["answer"])
+        return {"id": request_id, "status": "ok", "answer": result["answer"],
+                "server_s": time.perf_counter() - start, **annotations}
+    except GPUMemoryExhausted as e:
+        logger.warning("Rejected WebSocket request under GPU memory pressure: %s", e)
+        return {"id": request_id, "status": "error", "code": 503, "detail": f"GPU memory is exhausted, please retry shortly: {e}"}
+    except Exception as e:
+        logger.error("An error occurred during WebSocket inference: %s", e)
+        return {"id": request_id, "status": "error", "code": 500, "detail": f"An internal error occurred: {e}"}
     finally:
         if os.path.exists(temp_image_path):
             os.remove(temp_image_path)
-        if os.path.exists(TEMP_DIR) and not os.listdir(TEMP_DIR):
-            os.rmdir(TEMP_DIR)
+
+@app.websocket("/ws")
+async def inference_socket(websocket: WebSocket):
+    """
+    Persistent binary detection channel, see ws_protocol.py for the framing.
+    Requests are handled concurrently and answered as they finish, matched by their id.
+    """
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    in_flight = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+    tasks = set()
+
+    async def handle(data):
+        try:
+            try:
+                header, payload = unpack_frame(data)
+            except Exception as e:
+                response = {"id": None, "status": "error", "code": 400, "detail": f"Malformed frame: {e}"}
+            else:
+                response = await _ws_detect(header, payload)
+            REQUESTS.labels(path="/ws", status=str(response.get("code", 200))).inc()
+            async with send_lock:
+                await websocket.send_bytes(pack_frame(response))
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # The client went away before its answer was ready.
+        finally:
+            in_flight.release()
+
+    try:
+        while True:
+            data = await websocket.receive_bytes()
+            # Stop reading once the connection has enough work queued; TCP pushes back on the client.
+            await in_flight.acquire()
+            task = asyncio.create_task(handle(data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        logger.debug("WebSocket client disconnected with %d request(s) in flight.", len(tasks))
+    finally:
+        for task in list(tasks):
+            task.cancel()
 
 # --- Main execution block to start the server and ngrok tunnel ---
 if __name__ == "__main__":
+    configure_logging()
     # Get your ngrok authtoken from https://dashboard.ngrok.com/get-started/your-authtoken
     # It's recommended to set this as an environment variable for security,
     # but we will ask for it as input for simplicity.
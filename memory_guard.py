@@ -0,0 +1,177 @@
+import threading, time
+
+from telemetry import DEGRADED_REQUESTS, GPU_MEMORY_HEADROOM_BYTES, GPU_OOM_EVENTS, logger
+
+
+class GPUMemoryExhausted(RuntimeError):
+    """
+    A request could not get enough GPU memory, even after downscaling and
+    waiting. The API servers answer it with 503 and Retry-After, not 500.
+    """
+
+
+class MemoryGuard:
+    """
+    Admission control for GPU memory.
+
+    The memory a generate call needs is estimated from its visual tokens, text
+    tokens and max_new_tokens using the model config: KV cache, per-token
+    activations, and the attention matrices of the vision tower when no flash
+    attention is used. Before preprocessing, plan_visual_tokens() downscales
+    images whose estimate would take more than max_request_fraction of the
+    GPU, or more than the current headroom. Right before generate, admit()
+    waits up to queue_timeout_s for memory held by other requests or processes
+    to be released. After a CUDA OOM, recover_from_oom() frees the allocator
+    cache and makes later estimates more pessimistic; record_success() eases
+    them back once decay_after generate calls in a row have gone through.
+
+    torch is passed in, as in telemetry.record_gpu_memory(), so this module can
+    be imported without it.
+    """
+
+    def __init__(self, torch, config, dtype_bytes=2, reserve_fraction=0.05, max_request_fraction=0.5,
+                 queue_timeout_s=10.0, min_visual_tokens=256, decay_after=20):
+        self.torch = torch
+        self.dtype_bytes = dtype_bytes
+        self.max_request_fraction = max_request_fraction
+        self.queue_timeout_s = queue_timeout_s
+        self.min_visual_tokens = min_visual_tokens
+        # Multiplier on every estimate; raised after each OOM, lowered again by successful calls.
+        self.scale = 1.0
+        self.decay_after = decay_after
+        self.successes = 0
+        self.lock = threading.Lock()
+
+        _, self.total_bytes = torch.cuda.mem_get_info()
+        self.reserve_bytes = int(reserve_fraction * self.total_bytes)
+
+        vision = getattr(config, "vision_config", None)
+        hidden = config.hidden_size
+        head_dim = hidden // config.num_attention_heads
+        kv_heads = getattr(config, "num_key_value_heads", config.num_attention_heads)
+        flash = getattr(config, "_attn_implementation", None) == "flash_attention_2"
+
+        self.kv_bytes_per_token = 2 * config.num_hidden_layers * kv_heads * head_dim * dtype_bytes
+        # Residual stream, q/k/v/o projections and the MLP of one layer are alive at once.
+        self.text_act_bytes_per_token = (4 * hidden + 2 * config.intermediate_size) * dtype_bytes
+        self.text_attention_heads = 0 if flash else config.num_attention_heads
+        merge_size = getattr(vision, "spatial_merge_size", 2)
+        self.patches_per_visual_token = merge_size ** 2
+        self.vision_act_bytes_per_patch = (4 * getattr(vision, "hidden_size", 1280)
+                                           + 2 * getattr(vision, "intermediate_size", 3420)) * dtype_bytes
+        self.vision_attention_heads = 0 if flash else getattr(vision, "num_heads", 16)
+
+    def estimate(self, visual_tokens, text_tokens, new_tokens, batch=1):
+        """
+        Estimated peak bytes of one generate call, for `batch` sequences of this size.
+        """
+        prompt = visual_tokens + text_tokens
+        patches = visual_tokens * self.patches_per_visual_token
+        per_sequence = (
+            self.kv_bytes_per_token * (prompt + new_tokens)
+            + self.text_act_bytes_per_token * prompt
+            + self.text_attention_heads * prompt * prompt * self.dtype_bytes
+            + self.vision_act_bytes_per_patch * patches
+            + self.vision_attention_heads * patches * patches * self.dtype_bytes
+        )
+        return int(self.scale * batch * per_sequence)
+
+    def headroom_bytes(self):
+        """
+        Memory a new request can use right now: free device memory plus blocks
+        cached by the allocator, minus the safety reserve.
+        """
+        free, _ = self.torch.cuda.mem_get_info()
+        cached = self.torch.cuda.memory_reserved() - self.torch.cuda.memory_allocated()
+        headroom = max(0, free + cached - self.reserve_bytes)
+        GPU_MEMORY_HEADROOM_BYTES.set(headroom)
+        return headroom
+
+    def plan_visual_tokens(self, visual_tokens, text_tokens, new_tokens, batch=1):
+        """
+        Largest number of visual tokens per sequence, up to the requested one,
+        whose estimate fits both the per-request cap and the current headroom.
+        """
+        limit = min(self.max_request_fraction * (self.total_bytes - self.reserve_bytes), self.headroom_bytes())
+        allowed = visual_tokens
+        while allowed > self.min_visual_tokens and self.estimate(allowed, text_tokens, new_tokens, batch) > limit:
+            allowed = max(self.min_visual_tokens, int(allowed * 0.75))
+        if allowed < visual_tokens:
+            DEGRADED_REQUESTS.labels(action="downscale").inc()
+            logger.info("Downscaling image from %d to %d visual tokens to fit GPU memory.", visual_tokens, allowed)
+        return allowed
+
+    def split_batch(self, estimates):
+        """
+        Group per-sequence estimates into consecutive chunks that each fit the
+        current headroom. Returns a list of index lists.
+        """
+        budget = self.headroom_bytes()
+        chunks, current, used = [], [], 0
+        for i, estimate in enumerate(estimates):
+            if current and used + estimate > budget:
+                chunks.append(current)
+                current, used = [], 0
+            current.append(i)
+            used += estimate
+        chunks.append(current)
+        if len(chunks) > 1:
+            DEGRADED_REQUESTS.labels(action="split_batch").inc()
+            logger.info("Splitting batch of %d into %d chunks to fit GPU memory.", len(estimates), len(chunks))
+        return chunks
+
+    def admit(self, estimate, lock=None):
+        """
+        Block until the estimate fits the headroom, for at most queue_timeout_s.
+        A lock held by the caller is released while waiting and re-acquired
+        before returning or raising.
+        """
+        deadline = time.perf_counter() + self.queue_timeout_s
+        queued = False
+        while self.headroom_bytes() < estimate:
+            if not queued:
+                queued = True
+                DEGRADED_REQUESTS.labels(action="queued").inc()
+                logger.info("Waiting for %.0f MiB of GPU memory.", estimate / 2**20)
+                # Cached blocks of finished requests may be fragmented; give them back first.
+                self.torch.cuda.empty_cache()
+                continue
+            if time.perf_counter() > deadline:
+                raise GPUMemoryExhausted(
+                    f"Request needs about {estimate / 2**20:.0f} MiB of GPU memory, "
+                    f"only {self.headroom_bytes() / 2**20:.0f} MiB available.")
+            if lock is None:
+                time.sleep(0.1)
+                continue
+            lock.release()
+            try:
+                time.sleep(0.1)
+            finally:
+                lock.acquire()
+
+    def recover_from_oom(self):
+        """
+        Call after a CUDA OOM: release cached memory and make estimates more pessimistic.
+        """
+        GPU_OOM_EVENTS.inc()
+        self.torch.cuda.empty_cache()
+        with self.lock:
+            self.scale = min(4.0, self.scale * 1.5)
+            self.successes = 0
+        logger.warning("CUDA out of memory; estimates scaled by %.2f until requests succeed again.", self.scale)
+
+    def record_success(self):
+        """
+        Call after a generate call that did not run out of memory. Every decay_after
+        of them in a row take a step of the OOM scaling back, down to 1.0.
+        """
+        with self.lock:
+            if self.scale == 1.0:
+                return
+            self.successes += 1
+            if self.successes < self.decay_after:
+                return
+            self.successes = 0
+            self.scale = max(1.0, self.scale / 1.5)
+            scale = self.scale
+        logger.info("Estimates scaled by %.2f after %d successful requests.", scale, self.decay_after)
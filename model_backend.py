@@ -0,0 +1,53 @@
+import os
+
+
+def create_model(model_id="BAAI/RoboBrain2.0-3B"):
+    """
+    Build the inference backend selected by the ROBOBRAIN_BACKEND environment variable.
+
+    ROBOBRAIN_BACKEND:
+        "hf" (default)  SimpleInference, the real Hugging Face model on GPU. ROBOBRAIN_CACHE_DIR
+                        (default ".model_cache") keeps its processor and config for fast restarts.
+                        ROBOBRAIN_ASSISTANT enables assisted decoding: "prompt_lookup[:N]" or the id
+                        of a smaller draft model (see inference.parse_assistant).
+                        ROBOBRAIN_THINKING_BUDGET caps reasoning tokens when thinking is enabled.
+                        ROBOBRAIN_PIPELINE_WORKERS=N (N > 0) overlaps preprocessing of the next
+                        request with generation of the current one, see PipelinedInference.
+                        ROBOBRAIN_FEATURE_CACHE_DIR (unset by default) keeps preprocessed pixels,
+                        visual embeddings and greedy results of stored images across restarts, up
+                        to ROBOBRAIN_FEATURE_CACHE_MAX_MB (default 2048), see FeatureCache.
+        "fake"          FakeInference, no GPU or weights needed. Its behaviour is set with
+                        FAKE_LATENCY (e.g. "lognormal:0.3:0.5"), FAKE_SAME_RATE and FAKE_SEED.
+
+    The imports are done lazily so the fake backend does not pull in torch.
+    """
+    backend = os.environ.get("ROBOBRAIN_BACKEND", "hf").lower()
+
+    if backend == "fake":
+        from fake_inference import FakeInference
+        seed = os.environ.get("FAKE_SEED")
+        return FakeInference(
+            model_id,
+            latency=os.environ.get("FAKE_LATENCY", "lognormal:0.3:0.5"),
+            same_rate=float(os.environ.get("FAKE_SAME_RATE", "0.9")),
+            seed=int(seed) if seed is not None else None
+        )
+    if backend == "hf":
+        # Must be set before torch initialises CUDA; growable segments fragment less under mixed image sizes.
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+        from inference import SimpleInference
+        model = SimpleInference(
+            model_id,
+            cache_dir=os.environ.get("ROBOBRAIN_CACHE_DIR", ".model_cache") or None,
+            assistant=os.environ.get("ROBOBRAIN_ASSISTANT") or None,
+            thinking_budget=int(os.environ["ROBOBRAIN_THINKING_BUDGET"]) if os.environ.get("ROBOBRAIN_THINKING_BUDGET") else None,
+            feature_cache_dir=os.environ.get("ROBOBRAIN_FEATURE_CACHE_DIR") or None,
+            feature_cache_max_bytes=int(os.environ.get("ROBOBRAIN_FEATURE_CACHE_MAX_MB", "2048")) * 2**20
+        )
+        workers = int(os.environ.get("ROBOBRAIN_PIPELINE_WORKERS", "0"))
+        if workers > 0:
+            from inference_pipeline import PipelinedInference
+            model = PipelinedInference(model, preprocess_workers=workers)
+        return model
+
+    raise ValueError(f"Unknown ROBOBRAIN_BACKEND: {backend}. Supported backends are 'hf' and 'fake'.")
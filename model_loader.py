@@ -0,0 +1,100 @@
+import os, tempfile, threading, time
+from PIL import Image
+
+from model_backend import create_model
+from telemetry import logger
+
+# "task:WIDTHxHEIGHT" pairs run once after loading so CUDA kernels and the allocator
+# are warm before the first real request. Set ROBOBRAIN_WARMUP="" to skip warm-up.
+DEFAULT_WARMUP = "pointing:640x480,verify:640x480"
+
+# How long a model pool may take to load and warm up every replica (ROBOBRAIN_READY_TIMEOUT_S).
+DEFAULT_READY_TIMEOUT_S = 1800.0
+
+
+def parse_warmup(spec):
+    """
+    "pointing:640x480,verify:1280x720" -> [("pointing", 640, 480), ("verify", 1280, 720)]
+    """
+    shapes = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        task, size = item.split(":")
+        width, height = size.lower().split("x")
+        shapes.append((task, int(width), int(height)))
+    return shapes
+
+
+def warm_up(model, shapes):
+    """
+    Run one request per (task, width, height) on a synthetic image.
+    """
+    for task, width, height in shapes:
+        # Noise rather than a flat colour, so the vision tower sees a realistic workload.
+        image = Image.effect_noise((width, height), 64).convert("RGB")
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+            path = f.name
+        try:
+            image.save(path)
+            start = time.perf_counter()
+            model.inference("the object", path, task=task, plot=False, enable_thinking=False, do_sample=False)
+            logger.info("Warm-up %s %dx%d took %.2fs.", task, width, height, time.perf_counter() - start)
+        finally:
+            os.remove(path)
+
+
+class ModelLoader:
+    """
+    Loads the model in a background thread so the server can bind its port
+    immediately, then warms it up. status moves through
+    "loading" -> "warming" -> "ready" (or "failed"). When ROBOBRAIN_REPLICAS
+    is set the model is a ModelPool of replica processes instead.
+    """
+
+    def __init__(self, model_id="BAAI/RoboBrain2.0-3B", warmup=None):
+        self.model_id = model_id
+        self.warmup = parse_warmup(os.environ.get("ROBOBRAIN_WARMUP", DEFAULT_WARMUP) if warmup is None else warmup)
+        self.model = None
+        self.status = "not_started"
+        self.error = None
+        self.thread = None
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def start(self):
+        if self.thread is None:
+            self.status = "loading"
+            self.thread = threading.Thread(target=self._load, daemon=True)
+            self.thread.start()
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            replicas = os.environ.get("ROBOBRAIN_REPLICAS")
+            if replicas:
+                # Each replica process loads and warms up its own copy.
+                from model_pool import ModelPool, parse_replicas
+                logger.info("Starting model pool for %s (replicas: %s) ...", self.model_id, replicas)
+                self.status = "warming"
+                model = ModelPool(self.model_id, parse_replicas(replicas), warmup=self.warmup)
+                try:
+                    model.wait_ready(float(os.environ.get("ROBOBRAIN_READY_TIMEOUT_S", DEFAULT_READY_TIMEOUT_S)))
+                except Exception:
+                    model.close()
+                    raise
+            else:
+                logger.info("Loading model %s in the background ...", self.model_id)
+                model = create_model(self.model_id)
+                logger.info("Model loaded in %.1fs.", time.perf_counter() - start)
+
+                self.status = "warming"
+                warm_up(model, self.warmup)
+            self.model = model
+            self.status = "ready"
+            logger.info("Model ready in %.1fs.", time.perf_counter() - start)
+        except Exception as e:
+            self.error = str(e)
+            self.status = "failed"
+            logger.exception("Model loading failed: %s", e)
+
@@ -0,0 +1,299 @@
+import hashlib, itertools, multiprocessing, os, queue, threading, time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from model_backend import create_model
+from memory_guard import GPUMemoryExhausted
+from model_loader import warm_up
+from telemetry import configure_logging, logger, mark_process_dead
+
+
+def parse_replicas(spec):
+    """
+    Turn ROBOBRAIN_REPLICAS into one CUDA device index per replica.
+
+        "auto"     one replica per visible GPU
+        "3"        three replicas spread round-robin over the visible GPUs
+        "0,0,1"    explicit devices: two replicas on GPU 0, one on GPU 1
+    """
+    spec = spec.strip().lower()
+    if "," in spec:
+        return [int(device) for device in spec.split(",")]
+
+    import torch
+    gpu_count = torch.cuda.device_count()
+    if gpu_count == 0:
+        raise RuntimeError("ROBOBRAIN_REPLICAS needs at least one visible GPU.")
+    count = gpu_count if spec == "auto" else int(spec)
+    return [i % gpu_count for i in range(count)]
+
+
+def _replica_main(index, generation, device, model_id, warmup, requests, responses):
+    """
+    Entry point of a replica process: load one model on one GPU and serve
+    (request_id, method, kwargs) items from its request queue until it gets None.
+    """
+    configure_logging()
+    # Must happen before torch initialises CUDA in this process.
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+    model = create_model(model_id)
+    warm_up(model, warmup)
+    responses.put((index, generation, None, "ready", None))
+
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        request_id, method, kwargs = item
+        # The pool times requests from here, not from when they were queued.
+        responses.put((index, generation, request_id, "started", None))
+        try:
+            result = getattr(model, method)(**kwargs)
+            responses.put((index, generation, request_id, "ok", result))
+        except GPUMemoryExhausted as e:
+            responses.put((index, generation, request_id, "oom", str(e)))
+        except Exception as e:
+            responses.put((index, generation, request_id, "error", f"{type(e).__name__}: {e}"))
+
+
+class _Replica:
+    def __init__(self, index, device):
+        self.index = index
+        self.device = device
+        self.generation = 0
+        self.process = None
+        self.requests = None
+        self.ready = False
+        # Restarts since the replica was last ready, and when the next one is due.
+        self.restarts = 0
+        self.restart_at = None
+        self.failed = False
+        # request_id -> (future, start time, or None until the replica picks it up)
+        self.outstanding = {}
+
+
+class ModelPool:
+    """
+    Hosts one model replica per worker process and dispatches requests to them.
+
+    Dispatch is least-outstanding-requests. Requests on an image the pool has
+    seen before go back to the same replica (affinity by image content), so
+    per-image caches stay warm, unless that replica is clearly busier than the
+    others. A monitor thread restarts replicas whose process died or whose
+    request ran for longer than request_timeout, waiting restart_backoff_s,
+    then twice as long after every further failure (at most max_backoff_s).
+    A replica that fails max_restarts times without becoming ready is given
+    up on and self.error is set; wait_ready() then raises. Replicas record
+    their metrics in PROMETHEUS_MULTIPROC_DIR (see telemetry), so the server's
+    /metrics covers them.
+
+    The pool exposes the same inference()/batch_inference() methods as
+    SimpleInference, so the API servers use it unchanged.
+    """
+
+    def __init__(self, model_id, devices, warmup=(), request_timeout=300.0, affinity_slack=2, max_affinity_keys=10000,
+                 max_restarts=5, restart_backoff_s=1.0, max_backoff_s=60.0):
+        self.model_id = model_id
+        self.warmup = list(warmup)
+        self.request_timeout = request_timeout
+        self.max_restarts = max_restarts
+        self.restart_backoff_s = restart_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.affinity_slack = affinity_slack
+        self.max_affinity_keys = max_affinity_keys
+
+        # spawn, not fork: a forked child cannot re-initialise CUDA.
+        self.ctx = multiprocessing.get_context("spawn")
+        self.responses = self.ctx.Queue()
+        self.replicas = [_Replica(i, device) for i, device in enumerate(devices)]
+        self.affinity = OrderedDict()
+        self.request_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.all_ready = threading.Event()
+        self.error = None
+        self.running = True
+
+        for replica in self.replicas:
+            replica.requests = self.ctx.Queue()
+            self._start_replica(replica)
+        threading.Thread(target=self._collect_responses, daemon=True).start()
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    # --- Replica lifecycle ---
+    def _start_replica(self, replica):
+        replica.generation += 1
+        replica.ready = False
+        replica.process = self.ctx.Process(
+            target=_replica_main,
+            args=(replica.index, replica.generation, replica.device, self.model_id, self.warmup,
+                  replica.requests, self.responses),
+            daemon=True,
+        )
+        replica.process.start()
+        logger.info("Started replica %d on GPU %d (pid %d).", replica.index, replica.device, replica.process.pid)
+
+    def _restart_replica(self, replica, reason):
+        """
+        Fail everything the replica still owes, stop its process and schedule a
+        fresh one after the backoff, or give up on it. Call with self.lock held.
+        Returns the stopped process, for the caller to join once the lock is released.
+        """
+        for future, _ in replica.outstanding.values():
+            future.set_exception(RuntimeError(f"Model replica {replica.index} failed: {reason}"))
+        replica.outstanding = {}
+        stopped = replica.process
+        if stopped.is_alive():
+            stopped.terminate()
+        replica.ready = False
+        # Requests dispatched while the replica is down wait here for the new process.
+        replica.requests = self.ctx.Queue()
+
+        replica.restarts += 1
+        if replica.restarts > self.max_restarts:
+            replica.failed = True
+            self.error = f"Model replica {replica.index} failed {self.max_restarts} restarts in a row: {reason}"
+            logger.error(self.error)
+            return stopped
+        delay = min(self.max_backoff_s, self.restart_backoff_s * 2 ** (replica.restarts - 1))
+        logger.error("Restarting replica %d in %.1fs: %s", replica.index, delay, reason)
+        replica.restart_at = time.perf_counter() + delay
+        return stopped
+
+    def _monitor(self):
+        while self.running:
+            time.sleep(1.0)
+            now = time.perf_counter()
+            stopped = []
+            with self.lock:
+                for replica in self.replicas:
+                    if replica.failed:
+                        continue
+                    if replica.restart_at is not None:
+                        if now >= replica.restart_at:
+                            replica.restart_at = None
+                            self._start_replica(replica)
+                    elif not replica.process.is_alive():
+                        stopped.append(self._restart_replica(
+                            replica, f"process exited with code {replica.process.exitcode}"))
+                    elif any(start is not None and now - start > self.request_timeout
+                             for _, start in replica.outstanding.values()):
+                        stopped.append(self._restart_replica(replica, f"request exceeded {self.request_timeout:.0f}s"))
+            # Outside the lock, so dispatch and result collection go on while a process shuts down.
+            for process in stopped:
+                process.join(timeout=5)
+                mark_process_dead(process.pid)
+
+    def _collect_responses(self):
+        while self.running:
+            try:
+                index, generation, request_id, status, payload = self.responses.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            with self.lock:
+                replica = self.replicas[index]
+                if generation != replica.generation:
+                    continue  # Late message from a process that has been replaced.
+                if status == "ready":
+                    replica.ready = True
+                    replica.restarts = 0
+                    logger.info("Replica %d is ready.", index)
+                    if all(r.ready for r in self.replicas):
+                        self.all_ready.set()
+                    continue
+                if status == "started":
+                    if request_id in replica.outstanding:
+                        replica.outstanding[request_id] = (replica.outstanding[request_id][0], time.perf_counter())
+                    continue
+                future, _ = replica.outstanding.pop(request_id, (None, None))
+            if future is None:
+                continue
+            if status == "ok":
+                future.set_result(payload)
+            elif status == "oom":
+                # Keep the type, so the servers answer 503 as they do without a pool.
+                future.set_exception(GPUMemoryExhausted(payload))
+            else:
+                future.set_exception(RuntimeError(payload))
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until every replica has loaded and warmed up its model. Raises
+        RuntimeError when a replica has been given up on.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self.all_ready.wait(1.0):
+            if self.error is not None:
+                raise RuntimeError(self.error)
+            if deadline is not None and time.perf_counter() > deadline:
+                raise TimeoutError("Model replicas did not become ready in time.")
+
+    def replica_status(self):
+        with self.lock:
+            return [
+                {"replica": r.index, "gpu": r.device, "ready": r.ready, "failed": r.failed,
+                 "restarts": r.restarts, "outstanding": len(r.outstanding)}
+                for r in self.replicas
+            ]
+
+    # --- Dispatch ---
+    @staticmethod
+    def _affinity_key(image):
+        """
+        Content hash of the request's image, so the same picture maps to the
+        same replica whatever file name it was uploaded under.
+        """
+        path = image[0] if isinstance(image, list) else image
+        if not isinstance(path, str) or path.startswith("http") or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _pick_replica(self, key):
+        """
+        Least-outstanding ready replica, preferring the one bound to key. Call with self.lock held.
+        """
+        candidates = [r for r in self.replicas if r.ready] or [r for r in self.replicas if not r.failed]
+        if not candidates:
+            raise RuntimeError(self.error)
+        least_loaded = min(candidates, key=lambda r: len(r.outstanding))
+
+        if key is not None and key in self.affinity:
+            bound = self.replicas[self.affinity[key]]
+            if bound in candidates and len(bound.outstanding) <= len(least_loaded.outstanding) + self.affinity_slack:
+                self.affinity.move_to_end(key)
+                return bound
+
+        if key is not None:
+            self.affinity[key] = least_loaded.index
+            self.affinity.move_to_end(key)
+            if len(self.affinity) > self.max_affinity_keys:
+                self.affinity.popitem(last=False)
+        return least_loaded
+
+    def submit(self, method, affinity_key=None, **kwargs):
+        """
+        Queue one call of model.<method>(**kwargs) on a replica; returns a Future.
+        """
+        future = Future()
+        with self.lock:
+            replica = self._pick_replica(affinity_key)
+            request_id = next(self.request_ids)
+            replica.outstanding[request_id] = (future, None)
+            replica.requests.put((request_id, method, kwargs))
+        return future
+
+    def inference(self, text, image, **kwargs):
+        return self.submit("inference", affinity_key=self._affinity_key(image), text=text, image=image, **kwargs).result()
+
+    def batch_inference(self, texts, images, **kwargs):
+        return self.submit("batch_inference", texts=texts, images=images, **kwargs).result()
+
+    def close(self):
+        self.running = False
+        for replica in self.replicas:
+            replica.requests.put(None)
+        for replica in self.replicas:
+            replica.process.join(timeout=10)
+            if replica.process.is_alive():
+                # Still loading, or stuck in a request.
+                replica.process.terminate()
@@ -0,0 +1,117 @@
+import logging, os, tempfile, time
+from contextlib import contextmanager
+
+# --- Multi-process metrics ---
+# With ROBOBRAIN_REPLICAS, generate runs in replica processes. They and the server then write
+# their metrics to PROMETHEUS_MULTIPROC_DIR, which /metrics aggregates. prometheus_client reads
+# the variable on import, and spawned replicas inherit it, so it is set before the import below.
+if os.environ.get("ROBOBRAIN_REPLICAS") and not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="robobrain_metrics_")
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# --- Logging ---
+# ROBOBRAIN_LOG_LEVEL=DEBUG brings back the per-request prompt dumps; INFO (default) keeps the hot path quiet.
+logger = logging.getLogger("robobrain")
+logger.setLevel(os.environ.get("ROBOBRAIN_LOG_LEVEL", "INFO").upper())
+
+
+def configure_logging():
+    """
+    Set up the root log handler. Called by the entry points, not on import, so
+    importing these modules leaves an application's own logging setup alone.
+    """
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+# --- Metrics ---
+STAGE_SECONDS = Histogram(
+    "robobrain_stage_seconds",
+    "Time spent in each request stage.",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+GENERATED_TOKENS = Counter("robobrain_generated_tokens_total", "Tokens produced by generate.")
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "robobrain_decode_tokens_per_second",
+    "Decode speed of each generate call, excluding prefill.",
+    buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 400),
+)
+# Per process in multi-process mode (a pid label per live replica); ignored otherwise.
+GPU_MEMORY_PEAK_BYTES = Gauge("robobrain_gpu_memory_peak_bytes", "High-water mark of allocated GPU memory.",
+                              multiprocess_mode="liveall")
+GPU_MEMORY_ALLOCATED_BYTES = Gauge("robobrain_gpu_memory_allocated_bytes", "GPU memory allocated after the last request.",
+                                   multiprocess_mode="liveall")
+GPU_MEMORY_HEADROOM_BYTES = Gauge("robobrain_gpu_memory_headroom_bytes", "GPU memory a new request could use, after the safety reserve.",
+                                  multiprocess_mode="liveall")
+GPU_OOM_EVENTS = Counter("robobrain_gpu_oom_total", "CUDA out-of-memory errors recovered from.")
+DEGRADED_REQUESTS = Counter("robobrain_degraded_requests_total", "Requests degraded to fit GPU memory.", ["action"])
+IN_FLIGHT_REQUESTS = Gauge("robobrain_in_flight_requests", "Requests currently being handled (queue depth).",
+                           multiprocess_mode="livesum")
+DRAFT_TOKENS = Counter("robobrain_draft_tokens_total", "Tokens proposed by the assisted-decoding drafter.")
+ACCEPTED_DRAFT_TOKENS = Counter("robobrain_accepted_draft_tokens_total", "Drafted tokens accepted by the target model.")
+THINKING_BUDGET_FORCED = Counter("robobrain_thinking_budget_forced_total", "Sequences whose answer was forced by the thinking budget.")
+FEATURE_CACHE_LOOKUPS = Counter("robobrain_feature_cache_lookups_total", "Warm-restart feature cache lookups.", ["kind", "outcome"])
+REQUESTS = Counter("robobrain_requests_total", "Handled HTTP requests.", ["path", "status"])
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Time the enclosed block and record it under robobrain_stage_seconds{stage=...}.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage=stage).observe(time.perf_counter() - start)
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+
+def record_gpu_memory(torch):
+    """
+    Publish the current and peak allocated GPU memory.
+    """
+    if torch.cuda.is_available():
+        GPU_MEMORY_PEAK_BYTES.set(torch.cuda.max_memory_allocated())
+        GPU_MEMORY_ALLOCATED_BYTES.set(torch.cuda.memory_allocated())
+
+
+async def track_requests(request, call_next):
+    """
+    FastAPI HTTP middleware: keeps the in-flight gauge and per-route request counter up to date.
+    Requests are labelled with the route template, so the label set stays bounded;
+    anything that matched no route counts as "other".
+    """
+    IN_FLIGHT_REQUESTS.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        IN_FLIGHT_REQUESTS.dec()
+        route = request.scope.get("route")
+        REQUESTS.labels(path=getattr(route, "path", "other"), status=str(status)).inc()
+
+
+def metrics_payload():
+    """
+    Returns (body, content_type) in the Prometheus text exposition format. In
+    multi-process mode the metrics of every process are merged.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """
+    Drops the live gauges of a stopped replica process in multi-process mode.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,46 @@
+import struct
+import msgpack
+
+# Binary framing used on the /ws endpoint. Every WebSocket message is
+#
+#     [4-byte big-endian header length][msgpack header][payload]
+#
+# Requests carry an encoded image as payload and a header like
+#     {"id": 7, "text": "Point to the keys", "task": "pointing", "format": "jpeg"}
+# Responses have an empty payload and a header like
+#     {"id": 7, "status": "ok", "points": [[x, y], ...], "answer": "...", "server_s": 0.41}
+# or {"id": 7, "status": "error", "code": 503, "detail": "..."}.
+# The id lets a client keep several detections in flight on one connection;
+# responses may come back in any order.
+
+HEADER_LENGTH = struct.Struct("!I")
+
+# Image formats accepted in the "format" header field, with the file suffix used server-side.
+IMAGE_FORMATS = {"jpeg": ".jpg", "webp": ".webp", "png": ".png"}
+
+# Values accepted in the "task" header field; the model's single-image tasks.
+TASKS = ("general", "pointing", "affordance", "trajectory", "grounding", "verify", "object")
+
+
+def pack_frame(header, payload=b""):
+    """
+    Build one binary message from a header dict and an optional payload.
+    """
+    header_bytes = msgpack.packb(header, use_bin_type=True)
+    return HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + payload
+
+
+def unpack_frame(data):
+    """
+    Split one binary message into (header dict, payload bytes).
+    """
+    if len(data) < HEADER_LENGTH.size:
+        raise ValueError("Frame is shorter than its length prefix.")
+    (length,) = HEADER_LENGTH.unpack_from(data)
+    end = HEADER_LENGTH.size + length
+    if len(data) < end:
+        raise ValueError("Frame is shorter than its declared header length.")
+    header = msgpack.unpackb(data[HEADER_LENGTH.size:end], raw=False)
+    if not isinstance(header, dict):
+        raise ValueError("Frame header must be a map.")
+    return header, data[end:]